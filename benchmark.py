@@ -0,0 +1,232 @@
+
+# Benchmarks for kogin.py
+#
+#   python benchmark.py startup [path]
+#   python benchmark.py encoding [path]
+#   python benchmark.py output [path]
+#
+# Templates are generated when no path is specified.
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, join
+
+KOGIN = join(dirname(abspath(__file__)), 'kogin.py')
+
+
+def make_data(width, height, seed=0, colors=('#000000', '#ff0000')):
+    """ Generates kogin-data with random stitches in each row. """
+    rnd = random.Random(seed)
+    refs = {}
+    for y in range(height):
+        x = rnd.randrange(0, 3)
+        while True:
+            length = rnd.randrange(1, 8)
+            if x + length > width:
+                break
+            color = rnd.choice(colors)
+            refs.setdefault((length, color), []).append([x, y])
+            x += length + rnd.randrange(1, 4)
+    children = [{'ref': '{}-{}'.format(length, color[1:]), 'coords': coords}
+                for (length, color), coords in refs.items()]
+    lengths = {}
+    for length, color in refs.keys():
+        lengths.setdefault(str(length), []).append(color)
+    return {
+        'application': 'kogin',
+        'data': [{'layer': True, 'name': 'Layer 1', 'visible': True, 'locked': False,
+                  'x': 0, 'y': 0, 'children': children}],
+        'defs': {'single': [{'length': key, 'colors': value} for key, value in lengths.items()]},
+        'pivots': [],
+        'bbox': [0, 0, width, height],
+    }
+
+
+def make_option():
+    output = {
+        'noData': False, 'useXLink': True, 'gridNumber': False, 'monochrome': False,
+        'setBackground': True, 'backgroundColor': '#ffffff', 'strokeWidth': 16,
+        'leftMargin': 1, 'rightMargin': 1, 'topMargin': 1, 'bottomMargin': 1,
+        'showTitle': False, 'showCopyright': False,
+        'lineGrainLineWidth': 8, 'overGrainLineWidth': 8, 'overWarpLineWidth': 8,
+        'overGrainOffsetRatio': 0.1, 'overWarpOffsetRatio': 0.1,
+    }
+    grid = {
+        'showGrid': True, 'overGrid': False, 'horiCount': 100, 'vertCount': 50,
+        'gridWidth': 16, 'gridHeight': 16, 'gridLineWidth': 1.0,
+        'gridLineColor': '#00000020', 'gridMajorLineColor': '#00000050',
+        'gridMajorLineFrequency': 5, 'gridMajorVertOffset': 1, 'gridMajorHoriOffset': 1,
+        'showGridMajorLine': True, 'showGridFrame': True, 'numberingColor': '#00000050',
+    }
+    printOutput = dict(output, setBackground=False, strokeWidth=2,
+                       lineGrainLineWidth=2, overGrainLineWidth=2, overWarpLineWidth=2)
+    printGrid = dict(grid, gridWidth=4, gridHeight=4, gridLineWidth=0.15,
+                     gridLineColor='#bbbbbb', gridMajorLineColor='#000000', numberingColor='#000000')
+    return {
+        'output-screen': output,
+        'output-print': printOutput,
+        'grid-screen': grid,
+        'grid-print': printGrid,
+        'bounds': {'useOutputBounds': False, 'boundsLeft': 5, 'boundsRight': 15,
+                   'boundsTop': 5, 'boundsBottom': 15},
+        'pdf-export': {'useOutputBounds': False, 'gridNumber': True, 'pageSize': 'A4',
+                       'landscape': False, 'leftMargin': 10, 'rightMargin': 10,
+                       'topMargin': 17, 'bottomMargin': 12, 'multibyteFont': ''},
+        'view': {'viewMode': 3},
+    }
+
+
+def make_template(path, width, height, seed=0):
+    metadata = {'title': 'benchmark {}x{}'.format(width, height), 'copyright': ''}
+    with open(path, 'w') as f:
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n')
+        f.write('<foreignObject id="kogin-option" visibility="hidden">{}</foreignObject>\n'.format(
+            json.dumps(make_option(), indent=1)))
+        f.write('<foreignObject id="kogin-data" visibility="hidden">{}</foreignObject>\n'.format(
+            json.dumps(make_data(width, height, seed))))
+        f.write('<foreignObject id="kogin-metadata" visibility="hidden">{}</foreignObject>\n'.format(
+            json.dumps(metadata, indent=1)))
+        f.write('</svg>')
+    return path
+
+
+def timeit(args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL, cwd=dirname(KOGIN))
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times):
+    print('{:<24} min {:8.2f} ms  median {:8.2f} ms'.format(
+        name, min(times) * 1000, statistics.median(times) * 1000))
+
+
+def bench_startup(args, tmpdir):
+    path = args.path or make_template(join(tmpdir, 'small.svg'), 20, 20)
+    python = sys.executable
+    # warm up, writes bytecode cache
+    subprocess.run([python, '-c', 'import kogin'], check=True, cwd=dirname(KOGIN))
+
+    report('interpreter', timeit([python, '-c', 'pass'], args.repeat))
+    report('import kogin', timeit([python, '-c', 'import kogin'], args.repeat))
+    report('kogin --help', timeit([python, KOGIN, '--help'], args.repeat))
+    report('kogin hash', timeit([python, KOGIN, 'hash', path], args.repeat))
+    # uses bytecode cache of the module
+    report('python -m kogin hash', timeit([python, '-m', 'kogin', 'hash', path], args.repeat))
+
+
+def load_kogin():
+    sys.path.insert(0, dirname(KOGIN))
+    import kogin
+    return kogin
+
+
+def bench_encoding(args, tmpdir):
+    kogin = load_kogin()
+    path = args.path or make_template(join(tmpdir, 'large.svg'), 600, 600)
+    paths = {}
+    for name, dataFormat in (('json', kogin.DATA_FORMAT_JSON), ('packed', kogin.DATA_FORMAT_PACKED)):
+        paths[name] = join(tmpdir, '{}.svg'.format(name))
+        with open(path, 'rb') as src, open(paths[name], 'wb') as dst:
+            dst.write(src.read())
+        _, _, size, error = kogin.pack_file(paths[name], dataFormat)
+        if error:
+            print('Error: {}'.format(error))
+            return
+        print('{:<24} file {:10d} bytes  kogin-data {:10d} bytes'.format(
+            name, os.path.getsize(paths[name]), size))
+
+    for name, file_path in paths.items():
+        def load():
+            kogin.Kogin(file_path).getData().flat()
+        report('load ' + name, measure(load, args.repeat))
+
+
+def bench_output(args, tmpdir):
+    kogin = load_kogin()
+    if args.path:
+        paths = kogin.list_files(args.path)
+    else:
+        paths = [make_template(join(tmpdir, 'template-{}.svg'.format(size)), size, size, seed=size)
+                 for size in (20, 60, 200)]
+    total = {}
+    for path in paths:
+        data = kogin.Kogin(path)
+        for forPrinting in (False, True):
+            for name, minify in (('default', False), ('minified', True)):
+                s = kogin.Writer(data, minify=minify).write(forPrinting)
+                key = '{} {}'.format('print' if forPrinting else 'screen', name)
+                total[key] = total.get(key, 0) + len(s.encode('utf-8'))
+                if minify:
+                    # output has to be read back as the same template
+                    out = join(tmpdir, 'output.svg')
+                    with open(out, 'w', encoding='utf-8') as f:
+                        f.write(s)
+                    back = kogin.Kogin(out)
+                    if (back.getData().getData() != data.getData().getData() or
+                            back.getOption().getData() != data.getOption().getData() or
+                            back.getMetadata() != data.getMetadata()):
+                        print('Error: {} is not read back'.format(path))
+
+    print('{} files'.format(len(paths)))
+    for target in ('screen', 'print'):
+        default = total['{} default'.format(target)]
+        minified = total['{} minified'.format(target)]
+        print('{:<24} default {:10d} bytes  minified {:10d} bytes  {:5.1f} %'.format(
+            target, default, minified, minified * 100 / default))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                prog = 'benchmark',
+                description = 'Benchmarks for kogin.py')
+    subparsers = parser.add_subparsers()
+
+    parser_startup = subparsers.add_parser('startup',
+        help='Measures startup time of the command.')
+    parser_startup.add_argument('path', nargs='?',
+        help='Path to kogin file.')
+    parser_startup.add_argument('-r', '--repeat', type=int, default=20)
+    parser_startup.set_defaults(func=bench_startup)
+
+    parser_encoding = subparsers.add_parser('encoding',
+        help='Compares size and load time of JSON and packed kogin-data.')
+    parser_encoding.add_argument('path', nargs='?',
+        help='Path to kogin file.')
+    parser_encoding.add_argument('-r', '--repeat', type=int, default=10)
+    parser_encoding.set_defaults(func=bench_encoding)
+
+    parser_output = subparsers.add_parser('output',
+        help='Compares size of default and minified output of Writer.')
+    parser_output.add_argument('path', nargs='?',
+        help='Path to kogin file or directory.')
+    parser_output.set_defaults(func=bench_output)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return 1
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.func(args, tmpdir)
+
+if __name__ == '__main__':
+    sys.exit(main())
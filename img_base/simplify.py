@@ -1,65 +1,323 @@
 
+import argparse
+import hashlib
+import json
 import os
 import os.path
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 
-def main():
-    main2(sys.argv[1])
+CACHE_NAME = '.simplify-cache.json'
 
-def main2(path):
-    with open(path, "r") as f:
-        s = f.read()
+# number of arguments for each command
+ARGS = {
+    'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4, 'T': 2, 'A': 7, 'Z': 0,
+}
 
-    exp_style = re.compile(r'\n\s*style="[^"]+?"', re.M)
-    exp = re.compile(r'[^i]d="([^"]+?)"', re.M)
-
-    def to_value(v):
-        try:
-            n = int(v, 10)
-            m = str(n)
-            return m
-        except:
-            try:
-                n = float(v)
-                m = "{:.1f}".format(n)
-                if m.endswith('.0'):
-                    p = m[0:-2]
-                    if p == '-0':
-                        return '0'
-                    else:
-                        return p
-                else:
-                    return m
-            except:
-                return None
+NUMBER_EXP = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+SEPARATOR_EXP = re.compile(r'[\s,]*')
 
-    def repl(m):
-        converted = []
-        parts = m.group(1).split(' ')
-        for part in parts:
-            xy = part.split(',')
-            if len(xy) == 2:
-                x = to_value(xy[0])
-                y = to_value(xy[1])
-                if not x is None:
-                    if not y is None:
-                        converted.append("{},{}".format(x, y))
+
+class PathError(Exception):
+    pass
+
+
+def tokenize(d):
+    """ Splits path data into list of (command, [numbers]).
+
+    Implicit repeats of the command are split into their own entries,
+    the coordinates following to the moveto are returned as lineto.
+    """
+    segments = []
+    pos = 0
+    end = len(d)
+    command = None
+    def skip(pos):
+        return SEPARATOR_EXP.match(d, pos).end()
+
+    def number(pos):
+        m = NUMBER_EXP.match(d, pos)
+        if not m:
+            raise PathError('number expected at {}: {}'.format(pos, d[pos:pos + 10]))
+        return float(m.group(0)), m.end()
+
+    def flag(pos):
+        c = d[pos:pos + 1]
+        if c != '0' and c != '1':
+            raise PathError('flag expected at {}'.format(pos))
+        return float(c), pos + 1
+
+    pos = skip(pos)
+    while pos < end:
+        c = d[pos]
+        if c.upper() in ARGS:
+            command = c
+            pos = skip(pos + 1)
+            if command.upper() == 'Z':
+                segments.append((command, []))
+                continue
+        elif command is None or command.upper() == 'Z':
+            raise PathError('command expected at {}'.format(pos))
+        elif command == 'M':
+            command = 'L'
+        elif command == 'm':
+            command = 'l'
+
+        args = []
+        upper = command.upper()
+        for i in range(ARGS[upper]):
+            if upper == 'A' and (i == 3 or i == 4):
+                value, pos = flag(pos)
             else:
-                v = to_value(part)
-                if not v is None:
-                    converted.append(v)
-                else:
-                    converted.append(part)
+                value, pos = number(pos)
+            args.append(value)
+            pos = skip(pos)
+        segments.append((command, args))
+    return segments
+
+
+def to_absolute(segments):
+    """ Converts all segments into absolute coordinates. """
+    converted = []
+    x = y = 0.0
+    startX = startY = 0.0
+    for command, args in segments:
+        upper = command.upper()
+        relative = command != upper
+        if upper == 'Z':
+            x, y = startX, startY
+            converted.append(('Z', []))
+            continue
+        args = list(args)
+        if upper == 'H':
+            if relative:
+                args[0] += x
+            x = args[0]
+        elif upper == 'V':
+            if relative:
+                args[0] += y
+            y = args[0]
+        elif upper == 'A':
+            if relative:
+                args[5] += x
+                args[6] += y
+            x, y = args[5], args[6]
+        else:
+            if relative:
+                for i in range(0, len(args), 2):
+                    args[i] += x
+                    args[i + 1] += y
+            x, y = args[-2], args[-1]
+        if upper == 'M':
+            startX, startY = x, y
+        converted.append((upper, args))
+    return converted
+
+
+class Formatter:
+    def __init__(self, precision):
+        self.precision = precision
+
+    def round(self, value):
+        value = round(value, self.precision)
+        if value == 0:
+            # no negative zero
+            return 0.0
+        return value
+
+    def number(self, value):
+        s = '{:.{}f}'.format(value, self.precision)
+        if '.' in s:
+            s = s.rstrip('0').rstrip('.')
+        if s.startswith('0.'):
+            s = s[1:]
+        elif s.startswith('-0.'):
+            s = '-' + s[2:]
+        elif s == '-0':
+            s = '0'
+        return s
+
+    def numbers(self, values):
+        parts = []
+        previous = ''
+        for value in values:
+            s = self.number(value)
+            if previous and not (s[0] == '-' or (s[0] == '.' and '.' in previous)):
+                parts.append(' ')
+            parts.append(s)
+            previous = s
+        return ''.join(parts)
+
+
+def simplify_path(d, precision=1, relative=True):
+    """ Returns shortened path data. """
+    formatter = Formatter(precision)
+    r = formatter.round
+    x = y = 0.0
+    startX = startY = 0.0
+    output = []
+    lastCommand = None
+    for command, args in to_absolute(tokenize(d)):
+        if command == 'Z':
+            x, y = startX, startY
+            output.append('z')
+            lastCommand = 'z'
+            continue
+
+        args = [r(v) for v in args]
+        if command == 'L' and args[0] == x and args[1] != y:
+            command, args = 'V', [args[1]]
+        elif command == 'L' and args[1] == y and args[0] != x:
+            command, args = 'H', [args[0]]
+
+        rel = list(args)
+        if command == 'H':
+            rel[0] = r(args[0] - x)
+        elif command == 'V':
+            rel[0] = r(args[0] - y)
+        elif command == 'A':
+            rel[5] = r(args[5] - x)
+            rel[6] = r(args[6] - y)
+        else:
+            for i in range(0, len(args), 2):
+                rel[i] = r(args[i] - x)
+                rel[i + 1] = r(args[i + 1] - y)
+
+        if command == 'H':
+            x = args[0]
+        elif command == 'V':
+            y = args[0]
+        else:
+            x, y = args[-2], args[-1]
+        if command == 'M':
+            startX, startY = x, y
+
+        candidates = [join_command(command, formatter.numbers(args), lastCommand)]
+        if relative:
+            candidates.append(join_command(command.lower(), formatter.numbers(rel), lastCommand))
+        lastCommand, s = min(candidates, key=lambda candidate: len(candidate[1]))
+        output.append(s)
+    return ''.join(output)
+
+
+def join_command(command, s, lastCommand):
+    # the command letter can be omitted when it is repeated, except moveto
+    if command == lastCommand and command.upper() != 'M':
+        return (command, s if s[0] == '-' else ' ' + s)
+    return (command, command + s)
+
+
+ATTR_D_EXP = re.compile(r'(?<![\w:-])d="([^"]+?)"', re.M)
+STYLE_EXP = re.compile(r'\n\s*style="[^"]+?"', re.M)
+
+
+def simplify(s, precision=1, relative=True):
+    def repl(m):
+        return 'd="{}"'.format(simplify_path(m.group(1), precision, relative))
+
+    n = ATTR_D_EXP.sub(repl, s)
+    return STYLE_EXP.sub('', n)
+
+
+def content_hash(s, precision, relative):
+    h = hashlib.sha1(s.encode('utf-8'))
+    h.update('{}:{}'.format(precision, relative).encode('ascii'))
+    return h.hexdigest()
+
+
+def process(path, precision=1, relative=True, known=None, dryRun=False):
+    """ Simplifies the file and returns (path, hash of the result, changed, error). """
+    with open(path, 'r') as f:
+        s = f.read()
+    h = content_hash(s, precision, relative)
+    if h == known:
+        return (path, h, False, None)
+    try:
+        n = simplify(s, precision, relative)
+    except PathError as e:
+        return (path, None, False, str(e))
+    changed = n != s
+    if changed and not dryRun:
+        with open(path, 'w') as f:
+            f.write(n)
+    return (path, content_hash(n, precision, relative), changed, None)
+
+
+def _process(args):
+    return process(*args)
+
+
+def load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def list_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.endswith('.svg'))
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                prog = 'simplify',
+                description = 'Shortens path data of SVG icons')
+    parser.add_argument('paths', nargs='*',
+        default=[os.path.dirname(os.path.abspath(__file__))],
+        help='SVG files or directories, directory of this script by default.')
+    parser.add_argument('-p', '--precision', type=int, default=1,
+        help='Number of digits after decimal point.')
+    parser.add_argument('--absolute', action='store_true',
+        help='Do not convert into relative coordinates.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='Number of worker processes.')
+    parser.add_argument('--cache', default=None,
+        help='Path to cache file, {} in the first directory by default.'.format(CACHE_NAME))
+    parser.add_argument('--no-cache', action='store_true',
+        help='Processes all files.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+        help='Only reports files to be changed.')
+    args = parser.parse_args()
+
+    files = list_files(args.paths)
+    cachePath = args.cache
+    if cachePath is None:
+        base = args.paths[0] if os.path.isdir(args.paths[0]) else os.path.dirname(args.paths[0])
+        cachePath = os.path.join(base, CACHE_NAME)
+    cache = {} if args.no_cache else load_cache(cachePath)
+    relative = not args.absolute
+
+    cacheDir = os.path.dirname(os.path.abspath(cachePath))
+    keys = [os.path.relpath(os.path.abspath(path), cacheDir) for path in files]
+    tasks = [(path, args.precision, relative, cache.get(key), args.dry_run)
+             for path, key in zip(files, keys)]
+    with ProcessPoolExecutor(args.jobs) as executor:
+        results = list(executor.map(_process, tasks, chunksize=8))
 
-        r = " d=\"{}\"".format(' '.join(converted))
-        return r
+    status = 0
+    for key, (path, h, changed, error) in zip(keys, results):
+        if error:
+            print('Error: {}: {}'.format(path, error))
+            status = 1
+        elif changed:
+            print(path)
+        if h and not args.dry_run:
+            cache[key] = h
 
-    n = exp.sub(repl, s)
-    n = exp_style.sub('', n)
-    with open(path, "w") as f:
-        f.write(n)
+    if not args.dry_run and not args.no_cache:
+        with open(cachePath, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+    return status
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,19 +1,28 @@
 
-import xml.etree.ElementTree as ET
+# Modules only required by some commands are imported where they are used
+# to keep startup time short.
+import os
+import re
+import sys
 import json
 import hashlib
-import os
 from os.path import join
 from operator import itemgetter
-import argparse
-from math import floor
-from xml.sax.saxutils import escape
+import heapq
+from math import floor, ceil
 
 viewModeLineGrain = 0;
 viewModeFillGrain = 1;
 viewModeOverGrain = 2;
 viewModeOverWarp = 3;
 
+def escape(data):
+    # same as xml.sax.saxutils.escape which imports urllib
+    return data.replace('&', '&amp;').replace('>', '&gt;').replace('<', '&lt;')
+
+def unescape(data):
+    return data.replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"').replace('&amp;', '&')
+
 class Point:
     def __init__(self, x, y):
         self.x = x
@@ -106,7 +115,7 @@ class OverGrain(PositionCalculator):
         point1 = self.gridToGridVertCenterPoint(x, y)
         if pixelCorrection:
             point1.y += 0.5
-        point2 = self.gridToGridVertCenterPoint(x, + length, y)
+        point2 = self.gridToGridVertCenterPoint(x + length, y)
         point2.y = point1.y
         point1.x -= self.offset
         point2.x += self.offset + self.gridLineWidth
@@ -135,16 +144,52 @@ PositionCalculator.CLASSES = {
     viewModeOverWarp: OverWarp,
 }
 
+VIEW_MODES = {cls.__name__: viewMode for viewMode, cls in PositionCalculator.CLASSES.items()}
+
+def format_number(v):
+    """ Returns the shortest text of the number which reads back to the same value. """
+    if isinstance(v, str):
+        v = float(v)
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    s = repr(v)
+    if s.startswith('0.'):
+        s = s[1:]
+    elif s.startswith('-0.'):
+        s = '-' + s[2:]
+    return s
+
+PATH_TOKEN_EXP = r'[A-Za-z]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+
+def compact_path(d):
+    """ Removes separators and shortens numbers of path data. """
+    parts = []
+    previous = ''
+    for token in re.findall(PATH_TOKEN_EXP, d):
+        if token.isalpha():
+            parts.append(token)
+            previous = token
+            continue
+        s = format_number(token)
+        # separator is required only between numbers
+        if not previous.isalpha() and not (s[0] == '-' or (s[0] == '.' and '.' in previous)):
+            parts.append(' ')
+        parts.append(s)
+        previous = s
+    return ''.join(parts)
+
 class SVGDOMElement:
     def __init__(self, name):
         self.tagName = name
         self.attributes = {}
         self.children = []
+        self.parentNode = None
 
     def setAttribute(self, name, value):
         self.attributes[name] = value
 
     def appendChild(self, child):
+        child.parentNode = self
         self.children.append(child)
 
     def _writeAttribute(self):
@@ -176,6 +221,16 @@ class SVGDOMElement:
         return newl.join(lines)
 
 
+class SVGDOMFragment:
+    """ Serialized element written as is. """
+    def __init__(self, text):
+        self.text = text
+        self.parentNode = None
+
+    def write(self, indent='', newl=''):
+        return self.text
+
+
 class SVGDOM(SVGDOMElement):
     def __init__(self, namespace, name):
         super().__init__(name)
@@ -185,44 +240,92 @@ class SVGDOM(SVGDOMElement):
         return SVGDOMElement(name)
 
 
+class FragmentCache:
+    """ Serialized fragments of images with least recently used eviction. """
+    def __init__(self, size):
+        self.size = size
+        self._items = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """ Returns the cached value for key, or the value built and cached. """
+        try:
+            value = self._items.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = build()
+            self.misses += 1
+            if len(self._items) >= self.size:
+                # dict keeps insertion order, the first is least recently used
+                del self._items[next(iter(self._items))]
+        self._items[key] = value
+        return value
+
+    def clear(self):
+        self._items.clear()
+
+# options the grid and numbering depend on, with size and output target
+GRID_OPTIONS = (
+    'gridWidth', 'gridHeight', 'gridLineWidth', 'gridLineColor', 'gridMajorLineColor',
+    'showGridFrame', 'showGridMajorLine', 'gridMajorLineFrequency',
+    'gridMajorHoriOffset', 'gridMajorVertOffset',
+)
+NUMBERING_OPTIONS = (
+    'gridWidth', 'gridHeight', 'gridMajorLineColor', 'gridMajorLineFrequency',
+    'leftMargin', 'topMargin',
+)
+FRAGMENT_CACHE_SIZE = 32
+FRAGMENT_CACHE = FragmentCache(FRAGMENT_CACHE_SIZE)
+
+LAYER_CACHE_VERSION = 1
+
+class LayerCache:
+    """ Serialized layers stored in the directory by hash of their content. """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # other processes never see partially written entry
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(temp, path)
+
 class Writer:
-    def __init__(self, kogin):
+    def __init__(self, kogin, tiling=False, minify=False, layerCache=None):
         self.kogin = kogin
-
-    def write(self, forPrinting=False):
-        self.op = self.readOptions(self.kogin.getOption(), forPrinting)
+        self.tiling = tiling
+        # shortest numbers, shared attributes on groups and no redundant attributes
+        self.minify = minify
+        # LayerCache to reuse serialized layers of unchanged content
+        self.layerCache = layerCache
+        self._flat = None
+
+    def write(self, forPrinting=False, viewMode=None):
+        self._setup(forPrinting, viewMode)
         op = self.op
-        viewMode = op.viewMode
-        if viewMode == viewModeLineGrain:
-            op.strokeWidth = op.lineGrainLineWidth
-        elif viewMode == viewModeFillGrain:
-            op.strokeWidth = op.gridHeight - op.gridLineWidth
-        elif viewMode == viewModeOverWarp:
-            op.strokeWidth = op.overWarpLineWidth
-        elif viewMode == viewModeOverGrain:
-            op.strokeWidth = op.overGrainLineWidth
-
-        op.halfStrokeWidth = op.strokeWidth / 2
-        op.posCalc = PositionCalculator.choose(op)
-        op.lineCap = op.posCalc.strokeCap
-
-        self.bboxRect = self._bboxToRectangle(self.kogin.data.bbox())
-        self.gridRect = self._getGridBoundingBox(self.bboxRect)
-        offsetX, offsetY, width, height = self._gridTotalSize(self.gridRect)
-        self.op.offsetX = offsetX
-        self.op.offsetY = offsetY
-        self.op.width = width
-        self.op.height = height
-        if self.op.forPrinting:
-            # font size in pt
-            fontSize = 9
-            self.horiMargin = 10
-            self.vertMargin = 10
-            self.numberingSize = fontSize * 25.4 / 72
-        else:
-            self.horiMargin = 30
-            self.vertMargin = 30
-            self.numberingSize = 12
+        offsetX = op.offsetX
+        offsetY = op.offsetY
+        width = op.width
+        height = op.height
 
         self.dom = self._createDom(offsetX, offsetY, width, height, op.useXLink)
         parent = self.dom
@@ -247,7 +350,7 @@ class Writer:
 
         # write clipPath for output bounds
         if self.op.useOutputBounds:
-            self._writeClipPath(dom)
+            self._writeClipPath(self.dom)
 
         # over grid
         if self.op.showGrid and self.op.overGrid:
@@ -270,64 +373,158 @@ class Writer:
             self._writeData(self.dom)
             self._writeMetadata(self.dom)
 
-        return self.dom.write(newl='\n')
+        return self.dom.write(newl='' if self.minify else '\n')
+
+    def writeVariants(self, variants):
+        """ Writes images for list of (viewMode, forPrinting).
+
+        Parsed data, layer tree and bounding box are shared between variants,
+        only options depending on the variant are recalculated.
+        """
+        return [self.write(forPrinting, viewMode) for viewMode, forPrinting in variants]
+
+    def _setup(self, forPrinting, viewMode=None, useOutputBounds=None):
+        self._prepare()
+        self.op = self.readOptions(self.kogin.getOption(), forPrinting, viewMode)
+        op = self.op
+        if useOutputBounds is not None:
+            op.useOutputBounds = useOutputBounds
+        viewMode = op.viewMode
+        if viewMode == viewModeLineGrain:
+            op.strokeWidth = op.lineGrainLineWidth
+        elif viewMode == viewModeFillGrain:
+            op.strokeWidth = op.gridHeight - op.gridLineWidth
+        elif viewMode == viewModeOverWarp:
+            op.strokeWidth = op.overWarpLineWidth
+        elif viewMode == viewModeOverGrain:
+            op.strokeWidth = op.overGrainLineWidth
+
+        op.halfStrokeWidth = op.strokeWidth / 2
+        op.posCalc = PositionCalculator.choose(op)
+        op.lineCap = op.posCalc.strokeCap
+
+        self.gridRect = self._getGridBoundingBox(self.bboxRect)
+        offsetX, offsetY, width, height = self._gridTotalSize(self.gridRect)
+        op.offsetX = offsetX
+        op.offsetY = offsetY
+        op.width = width
+        op.height = height
+        if op.forPrinting:
+            # font size in pt
+            fontSize = 9
+            self.horiMargin = 10
+            self.vertMargin = 10
+            self.numberingSize = fontSize * 25.4 / 72
+        else:
+            self.horiMargin = 30
+            self.vertMargin = 30
+            self.numberingSize = 12
+
+    def _prepare(self):
+        # independent from view mode and output target
+        if self._flat is not None:
+            return
+        data = self.kogin.getData()
+        self.bboxRect = self._bboxToRectangle(data.bbox())
+        self._flat = data.flat()
+        self._hrefs = ['#{}'.format(ref) for ref in self._flat.refs]
+        self._stitchDefs = []
+        for d in data.defs().get('single', []):
+            length = int(d.get('length', 0), 10)
+            if length <= 0:
+                continue
+            for color in d.get('colors', []):
+                id = '{}-{}'.format(length, color[1:])
+                self._stitchDefs.append((id, length, color))
+        self._dataText = {}
+        self._tilings = {}
+
+    def _getTiling(self, layer):
+        tiling = self._tilings.get(layer)
+        if tiling is None:
+            flat = self._flat
+            stitches = []
+            for run in flat.runs:
+                if flat.groupLayer[run[0]] == layer:
+                    _, r, start, end = run
+                    stitches.extend(zip(flat.xs[r][start:end], flat.ys[r][start:end], [r] * (end - start)))
+            tiling = Tiling(stitches)
+            self._tilings[layer] = tiling
+        return tiling
+
+    def _num(self, v):
+        return format_number(v) if self.minify else str(v)
+
+    def _useXLink(self):
+        # href is enough for SVG2 renderers
+        return self.op.useXLink and not self.minify
 
     def _createDom(self, offsetX, offsetY, width, height, useXLink):
         unit = 'mm' if self.op.forPrinting else ''
         dom = SVGDOM('http://www.w3.org/2000/svg', 'svg')
         dom.setAttribute('xmlns', 'http://www.w3.org/2000/svg')
-        if useXLink:
+        if self._useXLink():
             dom.setAttribute('xmlns:xlink', 'http://www.w3.org/1999/xlink')
         imageWidth = width + self.horiMargin * 2 if self.op.gridNumber else width
         imageHeight = height + self.vertMargin * 2 if self.op.gridNumber else height
-        dom.setAttribute('viewBox', '0 0 {} {}'.format(imageWidth, imageHeight))
-        dom.setAttribute('width', '{}{}'.format(imageWidth, unit))
-        dom.setAttribute('height', '{}{}'.format(imageHeight, unit))
+        num = self._num
+        dom.setAttribute('viewBox', '0 0 {} {}'.format(num(imageWidth), num(imageHeight)))
+        dom.setAttribute('width', '{}{}'.format(num(imageWidth), unit))
+        dom.setAttribute('height', '{}{}'.format(num(imageHeight), unit))
         return dom
 
     def _addBackground(self, parent):
         rect = self.dom.createElement('rect')
         rect.setAttribute('id', 'background')
-        rect.setAttribute('x', '0')
-        rect.setAttribute('y', '0')
-        rect.setAttribute('width', str(self.op.width + (self.horiMargin * 2 if self.op.gridNumber else 0)))
-        rect.setAttribute('height', str(self.op.height + (self.vertMargin * 2 if self.op.gridNumber else 0)))
+        if not self.minify:
+            rect.setAttribute('x', '0')
+            rect.setAttribute('y', '0')
+        rect.setAttribute('width', self._num(self.op.width + (self.horiMargin * 2 if self.op.gridNumber else 0)))
+        rect.setAttribute('height', self._num(self.op.height + (self.vertMargin * 2 if self.op.gridNumber else 0)))
         rect.setAttribute('fill', self.op.backgroundColor)
         parent.appendChild(rect)
 
     def _writeElements(self, parent, offsetX, offsetY, width, height):
         defs = self.dom.createElement('defs')
+        self._defs = defs
 
         # layers
         g = self.dom.createElement('g')
         g.setAttribute('id', 'layers')
         if self.op.useOutputBounds:
             g.setAttribute('clip-path', 'url(#{})'.format('clip-path'))
-        data = self.kogin.getData().data()
-        for layer in data:
-            self._writeGroup(g, layer)
+        if self.minify:
+            # inherited by the lines of the uses
+            g.setAttribute('stroke-width', self._num(self.op.strokeWidth))
+            g.setAttribute('stroke-linecap', self.op.lineCap)
+            if self.op.monochrome:
+                g.setAttribute('stroke', '#000000')
+        for layer in self._flat.layers:
+            if self.layerCache is not None:
+                self._writeCachedLayer(g, layer)
+            else:
+                self._writeGroup(g, layer)
 
         self.dom.appendChild(g)
 
-        for d in self.kogin.getData().defs().get('single', []):
-            length = int(d.get('length', 0), 10)
-            if length <= 0:
-                continue
-            for color in d.get('colors', []):
-                id = '{}-{}'.format(length, color[1:])
-                self._addDef(defs, id, length, color)
+        for id, length, color in self._stitchDefs:
+            self._addDef(defs, id, length, color)
 
         self.dom.appendChild(defs)
 
-    def _writeGroup(self, parent, group):
+    def _writeGroup(self, parent, index):
         g = self.dom.createElement('g')
+        flat = self._flat
+        group = flat.groups[index]
 
         if group.get('layer', False):
             g.setAttribute('id', group.get('name', 'group'))
             if not group.get('visible', True):
                 g.setAttribute('visibility', 'hidden')
 
-        useXLink = self.op.useXLink
+        useXLink = self._useXLink()
+        minify = self.minify
+        num = self._num
         offsetX = self.op.offsetX
         offsetY = self.op.offsetY
         strokeWidth = self.op.strokeWidth
@@ -339,39 +536,147 @@ class Writer:
         if group.get('x', 0) != 0 or group.get('y', 0) != 0:
             x = group.get('x', 0) * gridWidth
             y = group.get('y', 0) * gridHeight
-            g.setAttribute('transform', 'translate({} {})'.format(x, y))
+            g.setAttribute('transform', 'translate({} {})'.format(num(x), num(y)))
+        elif minify and not g.attributes:
+            # group without attributes is redundant
+            g = parent
+
+        groupX = flat.groupX[index]
+        groupY = flat.groupY[index]
+        if self.tiling and flat.groupParent[index] < 0 and \
+                self._writeTiles(g, flat.groupLayer[index], groupX, groupY):
+            if g is not parent:
+                parent.appendChild(g)
+            return
 
-        children = group.get('children', [])
-        for child in children:
-            ref = child.get('ref')
-            if ref:
-                coords = child.get('coords', [])
-                for coord in coords:
-                    x = floor(coord[0] * gridWidth)
-                    y = floor(coord[1] * gridHeight)
-                    use = self.dom.createElement('use')
-                    if useXLink:
-                        use.setAttribute('xlink:href', '#{}'.format(ref))
-                    use.setAttribute('href', '#{}'.format(ref)) # SVG2
-                    use.setAttribute('x', str(x - offsetX))
-                    use.setAttribute('y', str(y - offsetY))
-                    g.appendChild(use)
-            else:
+        for kind, child in flat.groupChildren[index]:
+            if kind == NODE_GROUP:
                 self._writeGroup(g, child)
+                continue
+            run = flat.runs[child]
+            href = self._hrefs[run[1]]
+            for cx, cy in flat.runCoords(run):
+                x = floor((cx - groupX) * gridWidth)
+                y = floor((cy - groupY) * gridHeight)
+                use = self.dom.createElement('use')
+                if useXLink:
+                    use.setAttribute('xlink:href', href)
+                use.setAttribute('href', href) # SVG2
+                x -= offsetX
+                y -= offsetY
+                if x or not minify:
+                    use.setAttribute('x', num(x))
+                if y or not minify:
+                    use.setAttribute('y', num(y))
+                g.appendChild(use)
+
+        if g is not parent:
+            parent.appendChild(g)
 
-        parent.appendChild(g)
+    def _layerKey(self, index):
+        # everything _writeGroup depends on, lines of stitches are in defs
+        op = self.op
+        flat = self._flat
+        key = [LAYER_CACHE_VERSION, flat.groupLayer[index], op.offsetX, op.offsetY,
+               op.gridWidth, op.gridHeight, op.forPrinting, self._useXLink(), self.minify, self.tiling]
+        h = hashlib.sha1(json.dumps(key).encode('utf-8'))
+        h.update(json.dumps(flat.groups[index], sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        return h.hexdigest()
+
+    def _writeCachedLayer(self, parent, index):
+        """ Writes the layer from the cache, or writes and caches it. """
+        key = self._layerKey(index)
+        entry = self.layerCache.get(key)
+        if entry is not None:
+            for text in entry['layer']:
+                parent.appendChild(SVGDOMFragment(text))
+            for text in entry['defs']:
+                self._defs.appendChild(SVGDOMFragment(text))
+            return
+
+        # the layer is unwrapped when minified, and tiles add motifs to defs
+        g = self.dom.createElement('g')
+        defsCount = len(self._defs.children)
+        self._writeGroup(g, index)
+        newl = '' if self.minify else '\n'
+        self.layerCache.put(key, {
+            'layer': [child.write('', newl) for child in g.children],
+            'defs': [child.write('', newl) for child in self._defs.children[defsCount:]],
+        })
+        for child in g.children:
+            parent.appendChild(child)
+
+    def _writeTiles(self, g, layer, groupX, groupY):
+        """ Writes repeated part of the layer as uses of a motif.
+
+        Returns False if the layer does not repeat, or positions of tiles are
+        not on pixels, where the output would differ from expanded stitches.
+        """
+        tiling = self._getTiling(layer)
+        if not tiling.found():
+            return False
+        gridWidth = self.op.gridWidth
+        gridHeight = self.op.gridHeight
+        positions = []
+        for tx, ty in tiling.tiles:
+            x = (tx - groupX) * gridWidth
+            y = (ty - groupY) * gridHeight
+            if not (float(x).is_integer() and float(y).is_integer()):
+                return False
+            positions.append((int(x), int(y)))
+
+        useXLink = self._useXLink()
+        minify = self.minify
+        num = self._num
+        offsetX = self.op.offsetX
+        offsetY = self.op.offsetY
+        hrefs = self._hrefs
+
+        def addUse(parent, href, x, y):
+            use = self.dom.createElement('use')
+            if useXLink:
+                use.setAttribute('xlink:href', href)
+            use.setAttribute('href', href) # SVG2
+            if x or not minify:
+                use.setAttribute('x', num(x))
+            if y or not minify:
+                use.setAttribute('y', num(y))
+            parent.appendChild(use)
+
+        id = 'tile-{}'.format(layer)
+        motif = self.dom.createElement('g')
+        motif.setAttribute('id', id)
+        for lx, ly, r in tiling.motif:
+            addUse(motif, hrefs[r], floor(lx * gridWidth), floor(ly * gridHeight))
+        self._defs.appendChild(motif)
+
+        href = '#' + id
+        for x, y in positions:
+            addUse(g, href, x - offsetX, y - offsetY)
+
+        if tiling.residue:
+            residue = self.dom.createElement('g')
+            residue.setAttribute('class', 'residue')
+            for cx, cy, r in tiling.residue:
+                addUse(residue, hrefs[r], floor((cx - groupX) * gridWidth) - offsetX,
+                       floor((cy - groupY) * gridHeight) - offsetY)
+            g.appendChild(residue)
+        return True
 
     def _addLine(self, parent, id, x1, y1, x2, y2, stroke, strokeWidth):
         line = self.dom.createElement('line')
         if id:
             line.setAttribute('id', id)
-        line.setAttribute('x1', str(x1))
-        line.setAttribute('y1', str(y1))
-        line.setAttribute('x2', str(x2))
-        line.setAttribute('y2', str(y2))
-        line.setAttribute('stroke', stroke)
-        line.setAttribute('stroke-width', str(strokeWidth))
-        line.setAttribute('stroke-linecap', self.op.lineCap)
+        minify = self.minify
+        for name, value in (('x1', x1), ('y1', y1), ('x2', x2), ('y2', y2)):
+            if value or not minify:
+                line.setAttribute(name, self._num(value))
+        if not (minify and self.op.monochrome):
+            line.setAttribute('stroke', stroke)
+        if not minify:
+            # set to layers when minified
+            line.setAttribute('stroke-width', str(strokeWidth))
+            line.setAttribute('stroke-linecap', self.op.lineCap)
         parent.appendChild(line)
 
     def _addDef(self, parent, id, length, color):
@@ -391,10 +696,10 @@ class Writer:
         obj.setAttribute('id', 'clip-path')
         g.appendChild(obj)
         rect = self.dom.createElement('rect')
-        rect.setAttribute('x', str(x))
-        rect.setAttribute('y', str(y))
-        rect.setAttribute('width', str(width))
-        rect.setAttribute('height', str(height))
+        rect.setAttribute('x', self._num(x))
+        rect.setAttribute('y', self._num(y))
+        rect.setAttribute('width', self._num(width))
+        rect.setAttribute('height', self._num(height))
         obj.appendChild(rect)
         parent.appendChild(g)
 
@@ -409,8 +714,8 @@ class Writer:
 
     def _writeCopyright(self, parent):
         text = self.dom.createElement('text')
-        text.setAttribute('x', str(self.op.width - 5))
-        text.setAttribute('y', str(self.op.height - 5))
+        text.setAttribute('x', self._num(self.op.width - 5))
+        text.setAttribute('y', self._num(self.op.height - 5))
         text.setAttribute('font-size', '9')
         text.setAttribute('text-anchor', 'end')
         text.setAttribute('fill', '#000000')
@@ -418,17 +723,39 @@ class Writer:
         parent.appendChild(text)
 
     def _writeGridNumbering(self, parent):
+        op = self.op
+        key = ('numbering', op.forPrinting, self.minify, op.width, op.height,
+               self.horiMargin, self.vertMargin, self.numberingSize) + \
+            tuple(getattr(op, name) for name in NUMBERING_OPTIONS)
+        parent.appendChild(self._cachedFragment(key, self._createGridNumbering))
+
+    def _writeGridByPath(self, dom, width, height):
+        op = self.op
+        key = ('grid', op.forPrinting, self.minify, width, height) + \
+            tuple(getattr(op, name) for name in GRID_OPTIONS)
+        fragment = self._cachedFragment(key, lambda: self._createGrid(width, height))
+        if fragment is not None:
+            dom.appendChild(fragment)
+
+    def _cachedFragment(self, key, create):
+        """ Returns element serialized by create, shared between files with the same key. """
+        def build():
+            element = create()
+            return None if element is None else element.write('', '' if self.minify else '\n')
+        text = FRAGMENT_CACHE.get(key, build)
+        return None if text is None else SVGDOMFragment(text)
+
+    def _createGridNumbering(self):
         forPrinting = self.op.forPrinting
         margin = 2 if forPrinting else 5
         color, alpha = self._convertColor(self.op.gridMajorLineColor)
 
         g = self.dom.createElement('g')
         g.setAttribute('id', 'numbering')
-        g.setAttribute('font-size', '{}{}'.format(self.numberingSize, ('pt' if forPrinting else 'px')))
+        g.setAttribute('font-size', '{}{}'.format(self._num(self.numberingSize), ('pt' if forPrinting else 'px')))
         g.setAttribute('fill', color)
-        if alpha:
-            g.setAttribute('fill-opacity', alpha)
-        parent.appendChild(g)
+        if alpha and not (self.minify and float(alpha) == 1):
+            g.setAttribute('fill-opacity', self._num(alpha))
 
         def createNumbering(parent, id, anchor):
             numbers = self.dom.createElement('g')
@@ -439,8 +766,8 @@ class Writer:
 
         def createText(parent, x, y, label):
             text = self.dom.createElement('text')
-            text.setAttribute('x', '{:.2f}'.format(x) if forPrinting else str(x))
-            text.setAttribute('y', '{:.2f}'.format(y) if forPrinting else str(y))
+            text.setAttribute('x', self._num('{:.2f}'.format(x) if forPrinting else x))
+            text.setAttribute('y', self._num('{:.2f}'.format(y) if forPrinting else y))
             text.textContent = label
             parent.appendChild(text)
             return text
@@ -450,7 +777,7 @@ class Writer:
         gridWidth = self.op.gridWidth
         totalHeight = self.op.height + gridHeight
 
-        startY = self.vertmargin + self.op.topMargin * gridHeight + gridHeight -\
+        startY = self.vertMargin + self.op.topMargin * gridHeight + gridHeight -\
             (gridHeight / 2 - self.numberingSize / 2) / 2
         leftX = self.horiMargin - margin - (1 if forPrinting else 0)
         rightX = self.horiMargin + self.op.width + margin
@@ -463,8 +790,8 @@ class Writer:
         y = startY
         while y < totalHeight:
             label = str(number)
-            createText(leftNumbering, leftX, y, label, 'end')
-            createText(rightNumbering, rightX, y, label, 'start')
+            createText(leftNumbering, leftX, y, label)
+            createText(rightNumbering, rightX, y, label)
 
             if number != 1:
                 number += majorFrequency
@@ -495,13 +822,14 @@ class Writer:
             else:
                 number += majorFrequency - 1
                 x += (majorFrequency - 1) * gridWidth
+        return g
 
-    def _writeGridByPath(self, dom, width, height):
+    def _createGrid(self, width, height):
         gridWidth = self.op.gridWidth
         gridHeight = self.op.gridHeight
 
         if gridWidth <= 0 or gridHeight <= 0 or width <= 0 or height <= 0:
-            return
+            return None
 
         # for printing purpose
         gridLineWidth = self.op.gridLineWidth
@@ -514,19 +842,24 @@ class Writer:
         cor = 0 if self.op.forPrinting else 0#.5
         gridStart = gridLineWidth / 2
 
+        minify = self.minify
+
         def createPath(id, d, stroke, strokeWidth, major=False):
             path = self.dom.createElement('path')
             path.setAttribute('id', id)
             rgb, alpha = self._convertColor(stroke)
             path.setAttribute('stroke', rgb)
-            if alpha:
-                path.setAttribute('opacity', str(alpha))
-            path.setAttribute('stroke-width', str(strokeWidth))
-            path.setAttribute('d', d)
+            if alpha and not (minify and float(alpha) == 1):
+                path.setAttribute('opacity', self._num(alpha))
+            if not minify:
+                path.setAttribute('stroke-width', str(strokeWidth))
+            path.setAttribute('d', compact_path(d) if minify else d)
             return path
 
         g = self.dom.createElement('g')
         g.setAttribute('id', 'grid')
+        if minify:
+            g.setAttribute('stroke-width', self._num(gridLineWidth))
 
         vd = []
         vd.append('M {},{}'.format(gridStart + cor, gridStart + cor))
@@ -568,7 +901,7 @@ class Writer:
         if self.op.showGridMajorLine and self.op.gridMajorLineFrequency > 0:
             horiMajorMoveDistance = gridWidth * self.op.gridMajorLineFrequency
             if horiMajorMoveDistance <= 0:
-                return
+                return None
             horiMajorStart = gridStart + gridWidth * self.op.gridMajorHoriOffset + cor
             vmd = []
             vmd.append('M {},{}'.format(horiMajorStart, gridStart + cor))
@@ -585,7 +918,7 @@ class Writer:
 
             vertMajorMoveDistance = gridHeight * self.op.gridMajorLineFrequency
             if vertMajorMoveDistance <= 0:
-                return
+                return None
             vertMajorStart = gridStart + gridHeight * self.op.gridMajorVertOffset + cor
             hmd = []
             hmd.append('M {},{}'.format(gridStart + cor, vertMajorStart))
@@ -600,29 +933,42 @@ class Writer:
             hmpath = createPath('grid-hori-major-lines', ' '.join(hmd), gridMajorLineColor, gridLineWidth, True)
             g.appendChild(hmpath)
 
-        dom.appendChild(g)
+        return g
 
     def _writeOption(self, dom):
         obj = self.dom.createElement('foreignObject')
         obj.setAttribute('id', 'kogin-option')
         obj.setAttribute('visibility', 'hidden')
-        obj.textContent = json.dumps(self.kogin.getOption().getData())
+        obj.textContent = self._dumps('option', lambda: self.kogin.getOption().getData())
         self.dom.appendChild(obj)
 
     def _writeData(self, dom):
         obj = self.dom.createElement('foreignObject')
         obj.setAttribute('id', 'kogin-data')
         obj.setAttribute('visibility', 'hidden')
-        obj.textContent = json.dumps(self.kogin.getData().getData())
+        dataFormat = self.kogin.getOption().getData().get(DATA_FORMAT_KEY, DATA_FORMAT_JSON)
+        obj.textContent = self._dumps('data', lambda: self.kogin.getData().encoded(dataFormat))
         self.dom.appendChild(obj)
 
     def _writeMetadata(self, dom):
         obj = self.dom.createElement('foreignObject')
         obj.setAttribute('id', 'kogin-metadata')
         obj.setAttribute('visibility', 'hidden')
-        obj.textContent = json.dumps(self.kogin.getMetadata())
+        obj.textContent = self._dumps('metadata', lambda: self.kogin.getMetadata())
         self.dom.appendChild(obj)
 
+    def _dumps(self, key, getValue):
+        # same content for all variants, the value is only made once
+        text = self._dataText.get(key)
+        if text is None:
+            value = getValue()
+            if self.minify:
+                text = json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+            else:
+                text = json.dumps(value)
+            self._dataText[key] = text
+        return text
+
     def _convertColor(self, color):
         if len(color):
             rgb = color[0:7]
@@ -663,7 +1009,7 @@ class Writer:
     def _bboxToRectangle(self, bbox):
         return Rectangle(bbox[0], bbox[1], bbox[2], bbox[3])
 
-    def readOptions(self, option, forPrinting):
+    def readOptions(self, option, forPrinting, viewMode=None):
         class Op:
             def __init__(self):
                 pass
@@ -692,7 +1038,7 @@ class Writer:
             'viewModeFillGrain': viewModeFillGrain,
             'viewModeOverGrain': viewModeOverGrain,
             'viewModeOverWarp': viewModeOverWarp,
-            'viewMode': option.view()['viewMode']
+            'viewMode': option.view()['viewMode'] if viewMode is None else viewMode
         })
         if forPrinting:
             op.merge(option.outputPrint())
@@ -707,12 +1053,577 @@ class Writer:
             op.numberingColor = op.gridMajorLineColor
         return op
 
+# width of characters in 1/1000 of font size, from space to tilde
+HELVETICA_WIDTHS = (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+)
+
+def pdf_text_width(s, size):
+    width = 0
+    for c in s:
+        code = ord(c)
+        width += HELVETICA_WIDTHS[code - 32] if 32 <= code <= 126 else 556
+    return width * size / 1000
+
+def pdf_string(s):
+    # standard fonts can show only WinAnsi characters
+    s = s.encode('cp1252', 'replace').decode('latin-1')
+    return '(' + s.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+def pdf_number(v):
+    s = '{:.3f}'.format(v).rstrip('0').rstrip('.')
+    return '0' if s == '-0' else s
+
+
+class PDFDocument:
+    """ Minimal PDF writer.
+
+    Objects are written to the file when they are added, only their offsets
+    are kept until the cross reference table is written by close().
+    """
+    def __init__(self, f):
+        self.f = f
+        self.offsets = [None]
+        self.pages = []
+        f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self.pagesRef = self.reserve()
+
+    def reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def addObject(self, body, ref=None):
+        if ref is None:
+            ref = self.reserve()
+        self.offsets[ref] = self.f.tell()
+        self.f.write('{} 0 obj\n'.format(ref).encode('ascii'))
+        self.f.write(body.encode('latin-1') if isinstance(body, str) else body)
+        self.f.write(b'\nendobj\n')
+        return ref
+
+    def addStream(self, entries, data, ref=None):
+        import zlib
+        data = zlib.compress(data)
+        body = '<< {} /Filter /FlateDecode /Length {} >>\nstream\n'.format(entries, len(data))
+        return self.addObject(body.encode('latin-1') + data + b'\nendstream', ref)
+
+    def addPage(self, width, height, content, resources):
+        contentRef = self.addStream('', content.encode('latin-1'))
+        ref = self.addObject('<< /Type /Page /Parent {} 0 R /MediaBox [0 0 {} {}] '
+                             '/Resources {} 0 R /Contents {} 0 R >>'.format(
+                                 self.pagesRef, pdf_number(width), pdf_number(height),
+                                 resources, contentRef))
+        self.pages.append(ref)
+        return ref
+
+    def close(self, info=None):
+        self.addObject('<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+            ' '.join('{} 0 R'.format(ref) for ref in self.pages), len(self.pages)), self.pagesRef)
+        catalog = self.addObject('<< /Type /Catalog /Pages {} 0 R >>'.format(self.pagesRef))
+        infoRef = None
+        if info:
+            infoRef = self.addObject('<< {} >>'.format(' '.join(
+                '/{} {}'.format(key, pdf_string(value)) for key, value in info.items())))
+
+        xref = self.f.tell()
+        lines = ['xref', '0 {}'.format(len(self.offsets)), '0000000000 65535 f ']
+        for offset in self.offsets[1:]:
+            lines.append('{:010d} 00000 n '.format(offset))
+        trailer = '<< /Size {} /Root {} 0 R'.format(len(self.offsets), catalog)
+        if infoRef:
+            trailer += ' /Info {} 0 R'.format(infoRef)
+        lines.extend(['trailer', trailer + ' >>', 'startxref', str(xref), '%%EOF', ''])
+        self.f.write('\n'.join(lines).encode('latin-1'))
+
+
+class PDFExport(Writer):
+    """ Writes pattern into PDF for printing, split into pages if required. """
+    # in pt
+    PAGE_SIZES = {
+        'A3': (841.89, 1190.55),
+        'A4': (595.28, 841.89),
+        'A5': (419.53, 595.28),
+        'B4': (708.66, 1000.63),
+        'B5': (498.9, 708.66),
+        'Letter': (612.0, 792.0),
+        'Legal': (612.0, 1008.0),
+    }
+
+    def __init__(self, kogin, viewMode=None):
+        super().__init__(kogin)
+        self.options = kogin.getOption().pdfExport()
+        self._setup(True, viewMode, self.options.get('useOutputBounds', False))
+        self.originX = self.gridRect.x
+        self.originY = self.gridRect.y
+
+    def mmToPt(self, v):
+        return v * 72 / 25.4
+
+    def getPageSize(self):
+        width, height = self.PAGE_SIZES.get(self.options.get('pageSize', 'A4'), self.PAGE_SIZES['A4'])
+        if self.options.get('landscape', False):
+            return (height, width)
+        return (width, height)
+
+    def getContentSize(self):
+        pageWidth, pageHeight = self.getPageSize()
+        return (
+            pageWidth - self.mmToPt(self.options['leftMargin']) - self.mmToPt(self.options['rightMargin']),
+            pageHeight - self.mmToPt(self.options['topMargin']) - self.mmToPt(self.options['bottomMargin']),
+        )
+
+    def getContentGridSize(self):
+        """ Number of grid cells in a page. """
+        contentWidth, contentHeight = self.getContentSize()
+        return (
+            floor(contentWidth / self.mmToPt(self.op.gridWidth)),
+            floor(contentHeight / self.mmToPt(self.op.gridHeight)),
+        )
+
+    def getCountPages(self):
+        contentPageWidth, contentPageHeight = self.getContentGridSize()
+        if contentPageWidth <= 0 or contentPageHeight <= 0:
+            return (0, 0)
+        return (
+            ceil(self.gridRect.width / contentPageWidth),
+            ceil(self.gridRect.height / contentPageHeight),
+        )
+
+    def getPageGridSize(self, pageRow, pageColumn):
+        """ Number of grid cells shown in the page, the last ones take the rest. """
+        width = self.contentPageWidth if pageColumn != self.pageColumns - 1 else \
+            (self.gridRect.width % self.contentPageWidth) or self.contentPageWidth
+        height = self.contentPageHeight if pageRow != self.pageRows - 1 else \
+            (self.gridRect.height % self.contentPageHeight) or self.contentPageHeight
+        return (width, height)
+
+    def export(self, path):
+        self.pageColumns, self.pageRows = self.getCountPages()
+        if self.pageColumns <= 0 or self.pageRows <= 0:
+            raise Exception('Margin is too wide.')
+        self.pageWidth, self.pageHeight = self.getPageSize()
+        self.contentPageWidth, self.contentPageHeight = self.getContentGridSize()
+
+        with open(path, 'wb') as f:
+            self.doc = PDFDocument(f)
+            self.font = self.doc.addObject(
+                '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+            self._writeStitchDefs()
+            self.resources = self.doc.addObject('<< /Font << /F1 {} 0 R >> /XObject << {} >> >>'.format(
+                self.font, ' '.join('/S{} {} 0 R'.format(r, ref) for r, ref in self.stitchObjects.items())))
+
+            for pageRow in range(self.pageRows):
+                for pageColumn in range(self.pageColumns):
+                    self.writePage(pageRow, pageColumn)
+            if not (self.pageRows == 1 and self.pageColumns == 1):
+                self.writeDescriptionPage()
+
+            self.doc.close(self._getInfo())
+
+    def _getInfo(self):
+        metadata = self.kogin.getMetadata()
+        info = {'Producer': 'kogin'}
+        title = metadata.get('title') or metadata.get('title-en')
+        if title:
+            info['Title'] = title
+        if metadata.get('author'):
+            info['Author'] = metadata['author']
+        if metadata.get('keyword'):
+            info['Keywords'] = metadata['keyword']
+        return info
+
+    def _writeStitchDefs(self):
+        # each stitch is a form XObject placed at the position of stitches
+        self.stitchObjects = {}
+        flat = self._flat
+        lineWidth = self.mmToPt(self.getLineWidth())
+        lineCap = 1 if self.op.lineCap == 'round' else 0
+        for r, ref in enumerate(flat.refs):
+            if not flat.xs[r]:
+                continue
+            start, end = self.op.posCalc.calc(0, 0, flat.lengths[r], False)
+            x1, y1 = self.mmToPt(start.x), -self.mmToPt(start.y)
+            x2, y2 = self.mmToPt(end.x), -self.mmToPt(end.y)
+            red, green, blue = self.colorToRGB('#000000' if self.op.monochrome else '#' + flat.colors[r])
+            content = '{} w {} J {} {} {} RG {} {} m {} {} l S'.format(
+                pdf_number(lineWidth), lineCap, pdf_number(red), pdf_number(green), pdf_number(blue),
+                pdf_number(x1), pdf_number(y1), pdf_number(x2), pdf_number(y2))
+            bbox = [min(x1, x2) - lineWidth, min(y1, y2) - lineWidth,
+                    max(x1, x2) + lineWidth, max(y1, y2) + lineWidth]
+            self.stitchObjects[r] = self.doc.addStream(
+                '/Type /XObject /Subtype /Form /BBox [{}]'.format(' '.join(pdf_number(v) for v in bbox)),
+                content.encode('latin-1'))
+
+    def getLineWidth(self):
+        viewMode = self.op.viewMode
+        if viewMode == viewModeFillGrain:
+            return self.op.gridHeight
+        elif viewMode == viewModeOverWarp:
+            return self.op.overWarpLineWidth
+        elif viewMode == viewModeOverGrain:
+            return self.op.overGrainLineWidth
+        return self.op.lineGrainLineWidth
+
+    def colorToRGB(self, color):
+        if len(color) > 6:
+            return (int(color[1:3], 16) / 255, int(color[3:5], 16) / 255, int(color[5:7], 16) / 255)
+        return (0, 0, 0)
+
+    def toY(self, y):
+        return self.pageHeight - y
+
+    def writePage(self, pageRow, pageColumn):
+        self.pageRow = pageRow
+        self.pageColumn = pageColumn
+        single = self.pageRows == 1 and self.pageColumns == 1
+        startX = pageColumn * self.contentPageWidth
+        startY = pageRow * self.contentPageHeight
+        width, height = self.getPageGridSize(pageRow, pageColumn)
+
+        # centering if only a page in the pattern
+        self.gridStartX = (self.pageWidth - self.mmToPt(width * self.op.gridWidth)) / 2 if single else \
+            self.mmToPt(self.options['leftMargin'])
+        self.gridStartY = self.toY(self.mmToPt(self.options['topMargin']))
+        self.gridEndX = self.gridStartX + self.mmToPt(width * self.op.gridWidth)
+        self.gridEndY = self.gridStartY - self.mmToPt(height * self.op.gridHeight)
+
+        self.ops = []
+        # under grid
+        if self.op.showGrid and not self.op.overGrid:
+            self.addGrid(startX, startY, width, height)
+
+        self.writeElements(startX, startY, width, height)
+
+        # over grid
+        if self.op.showGrid and self.op.overGrid:
+            self.addGrid(startX, startY, width, height)
+
+        if not single:
+            self.addPageNumber()
+        self.addTitleIfRequired()
+        copyright = self.kogin.getMetadata().get('copyright')
+        if self.op.showCopyright and copyright:
+            self.addCopyright(copyright)
+
+        self.doc.addPage(self.pageWidth, self.pageHeight, '\n'.join(self.ops), self.resources)
+        self.ops = None
+
+    def writeElements(self, startX, startY, width, height):
+        op = self.op
+        ops = self.ops
+        left = self.gridStartX + (self.mmToPt(op.gridWidth * op.leftMargin) if self.pageColumn == 0 else 0)
+        top = self.gridStartY - (self.mmToPt(op.gridHeight * op.topMargin) if self.pageRow == 0 else 0)
+        right = self.gridEndX - (self.mmToPt(op.gridWidth * op.rightMargin)
+                                 if self.pageColumn == self.pageColumns - 1 else 0)
+        bottom = self.gridEndY + (self.mmToPt(op.gridHeight * op.bottomMargin)
+                                  if self.pageRow == self.pageRows - 1 else 0)
+        ops.append('q {} {} m {} {} l {} {} l {} {} l h W n'.format(
+            pdf_number(left), pdf_number(top), pdf_number(right), pdf_number(top),
+            pdf_number(right), pdf_number(bottom), pdf_number(left), pdf_number(bottom)))
+
+        flat = self._flat
+        posCalc = op.posCalc
+        endX = startX + width - 1
+        endY = startY + height - 1
+        hidden = flat.hiddenGroups()
+        for r, name in self.stitchObjects.items():
+            length = flat.lengths[r]
+            draw = '/S{} Do Q'.format(r)
+            for x, y, g in zip(flat.xs[r], flat.ys[r], flat.gs[r]):
+                if g in hidden:
+                    continue
+                x -= self.originX
+                y -= self.originY
+                if not (startY <= y <= endY):
+                    continue
+                if not (startX <= x <= endX or x <= startX <= x + length):
+                    continue
+                point = posCalc.gridToPoint(x - startX, y - startY)
+                ops.append('q 1 0 0 1 {} {} cm {}'.format(
+                    pdf_number(self.gridStartX + self.mmToPt(point.x)),
+                    pdf_number(self.gridStartY - self.mmToPt(point.y)), draw))
+        ops.append('Q')
+
+    def _line(self, x1, y1, x2, y2):
+        return '{} {} m {} {} l S'.format(pdf_number(x1), pdf_number(y1), pdf_number(x2), pdf_number(y2))
+
+    def addGrid(self, startX, startY, width, height):
+        op = self.op
+        ops = self.ops
+        gridWidth = op.gridWidth
+        gridHeight = op.gridHeight
+        if gridWidth <= 0 or gridHeight <= 0 or width <= 0 or height <= 0:
+            return
+
+        majorFrequency = op.gridMajorLineFrequency
+        showGridFrame = op.showGridFrame
+        colors = {
+            False: '{} {} {} RG'.format(*[pdf_number(v) for v in self.colorToRGB(op.gridLineColor)]),
+            True: '{} {} {} RG'.format(*[pdf_number(v) for v in self.colorToRGB(op.gridMajorLineColor)]),
+        }
+        ops.append('q {} w 0 J'.format(pdf_number(self.mmToPt(op.gridLineWidth))))
+        current = None
+
+        # horizontal lines
+        lineEndY = height * gridHeight
+        if self.pageRow == 0:
+            majorNumber = op.gridMajorVertOffset
+        else:
+            majorNumber = majorFrequency - ((startY - op.gridMajorVertOffset) % majorFrequency)
+        y = 0
+        lineCount = 0
+        while y <= lineEndY:
+            ypt = self.gridStartY - self.mmToPt(y)
+            major = lineCount == majorNumber or (showGridFrame and (
+                (self.pageRow == 0 and lineCount == 0) or
+                (self.pageRow == self.pageRows - 1 and height <= lineCount)))
+            if major != current:
+                ops.append(colors[major])
+                current = major
+            ops.append(self._line(self.gridStartX, ypt, self.gridEndX, ypt))
+            if lineCount == majorNumber:
+                majorNumber += majorFrequency
+            y += gridHeight
+            lineCount += 1
+
+        # vertical lines
+        lineEndX = width * gridWidth
+        if self.pageColumn == 0:
+            majorNumber = op.gridMajorHoriOffset
+        else:
+            majorNumber = majorFrequency - ((startX - op.gridMajorHoriOffset) % majorFrequency)
+        x = 0
+        lineCount = 0
+        while x <= lineEndX:
+            xpt = self.gridStartX + self.mmToPt(x)
+            major = lineCount == majorNumber or (showGridFrame and (
+                (self.pageColumn == 0 and lineCount == 0) or
+                (self.pageColumn == self.pageColumns - 1 and width <= lineCount)))
+            if major != current:
+                ops.append(colors[major])
+                current = major
+            ops.append(self._line(xpt, self.gridStartY, xpt, self.gridEndY))
+            if lineCount == majorNumber:
+                majorNumber += majorFrequency
+            x += gridWidth
+            lineCount += 1
+        ops.append('Q')
+
+        if self.options.get('gridNumber', False):
+            self.addGridNumbering(startX, startY, lineEndX, lineEndY)
+
+    def addGridNumbering(self, startX, startY, lineEndX, lineEndY):
+        op = self.op
+        gridWidth = op.gridWidth
+        gridHeight = op.gridHeight
+        numberingSize = 7
+        numberingFrequency = 5
+        vertOffset = gridHeight / 2
+
+        if self.pageRow == 0:
+            majorNumber = 1
+            numberingStartY = op.gridMajorVertOffset + 1
+        else:
+            majorNumber = (startY // numberingFrequency + 1) * numberingFrequency
+            numberingStartY = majorNumber - startY + op.gridMajorVertOffset
+        y = gridHeight * numberingStartY
+        while y <= lineEndY:
+            ypt = self.gridStartY - self.mmToPt(y)
+            label = str(majorNumber)
+            textWidth = pdf_text_width(label, numberingSize)
+            self.addText(label, self.gridStartX - textWidth - 5, ypt + vertOffset, numberingSize)
+            self.addText(label, self.gridEndX + 5, ypt + vertOffset, numberingSize)
+            if majorNumber != 1:
+                majorNumber += numberingFrequency
+                y += gridHeight * numberingFrequency
+            else:
+                majorNumber += numberingFrequency - 1
+                y += gridHeight * (numberingFrequency - 1)
+
+        if self.pageColumn == 0:
+            majorNumber = 1
+            numberingStartX = op.gridMajorHoriOffset + 1
+        else:
+            majorNumber = (startX // numberingFrequency + 1) * numberingFrequency
+            numberingStartX = majorNumber - startX + op.gridMajorHoriOffset
+        numberingStartOffset = gridWidth / 2 if op.viewMode != viewModeOverGrain else 0
+        x = gridWidth * numberingStartX - numberingStartOffset
+        while x <= lineEndX:
+            xpt = self.gridStartX + self.mmToPt(x)
+            label = str(majorNumber)
+            textWidth = pdf_text_width(label, numberingSize)
+            self.addText(label, xpt - textWidth / 2, self.gridStartY + 4, numberingSize)
+            self.addText(label, xpt - textWidth / 2, self.gridEndY - 10, numberingSize)
+            if majorNumber != 1:
+                majorNumber += numberingFrequency
+                x += gridWidth * numberingFrequency
+            else:
+                majorNumber += numberingFrequency - 1
+                x += gridWidth * (numberingFrequency - 1)
+
+    def addText(self, s, x, y, size):
+        self.ops.append('BT /F1 {} Tf 0 g {} {} Td {} Tj ET'.format(
+            pdf_number(size), pdf_number(x), pdf_number(y), pdf_string(s)))
+
+    def addPageNumber(self):
+        self.addText(str(self.pageRow * self.pageColumns + self.pageColumn + 1), 25, 20, 10)
+
+    def addTitleIfRequired(self):
+        if self.op.showTitle:
+            metadata = self.kogin.getMetadata()
+            # Japanese title can not be shown with standard fonts
+            title = metadata.get('title-en') or metadata.get('title')
+            if title:
+                self.addText(title, self.gridStartX, self.gridStartY + 13, 10)
+
+    def addCopyright(self, s):
+        x = self.pageWidth - self.mmToPt(self.options['rightMargin'])
+        self.addText(s, x - pdf_text_width(s, 7), self.gridEndY - 17, 7)
+
+    def writeDescriptionPage(self):
+        self.ops = []
+        self.gridStartX = self.mmToPt(self.options['leftMargin'])
+        self.gridStartY = self.toY(self.mmToPt(self.options['topMargin']))
+        self.addTitleIfRequired()
+
+        cellWidth = self.mmToPt(10)
+        cellHeight = self.mmToPt(14)
+        startX = self.mmToPt(self.options['leftMargin'])
+        y = self.toY(self.mmToPt(self.options['topMargin'])) - 40
+        self.ops.append('1 w 0 G')
+        for row in range(self.pageRows):
+            x = startX
+            for column in range(self.pageColumns):
+                self.ops.append('{} {} {} {} re S'.format(
+                    pdf_number(x), pdf_number(y), pdf_number(cellWidth), pdf_number(cellHeight)))
+                pageNumber = str(row * self.pageColumns + column + 1)
+                textWidth = pdf_text_width(pageNumber, 10)
+                self.addText(pageNumber, x + cellWidth / 2 - textWidth / 2, y + cellHeight / 2, 10)
+                x += cellWidth
+            y -= cellHeight
+        self.doc.addPage(self.pageWidth, self.pageHeight, '\n'.join(self.ops), self.resources)
+        self.ops = None
+
+
+JSON_STRING_EXP = r'"(?:[^"\\]|\\.)*"'
+
+class LazyJSONObject:
+    """ Top-level values of JSON object in the text, decoded on first access.
+
+    Ranges of the values are found by a single scan counting brackets between
+    strings, so values which are not accessed are never decoded.
+    """
+    def __init__(self, text):
+        self.text = text
+        self._ranges = None
+        self._values = {}
+        self._decoded = None
+
+    def ranges(self):
+        if self._ranges is None:
+            self._ranges = self._scan()
+        return self._ranges
+
+    def keys(self):
+        return self.ranges().keys()
+
+    def __contains__(self, key):
+        return key in self.ranges()
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        start, end = self.ranges()[key]
+        value = json.loads(self.text[start:end])
+        self._values[key] = value
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def decode(self):
+        """ Returns whole object as dict sharing the decoded values. """
+        if self._decoded is None:
+            self._decoded = {key: self[key] for key in self.keys()}
+        return self._decoded
+
+    def _scan(self):
+        text = self.text
+        decoder = json.JSONDecoder()
+        space = re.compile(r'\s*')
+        ranges = {}
+        pos = space.match(text).end()
+        if text[pos:pos + 1] != '{':
+            raise ValueError('JSON object expected')
+        pos = space.match(text, pos + 1).end()
+        if text[pos:pos + 1] == '}':
+            return ranges
+        while True:
+            key, pos = decoder.raw_decode(text, pos)
+            pos = space.match(text, pos).end()
+            if not isinstance(key, str) or text[pos:pos + 1] != ':':
+                raise ValueError('Key expected at {}'.format(pos))
+            start = space.match(text, pos + 1).end()
+            if text[start:start + 1] in ('[', '{'):
+                end = self._skip(text, start)
+            else:
+                _, end = decoder.raw_decode(text, start)
+            ranges[key] = (start, end)
+            pos = space.match(text, end).end()
+            c = text[pos:pos + 1]
+            if c == '}':
+                return ranges
+            if c != ',':
+                raise ValueError('Delimiter expected at {}'.format(pos))
+            pos = space.match(text, pos + 1).end()
+
+    def _skip(self, text, start):
+        # returns end of the array or object, brackets in strings are not counted
+        depth = 0
+        pos = start
+        for m in re.compile(JSON_STRING_EXP).finditer(text, start):
+            depth, end = self._count(text, pos, m.start(), depth)
+            if end is not None:
+                return end
+            pos = m.end()
+        depth, end = self._count(text, pos, len(text), depth)
+        if end is None:
+            raise ValueError('Unterminated value at {}'.format(start))
+        return end
+
+    def _count(self, text, pos, end, depth):
+        # returns (depth after the segment, position where depth gets 0 or None)
+        segment = text[pos:end]
+        change = segment.count('[') + segment.count('{') - segment.count(']') - segment.count('}')
+        depth += change
+        if depth > 0:
+            return (depth, None)
+        if depth < -1:
+            raise ValueError('Unexpected bracket at {}'.format(pos))
+        # only delimiters and the end of the object follow the value
+        end = len(segment)
+        for _ in range(1 - depth):
+            end = max(segment.rfind(']', 0, end), segment.rfind('}', 0, end))
+        if end < 0 or segment[end + 1:].strip(' \t\r\n,}'):
+            raise ValueError('Unexpected bracket at {}'.format(pos))
+        return (0, pos + end + 1)
+
 
 class KoginOption:
     def __init__(self, data):
+        # dict or LazyJSONObject
         self._data = data
 
     def getData(self):
+        if isinstance(self._data, LazyJSONObject):
+            self._data = self._data.decode()
         return self._data
 
     def outputScreen(self):
@@ -736,13 +1647,335 @@ class KoginOption:
     def view(self):
         return self._data['view']
 
+DATA_FORMAT_KEY = 'data-format'
+# coords of each ref as list of [x, y]
+DATA_FORMAT_JSON = 0
+# coords of each ref packed into [xs, ys], see pack_column()
+DATA_FORMAT_PACKED = 1
+
+# zigzag decoding of single byte varints
+_ZIGZAG = [(v >> 1) ^ -(v & 1) for v in range(128)]
+
+def pack_column(values):
+    """ Encodes integers into base64 of zigzag varints of the deltas. """
+    import base64
+    out = bytearray()
+    previous = 0
+    for v in values:
+        d = v - previous
+        previous = v
+        z = d << 1 if d >= 0 else (-d << 1) - 1
+        while z >= 0x80:
+            out.append((z & 0x7f) | 0x80)
+            z >>= 7
+        out.append(z)
+    return base64.b64encode(out).decode('ascii')
+
+def unpack_column(s):
+    """ Decodes integers encoded by pack_column(). """
+    import base64
+    from itertools import accumulate
+    b = base64.b64decode(s)
+    if b.isascii():
+        # all deltas fit in single byte
+        return list(accumulate(map(_ZIGZAG.__getitem__, b)))
+    deltas = []
+    z = 0
+    shift = 0
+    for byte in b:
+        z |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            deltas.append((z >> 1) ^ -(z & 1))
+            z = 0
+            shift = 0
+    return list(accumulate(deltas))
+
+def _packChild(child):
+    if not 'coords' in child:
+        return child
+    packed = {key: value for key, value in child.items() if key != 'coords'}
+    coords = child['coords']
+    packed['packed'] = [pack_column([c[0] for c in coords]), pack_column([c[1] for c in coords])]
+    return packed
+
+def _unpackChild(child):
+    if not 'packed' in child:
+        return child
+    coords = {key: value for key, value in child.items() if key != 'packed'}
+    coords['coords'] = [list(c) for c in zip(*map(unpack_column, child['packed']))]
+    return coords
+
+def _hasChildWith(group, key):
+    for child in group.get('children', []):
+        if 'ref' in child:
+            if key in child:
+                return True
+        elif _hasChildWith(child, key):
+            return True
+    return False
+
+def _convertGroup(group, func):
+    converted = dict(group)
+    converted['children'] = [func(child) if 'ref' in child else _convertGroup(child, func)
+                             for child in group.get('children', [])]
+    return converted
+
+NODE_GROUP = 0
+NODE_RUN = 1
+
+class FlatStitches:
+    """ Stitches of the group tree flattened into absolute coordinates.
+
+    Coordinates are stored in columns per ref, xs[r], ys[r] and group index
+    of each stitch in gs[r]. Groups are listed in pre-order, layers are
+    the groups without parent. Each run is a slice of the columns of
+    the ref in a group, (group, ref, start, end), in the order of the data.
+    """
+    def __init__(self, data):
+        self.refs = []
+        self.lengths = []
+        self.colors = []
+        self.xs = []
+        self.ys = []
+        self.gs = []
+
+        self.groups = []
+        self.groupParent = []
+        self.groupLayer = []
+        self.groupX = []
+        self.groupY = []
+        # list of (NODE_GROUP, group) or (NODE_RUN, run) for each group
+        self.groupChildren = []
+        self.layers = []
+        self.runs = []
+
+        self._refIndex = {}
+        for layer in data:
+            self.layers.append(self._addGroup(layer, -1, len(self.layers), 0, 0))
+
+    def _addRef(self, ref):
+        index = self._refIndex.get(ref)
+        if index is None:
+            length, color = ref.split('-', 1)
+            index = len(self.refs)
+            self._refIndex[ref] = index
+            self.refs.append(ref)
+            self.lengths.append(int(length, 10))
+            self.colors.append(color)
+            self.xs.append([])
+            self.ys.append([])
+            self.gs.append([])
+        return index
+
+    def _addGroup(self, group, parent, layer, offsetX, offsetY):
+        index = len(self.groups)
+        offsetX += group.get('x', 0)
+        offsetY += group.get('y', 0)
+        self.groups.append(group)
+        self.groupParent.append(parent)
+        self.groupLayer.append(layer)
+        self.groupX.append(offsetX)
+        self.groupY.append(offsetY)
+        children = []
+        self.groupChildren.append(children)
+
+        for child in group.get('children', []):
+            ref = child.get('ref')
+            if ref:
+                r = self._addRef(ref)
+                xs = self.xs[r]
+                ys = self.ys[r]
+                start = len(xs)
+                packed = child.get('packed')
+                if packed is not None:
+                    cx, cy = unpack_column(packed[0]), unpack_column(packed[1])
+                    xs.extend([x + offsetX for x in cx] if offsetX else cx)
+                    ys.extend([y + offsetY for y in cy] if offsetY else cy)
+                else:
+                    for coord in child.get('coords', []):
+                        xs.append(coord[0] + offsetX)
+                        ys.append(coord[1] + offsetY)
+                end = len(xs)
+                self.gs[r].extend([index] * (end - start))
+                children.append((NODE_RUN, len(self.runs)))
+                self.runs.append((index, r, start, end))
+            else:
+                children.append((NODE_GROUP, self._addGroup(child, index, layer, offsetX, offsetY)))
+        return index
+
+    def refIndex(self, ref):
+        return self._refIndex.get(ref, -1)
+
+    def count(self):
+        return sum(len(xs) for xs in self.xs)
+
+    def hiddenGroups(self):
+        """ Returns set of groups in layers hidden in the image. """
+        return set(g for g, layer in enumerate(self.groupLayer)
+                   if self.groups[layer].get('layer', False) and not self.groups[layer].get('visible', True))
+
+    def runCoords(self, run):
+        """ Returns absolute coordinates of the run. """
+        _, r, start, end = run
+        return zip(self.xs[r][start:end], self.ys[r][start:end])
+
+
+class Tiling:
+    """ Translational repetition of stitches.
+
+    Stitches are list of (x, y, ref index). Periods are searched from
+    the differences between stitches of a ref, a horizontal period and
+    a second one which can be skewed. The motif is list of (x, y, ref)
+    relative to the tile origin, tiles are origins of the repetitions
+    which contain the whole motif, the others are left in residue.
+    """
+    ANCHORS = 8
+    MAX_CANDIDATES = 16
+    MIN_TILES = 2
+    # a period has to repeat at least 1/MIN_SHARE of the stitches
+    MIN_SHARE = 3
+
+    def __init__(self, stitches):
+        self.periods = (None, None)
+        self.motif = []
+        self.tiles = []
+        self.residue = list(stitches)
+        self._detect(self.residue)
+
+    def found(self):
+        return len(self.tiles) > 0
+
+    def _detect(self, stitches):
+        unique = set(stitches)
+        byRef = {}
+        for s in unique:
+            byRef.setdefault(s[2], []).append(s)
+        refs = [items for items in byRef.values() if len(items) >= 2]
+        if not refs:
+            return
+        # the most frequent ref is the least likely to be a stray one,
+        # candidates are scored across every ref
+        items = sorted(max(refs, key=len), key=lambda s: (s[1], s[0]))
+        anchors = items[::max(1, len(items) // self.ANCHORS)][:self.ANCHORS]
+
+        horiCandidates = {}
+        for a in anchors:
+            for b in items:
+                if b[1] == a[1] and b[0] > a[0]:
+                    d = (b[0] - a[0], 0)
+                    horiCandidates[d] = horiCandidates.get(d, 0) + 1
+        hori = self._bestPeriod(unique, horiCandidates)
+
+        vertCandidates = {}
+        for a in anchors:
+            for b in items:
+                if b[1] > a[1]:
+                    dx = b[0] - a[0]
+                    if hori is not None:
+                        dx %= hori[0]
+                    d = (dx, b[1] - a[1])
+                    vertCandidates[d] = vertCandidates.get(d, 0) + 1
+        vert = self._bestPeriod(unique, vertCandidates, hori)
+        if hori is None and vert is None:
+            return
+        self._split(stitches, unique, hori, vert)
+
+    def _bestPeriod(self, unique, candidates, hori=None):
+        # with a horizontal period, positions are compared modulo it so
+        # that (3, 6) and (-3, 6) of a brick pattern score the same
+        if hori is not None:
+            hx = hori[0]
+            targets = set((x % hx, y, r) for x, y, r in unique)
+        else:
+            hx = None
+            targets = unique
+        best = None
+        bestScore = (len(unique) + self.MIN_SHARE - 1) // self.MIN_SHARE - 1
+        frequent = sorted(candidates.items(), key=lambda item: -item[1])[:self.MAX_CANDIDATES]
+        for d, _ in frequent:
+            dx, dy = d
+            score = 0
+            for x, y, r in unique:
+                x += dx
+                if hx is not None:
+                    x %= hx
+                if (x, y + dy, r) in targets:
+                    score += 1
+            if score > bestScore or (score == bestScore and best is not None and
+                                     (d[1], abs(d[0])) < (best[1], abs(best[0]))):
+                best = d
+                bestScore = score
+        return best
+
+    def _split(self, stitches, unique, hori, vert):
+        # the origin is taken from the repeated stitches only, strays
+        # would shift the tile grid
+        periods = [d for d in (hori, vert) if d is not None]
+        repeated = [(x, y, r) for x, y, r in unique
+                    if any((x + dx, y + dy, r) in unique or (x - dx, y - dy, r) in unique
+                           for dx, dy in periods)]
+        x0 = min(s[0] for s in repeated or unique)
+        y0 = min(s[1] for s in repeated or unique)
+        tiles = {}
+        placements = {}
+        for s in unique:
+            x, y, r = s
+            if vert is not None:
+                j = (y - y0) // vert[1]
+                x -= j * vert[0]
+                y -= j * vert[1]
+            else:
+                j = 0
+            if hori is not None:
+                i = (x - x0) // hori[0]
+                x -= i * hori[0]
+            else:
+                i = 0
+            local = (x - x0, y - y0, r)
+            placements[s] = ((i, j), local)
+            tiles.setdefault((i, j), set()).add(local)
+
+        counts = {}
+        for items in tiles.values():
+            for local in items:
+                counts[local] = counts.get(local, 0) + 1
+        motif = set(local for local, count in counts.items() if count * 2 >= len(tiles))
+        complete = sorted((key for key, items in tiles.items() if motif <= items),
+                          key=lambda key: (key[1], key[0]))
+        if len(complete) < self.MIN_TILES or \
+                len(motif) * len(complete) <= len(motif) + len(complete):
+            return
+
+        hx = hori[0] if hori is not None else 0
+        vx, vy = vert if vert is not None else (0, 0)
+        self.periods = (hori, vert)
+        self.motif = sorted(motif, key=lambda local: (local[1], local[0], local[2]))
+        self.tiles = [(x0 + i * hx + j * vx, y0 + j * vy) for i, j in complete]
+        completeSet = set(complete)
+        residue = []
+        covered = set()
+        for s in stitches:
+            key, local = placements[s]
+            if key in completeSet and local in motif and not s in covered:
+                covered.add(s)
+            else:
+                residue.append(s)
+        self.residue = residue
+
+
 class KoginData:
     def __init__(self, data):
+        # dict or LazyJSONObject, only accessed sections are decoded
         if data['application'] != 'kogin':
             raise Exception('Non-kogin data')
         self._data = data
+        self._flat = None
 
     def getData(self):
+        if isinstance(self._data, LazyJSONObject):
+            self._data = self._data.decode()
         return self._data
 
     def defs(self):
@@ -757,18 +1990,62 @@ class KoginData:
     def bbox(self):
         return self._data['bbox']
 
+    def flat(self):
+        """ Returns flattened stitches, built at the first call. """
+        if self._flat is None:
+            self._flat = FlatStitches(self.data())
+        return self._flat
+
+    def encoded(self, dataFormat):
+        """ Returns the data with coords in the format, the data itself if already in it. """
+        if dataFormat == DATA_FORMAT_PACKED:
+            func, source = _packChild, 'coords'
+        else:
+            func, source = _unpackChild, 'packed'
+        if not any(_hasChildWith(layer, source) for layer in self.data()):
+            return self.getData()
+        encoded = dict(self.getData())
+        encoded['data'] = [_convertGroup(layer, func) for layer in self.data()]
+        return encoded
+
 class Kogin:
+    """ Sections of the file, kept as text and decoded on first access. """
     def __init__(self, path):
         self.path = path
-        tree = ET.parse(path)
-        root = tree.getroot()
-        for obj in root.findall('{http://www.w3.org/2000/svg}foreignObject'):
-            if obj.get('id') == 'kogin-data':
-                self.data = KoginData(json.loads(obj.text))
-            elif obj.get('id') == 'kogin-option':
-                self.option = KoginOption(json.loads(obj.text))
-            elif obj.get('id') == 'kogin-metadata':
-                self.metadata = json.loads(obj.text)
+        with open(path, 'rb') as f:
+            self._sections = SVGSections(f.read())
+        if not 'kogin-data' in self._sections:
+            raise Exception('No kogin-data')
+        self._data = KoginData(LazyJSONObject(self._sections.text('kogin-data')))
+        self._option = None
+        self._metadata = None
+
+    @classmethod
+    def create(cls, data, option, metadata, path=None):
+        """ Creates from decoded sections. """
+        kogin = cls.__new__(cls)
+        kogin.path = path
+        kogin._sections = None
+        kogin._data = KoginData(data)
+        kogin._option = KoginOption(option)
+        kogin._metadata = metadata
+        return kogin
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def option(self):
+        if self._option is None:
+            self._option = KoginOption(LazyJSONObject(self._sections.text('kogin-option')))
+        return self._option
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = json.loads(self._sections.text('kogin-metadata'))
+        return self._metadata
 
     def getData(self):
         return self.data
@@ -785,7 +2062,7 @@ class Kogin:
     def mergeOption(self, other):
         op = self.getOption().getData()
         for key, value in other.getOption().getData().items():
-            if key == 'bounds':
+            if key == 'bounds' or key == SCHEMA_VERSION_KEY or key == DATA_FORMAT_KEY:
                 continue
             op[key] = value
 
@@ -795,9 +2072,25 @@ STATE_INSIDE = 1
 STATE_OVERLAP = 2
 STATE_UNKNOWN = 3
 
+# number of stitches to resolve conflictions in row bands with process pool,
+# used by single file commands only, the others already run files in a pool
+PARALLEL_NORMALIZE_THRESHOLD = 2000
+# number of stitches in a band
+NORMALIZE_BAND_SIZE = 500
+
+def _solveBand(stitches):
+    # conflictions occur only in the same row, bands are independent
+    normalizer = Normalizer(None)
+    normalizer._stitches = stitches
+    normalizer._solveConfliction(STATE_SAME, STATE_INSIDE)
+    normalizer._solveConfliction(STATE_OVERLAP, STATE_UNKNOWN)
+    return normalizer._stitches
+
 class Normalizer:
-    def __init__(self, data):
+    def __init__(self, data, jobs=None, threshold=None):
         self.data = data
+        self.jobs = jobs
+        self.threshold = threshold
         self._stitches = []
 
     def _addStitch(self, length, coord):
@@ -809,11 +2102,102 @@ class Normalizer:
 
     def normalize(self):
         self._parse()
-        self._solveConfliction(STATE_SAME, STATE_INSIDE)
-        self._solveConfliction(STATE_OVERLAP, STATE_UNKNOWN)
+        if self.threshold is not None and sum(map(len, self._stitches)) >= self.threshold:
+            self._solveBands()
+        else:
+            self._solveConfliction(STATE_SAME, STATE_INSIDE)
+            self._solveConfliction(STATE_OVERLAP, STATE_UNKNOWN)
         self._align()
         return self._hash()
 
+    def _bands(self):
+        """ Splits stitches into bands of rows, list of coords for each length. """
+        rows = {}
+        for coords in self._stitches:
+            for x, y in coords:
+                rows[y] = rows.get(y, 0) + 1
+        bandOfRow = {}
+        band = 0
+        count = 0
+        for y in sorted(rows):
+            if count >= NORMALIZE_BAND_SIZE:
+                band += 1
+                count = 0
+            bandOfRow[y] = band
+            count += rows[y]
+
+        bands = [[[] for _ in self._stitches] for _ in range(band + 1)]
+        for length, coords in enumerate(self._stitches):
+            for coord in coords:
+                bands[bandOfRow[coord[1]]][length].append(coord)
+        return bands
+
+    def _solveBands(self):
+        from concurrent.futures import ProcessPoolExecutor
+        bands = self._bands()
+        with ProcessPoolExecutor(self.jobs) as executor:
+            results = list(executor.map(_solveBand, bands))
+        # order in each length is restored by _align
+        merged = []
+        for stitches in results:
+            for length, coords in enumerate(stitches):
+                while len(merged) <= length:
+                    merged.append([])
+                merged[length].extend(coords)
+        self._stitches = merged
+
+    def signature(self):
+        """ Returns cheap signature of the data kept by normalize.
+
+        Conflictions are solved only in each row, by removing stitches inside
+        of another and joining overlapping ones, so cells covered in each row
+        do not change. Data with the same hash have the same signature.
+        """
+        flat = self.data.flat()
+        bbox = self.data.bbox()
+        left = bbox[0]
+        top = bbox[1]
+        rows = {}
+        for run in flat.runs:
+            length = flat.lengths[run[1]]
+            for x, y in flat.runCoords(run):
+                rows.setdefault(y, []).append((x, x + length))
+        # (row, first x, number of covered cells) for each row
+        entries = []
+        for y in sorted(rows):
+            intervals = sorted(rows[y])
+            startX, endX = intervals[0]
+            covered = 0
+            for x1, x2 in intervals:
+                if x1 > endX:
+                    covered += endX - startX
+                    startX = x1
+                endX = max(endX, x2)
+            covered += endX - startX
+            entries.append('{},{},{}'.format(y - top, intervals[0][0] - left, covered))
+        return hashlib.sha1(';'.join(entries).encode('utf-8')).hexdigest()
+
+    def stitches(self):
+        """ Returns iterator of normalized (x, y, length) sorted by position. """
+        return heapq.merge(*[[(x, y, length) for x, y in coords]
+                             for length, coords in enumerate(self._stitches) if coords])
+
+    def countConflicts(self):
+        """ Returns number of stitches still starting inside of another stitch in the row. """
+        rows = {}
+        for length, coords in enumerate(self._stitches):
+            for x, y in coords:
+                rows.setdefault(y, []).append((x, length))
+        count = 0
+        for row in rows.values():
+            row.sort()
+            endX = None
+            for x, length in row:
+                if endX is not None and x <= endX:
+                    count += 1
+                endX = x + length if endX is None else max(endX, x + length)
+        return count
+
     def _hash(self):
         # length:X,Y...\n
         lines = []
@@ -830,8 +2214,11 @@ class Normalizer:
         for _ in range(10):
             self._stitches.append([])
 
-        for layer in self.data.data():
-            self._parseGroup(layer, 0, 0)
+        flat = self.data.flat()
+        for run in flat.runs:
+            length = flat.lengths[run[1]]
+            for coord in flat.runCoords(run):
+                self._addStitch(length, coord)
 
     def _align(self):
         bbox = self.data.bbox()
@@ -843,17 +2230,6 @@ class Normalizer:
                 entries.sort(key=itemgetter(0, 1))
                 self._stitches[length] = entries
 
-    def _parseGroup(self, group, offsetX, offsetY):
-        for child in group['children']:
-            ref = child.get('ref')
-            if ref:
-                length, _ = self._parseRef(ref)
-                for coord in child['coords']:
-                    self._addStitch(length, (coord[0] + offsetX, coord[1] + offsetY))
-            else:
-                if child.get('children'):
-                    self._parseGroup(child, offsetX + child['x'], offsetY + child['y'])
-
     def _parseRef(self, ref):
         length, color = ref.split('-', 1)
         return int(length, 10), color
@@ -1042,30 +2418,1715 @@ class OverlapConfliction(Confliction):
         return '[{}, {}, {}]'.format(self.entry1, self.entries, self.STATE[self.state])
 
 
-def hash(path):
-    return Kogin(path).normalizer().normalize()
+SCHEMA_VERSION_KEY = 'schema-version'
+
+def _migrateOffsetRatio(sections):
+    changed = False
+    option = sections['kogin-option']
+    for key in ('output-screen', 'output-print'):
+        output = option.get(key)
+        if output is None:
+            continue
+        for name in ('overGrainOffsetRatio', 'overWarpOffsetRatio'):
+            if not name in output:
+                output[name] = 0.1
+                changed = True
+    return changed
+
+# (version, description, sections required, function)
+# Each function updates decoded sections in place and returns True if changed.
+# Functions have to be idempotent because files saved by the editor lose
+# the version stored in the option.
+MIGRATIONS = [
+    (1, 'add offset ratio for over grain and over warp', ('kogin-option',), _migrateOffsetRatio),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+FOREIGN_OBJECT_EXP = rb'<foreignObject\b[^>]*?\bid=(["\'])(kogin-[a-z]+)\1[^>]*>'
+# markup which unescape() does not handle, like CDATA and character references
+XML_MARKUP_EXP = rb'<|&(?!(?:lt|gt|quot|amp);)'
+
+class SVGSections:
+    """ Byte ranges of foreignObjects in the file, decoded on demand.
+
+    Sections are found by a regular expression, the file is parsed by
+    ElementTree only when a section is missing or contains markup.
+    """
+    def __init__(self, content):
+        self.content = content
+        self.ranges = {}
+        for m in re.finditer(FOREIGN_OBJECT_EXP, content):
+            if m.group(0).endswith(b'/>'):
+                continue
+            # searching the end is faster than matching lazily
+            end = content.find(b'</foreignObject>', m.end())
+            if end >= 0:
+                self.ranges[m.group(2).decode('ascii')] = (m.end(), end)
+        self._texts = None
+        self._decoded = {}
+        self.changed = set()
+
+    def __contains__(self, name):
+        return name in self.ranges or name in self._treeTexts()
+
+    def _treeTexts(self):
+        if self._texts is None:
+            import xml.etree.ElementTree as ET
+            self._texts = {}
+            try:
+                root = ET.fromstring(self.content)
+            except ET.ParseError:
+                return self._texts
+            for obj in root.iter('{http://www.w3.org/2000/svg}foreignObject'):
+                name = obj.get('id')
+                if name and name.startswith('kogin-') and obj.text:
+                    self._texts[name] = obj.text
+        return self._texts
+
+    def __setitem__(self, name, value):
+        self._decoded[name] = value
+        self.changed.add(name)
+
+    def __getitem__(self, name):
+        value = self._decoded.get(name)
+        if value is None:
+            value = json.loads(self.text(name))
+            self._decoded[name] = value
+        return value
+
+    def text(self, name):
+        """ Returns JSON text of the section. """
+        if name in self.ranges:
+            start, end = self.ranges[name]
+            text = self.content[start:end]
+            if re.search(XML_MARKUP_EXP, text) is None:
+                return unescape(text.decode('utf-8'))
+        return self._treeTexts()[name]
+
+    def splice(self):
+        """ Returns content with changed sections replaced. """
+        content = self.content
+        for name in self.changed:
+            if not name in self.ranges:
+                raise Exception('Section {} can not be replaced'.format(name))
+        for name in sorted(self.changed, key=lambda name: self.ranges[name][0], reverse=True):
+            start, end = self.ranges[name]
+            indent = 1 if name != 'kogin-data' else None
+            text = escape(json.dumps(self._decoded[name], indent=indent, ensure_ascii=False))
+            content = content[:start] + text.encode('utf-8') + content[end:]
+        return content
+
+def migrate_file(path, version=SCHEMA_VERSION, dryRun=False):
+    """ Migrates the file to specified version.
+
+    Returns (path, current version, list of applied migrations, error).
+    """
+    try:
+        with open(path, 'rb') as f:
+            sections = SVGSections(f.read())
+        if not 'kogin-option' in sections:
+            return (path, None, [], 'no option')
+        current = sections['kogin-option'].get(SCHEMA_VERSION_KEY, 0)
+        applied = []
+        for stepVersion, description, required, func in MIGRATIONS:
+            if stepVersion <= current or stepVersion > version:
+                continue
+            if not all(name in sections for name in required):
+                continue
+            if func(sections):
+                applied.append(description)
+                sections.changed.update(required)
+
+        if applied:
+            sections['kogin-option'][SCHEMA_VERSION_KEY] = version
+            sections.changed.add('kogin-option')
+            if not dryRun:
+                with open(path, 'wb') as f:
+                    f.write(sections.splice())
+        return (path, current, applied, None)
+    except Exception as e:
+        return (path, None, [], str(e))
+
+def pack_file(path, dataFormat=DATA_FORMAT_PACKED, dryRun=False):
+    """ Stores kogin-data of the file in the format.
+
+    Returns (path, size of the data before, size after, error).
+    """
+    try:
+        with open(path, 'rb') as f:
+            sections = SVGSections(f.read())
+        if not 'kogin-option' in sections or not 'kogin-data' in sections:
+            return (path, None, None, 'no data')
+        start, end = sections.ranges['kogin-data']
+        data = KoginData(sections['kogin-data'])
+        encoded = data.encoded(dataFormat)
+        option = sections['kogin-option']
+        if encoded is data.getData() and option.get(DATA_FORMAT_KEY, DATA_FORMAT_JSON) == dataFormat:
+            # already stored in the format
+            return (path, end - start, end - start, None)
+        sections['kogin-data'] = encoded
+        if dataFormat == DATA_FORMAT_JSON:
+            option.pop(DATA_FORMAT_KEY, None)
+        else:
+            option[DATA_FORMAT_KEY] = dataFormat
+        sections.changed.add('kogin-option')
+        content = sections.splice()
+        if not dryRun:
+            with open(path, 'wb') as f:
+                f.write(content)
+        size = len(content) - (len(sections.content) - (end - start))
+        return (path, end - start, size, None)
+    except Exception as e:
+        return (path, None, None, str(e))
+
+def migrate_files(paths, version=SCHEMA_VERSION, dryRun=False, jobs=None):
+    return map_files(migrate_file, [(path, version, dryRun) for path in paths], jobs, 16)
+
+
+class StitchDiff:
+    """ Difference of normalized stitches between two data. """
+    def __init__(self, stitches1, stitches2):
+        self.added = []
+        self.removed = []
+        # (x, y, old length, new length)
+        self.extended = []
+        self.shortened = []
+        self.unchanged = []
+        self._merge(iter(stitches1), iter(stitches2))
+
+    def _merge(self, it1, it2):
+        # both are sorted by (x, y, length), so single pass is enough
+        a = next(it1, None)
+        b = next(it2, None)
+        while a is not None and b is not None:
+            if a[0] == b[0] and a[1] == b[1]:
+                if a[2] == b[2]:
+                    self.unchanged.append(a)
+                elif a[2] < b[2]:
+                    self.extended.append((a[0], a[1], a[2], b[2]))
+                else:
+                    self.shortened.append((a[0], a[1], a[2], b[2]))
+                a = next(it1, None)
+                b = next(it2, None)
+            elif a < b:
+                self.removed.append(a)
+                a = next(it1, None)
+            else:
+                self.added.append(b)
+                b = next(it2, None)
+        while a is not None:
+            self.removed.append(a)
+            a = next(it1, None)
+        while b is not None:
+            self.added.append(b)
+            b = next(it2, None)
 
-def get_hash_list(path):
-    listing = []
-    for name in os.listdir(path):
+    def isSame(self):
+        return not (self.added or self.removed or self.extended or self.shortened)
+
+
+class DiffWriter:
+    """ Writes difference as an overlay image. """
+    COLORS = {
+        'unchanged': '#bbbbbb',
+        'removed': '#ff0000',
+        'added': '#00a000',
+        'extended': '#0000ff',
+        'shortened': '#ff8000',
+    }
+
+    def __init__(self, diff, gridWidth=16, gridHeight=16):
+        self.diff = diff
+        self.gridWidth = gridWidth
+        self.gridHeight = gridHeight
+
+    def write(self):
+        diff = self.diff
+        items = {
+            'unchanged': diff.unchanged,
+            'removed': diff.removed,
+            'added': diff.added,
+            'extended': [(x, y, max(old, new)) for x, y, old, new in diff.extended],
+            'shortened': [(x, y, max(old, new)) for x, y, old, new in diff.shortened],
+        }
+        right = bottom = 0
+        for stitches in items.values():
+            for x, y, length in stitches:
+                right = max(right, x + length)
+                bottom = max(bottom, y + 1)
+        # one grid for margin
+        width = (right + 2) * self.gridWidth
+        height = (bottom + 2) * self.gridHeight
+
+        dom = SVGDOM('http://www.w3.org/2000/svg', 'svg')
+        dom.setAttribute('viewBox', '0 0 {} {}'.format(width, height))
+        dom.setAttribute('width', str(width))
+        dom.setAttribute('height', str(height))
+        strokeWidth = self.gridHeight / 2
+        for name, stitches in items.items():
+            g = dom.createElement('g')
+            g.setAttribute('id', name)
+            g.setAttribute('stroke', self.COLORS[name])
+            g.setAttribute('stroke-width', str(strokeWidth))
+            for x, y, length in stitches:
+                line = dom.createElement('line')
+                line.setAttribute('x1', str((x + 1) * self.gridWidth + 1))
+                line.setAttribute('x2', str((x + 1 + length) * self.gridWidth - 1))
+                cy = (y + 1) * self.gridHeight + self.gridHeight / 2
+                line.setAttribute('y1', str(cy))
+                line.setAttribute('y2', str(cy))
+                g.appendChild(line)
+            dom.appendChild(g)
+        return dom.write(newl='\n')
+
+def normalized_stitches(kogin):
+    normalizer = kogin.normalizer()
+    normalizer.normalize()
+    return list(normalizer.stitches())
+
+def diff_kogins(kogin1, kogin2):
+    """ Returns StitchDiff of two patterns relative to the union of their bboxes.
+
+    Normalized stitches are relative to the bbox of each file, they are moved
+    to the shared origin so that a changed bbox does not move every stitch.
+    """
+    bbox1 = kogin1.getData().bbox()
+    bbox2 = kogin2.getData().bbox()
+    left = min(bbox1[0], bbox2[0])
+    top = min(bbox1[1], bbox2[1])
+
+    def shifted(kogin, bbox):
+        dx = bbox[0] - left
+        dy = bbox[1] - top
+        return [(x + dx, y + dy, length) for x, y, length in normalized_stitches(kogin)]
+
+    return StitchDiff(shifted(kogin1, bbox1), shifted(kogin2, bbox2))
+
+def diff(path1, path2):
+    return diff_kogins(Kogin(path1), Kogin(path2))
+
+class Symmetry:
+    """ Mirror axes and rotation centre of stitches.
+
+    Stitches are list of (x, y, length). As all stitches are horizontal, the
+    pattern can have only a vertical axis, a horizontal axis and a centre of
+    180 degree rotation. Each of them is determined by the extremes of the
+    stitches, so a single comparison of the reflected set is enough.
+    Axes are stored doubled, a cell at x is mirrored to hori - x.
+    """
+    def __init__(self, stitches):
+        self.hori = None
+        self.vert = None
+        self.rotation = False
+        if not stitches:
+            return
+        self.left = min(x for x, y, length in stitches)
+        self.right = max(x + length for x, y, length in stitches)
+        self.top = min(y for x, y, length in stitches)
+        self.bottom = max(y for x, y, length in stitches)
+
+        original = frozenset(stitches)
+        kx = self.left + self.right
+        ky = self.top + self.bottom
+        if frozenset((kx - x - length, y, length) for x, y, length in stitches) == original:
+            self.hori = kx - 1
+        if frozenset((x, ky - y, length) for x, y, length in stitches) == original:
+            self.vert = ky
+        self.rotation = frozenset((kx - x - length, ky - y, length)
+                                  for x, y, length in stitches) == original
+
+    def pivots(self):
+        """ Returns candidate pivots, tips of the axes and the centre. """
+        pivots = []
+        def add(x, y):
+            if not [x, y] in pivots:
+                pivots.append([x, y])
+
+        # the cell on the axis, or the left or upper cell next to it
+        centerX = (self.left + self.right - 1) // 2
+        centerY = (self.top + self.bottom) // 2
+        if self.hori is not None:
+            add(centerX, self.top)
+            add(centerX, self.bottom)
+        if self.vert is not None:
+            add(self.left, centerY)
+            add(self.right - 1, centerY)
+        if self.rotation:
+            add(centerX, centerY)
+        return pivots
+
+def compute_pivots(data):
+    """ Returns candidate pivots of KoginData in absolute coordinates.
+
+    Empty list if the stitches have no symmetry, the editor falls back to
+    the left top of the bbox for them without storing it.
+    """
+    normalizer = Normalizer(data)
+    normalizer.normalize()
+    left, top = data.bbox()[0:2]
+    stitches = [(x + left, y + top, length) for x, y, length in normalizer.stitches()]
+    return Symmetry(stitches).pivots()
+
+def pivots_file(path, overwrite=False, dryRun=False):
+    """ Computes pivots of the file and writes them into kogin-data.
+
+    Returns (path, pivots or None if the file has pivots, error). The file
+    is left unchanged when no symmetry is found and pivots are empty.
+    """
+    try:
+        with open(path, 'rb') as f:
+            sections = SVGSections(f.read())
+        data = sections['kogin-data']
+        if data.get('pivots') and not overwrite:
+            return (path, None, None)
+        pivots = compute_pivots(KoginData(data))
+        if not pivots:
+            return (path, pivots, None)
+        data['pivots'] = pivots
+        sections['kogin-data'] = data
+        if not dryRun:
+            with open(path, 'wb') as f:
+                f.write(sections.splice())
+        return (path, pivots, None)
+    except Exception as e:
+        return (path, None, str(e))
+
+def resolve_overlaps(stitches):
+    """ Resolves overlaps of list of [x, y, length, color, layer] in place.
+
+    A stitch which starts inside of or just after another stitch in the row
+    is removed when it ends inside, otherwise the other stitch is extended
+    to its end. Rows are swept once in order of x, longer stitch first, then
+    in the given order, so no overlap is left and a chain of overlapping
+    stitches becomes a single stitch with the color and layer of the first.
+
+    This differs from Normalizer, which is kept as is for the hashes: it
+    merges a stitch only with the stitches starting inside of it and the
+    ones starting inside of those, leaving longer chains overlapping, and
+    can leave duplicates when two stitches start inside of the same one.
+    """
+    stitches.sort(key=lambda s: (s[1], s[0], -s[2]))
+    resolved = []
+    current = None
+    for s in stitches:
+        if current is not None and s[1] == current[1] and s[0] <= current[0] + current[2]:
+            end = s[0] + s[2]
+            if current[0] + current[2] < end:
+                current[2] = end - current[0]
+            continue
+        current = s
+        resolved.append(s)
+    return resolved
+
+class Composer:
+    """ Places templates onto a canvas and merges them into a pattern.
+
+    Each placement becomes a layer of the pattern. Templates placed several
+    times are loaded once.
+    """
+    def __init__(self):
+        self.placements = []
+        self._cache = {}
+
+    def load(self, path):
+        kogin = self._cache.get(path)
+        if kogin is None:
+            kogin = Kogin(path)
+            self._cache[path] = kogin
+        return kogin
+
+    def add(self, kogin, x, y, hmirror=False, vmirror=False, name=None):
+        """ Places the template with the left top of its bbox at x, y. """
+        if name is None:
+            stem = os.path.splitext(os.path.basename(kogin.path or 'template'))[0]
+            name = '{} {}'.format(stem, len(self.placements) + 1)
+        self.placements.append((kogin, x, y, hmirror, vmirror, name))
+
+    def _placedStitches(self, layer, placement):
+        kogin, x, y, hmirror, vmirror, name = placement
+        data = kogin.getData()
+        flat = data.flat()
+        left, top, width, height = data.bbox()
+        stitches = []
+        for r in range(len(flat.refs)):
+            length = flat.lengths[r]
+            color = flat.colors[r]
+            for sx, sy in zip(flat.xs[r], flat.ys[r]):
+                if hmirror:
+                    sx = 2 * left + width - sx - length
+                if vmirror:
+                    sy = 2 * top + height - 1 - sy
+                stitches.append([sx - left + x, sy - top + y, length, color, layer])
+        return stitches
+
+    def _placedPivots(self, placement):
+        kogin, x, y, hmirror, vmirror, name = placement
+        data = kogin.getData()
+        left, top, width, height = data.bbox()
+        pivots = []
+        for pivot in data.pivots():
+            px, py = pivot[0], pivot[1]
+            if hmirror:
+                px = 2 * left + width - 1 - px
+            if vmirror:
+                py = 2 * top + height - 1 - py
+            pivots.append([px - left + x, py - top + y])
+        return pivots
+
+    def composeData(self):
+        """ Returns kogin-data of the merged pattern. """
+        stitches = []
+        pivots = []
+        for layer, placement in enumerate(self.placements):
+            stitches.extend(self._placedStitches(layer, placement))
+            for pivot in self._placedPivots(placement):
+                if not pivot in pivots:
+                    pivots.append(pivot)
+        stitches = resolve_overlaps(stitches)
+
+        layers = []
+        refs = [{} for _ in self.placements]
+        for name in (placement[5] for placement in self.placements):
+            layers.append({'layer': True, 'name': name, 'visible': True, 'locked': False,
+                           'x': 0, 'y': 0, 'children': []})
+        colors = {}
+        for x, y, length, color, layer in stitches:
+            ref = '{}-{}'.format(length, color)
+            coords = refs[layer].get(ref)
+            if coords is None:
+                coords = []
+                refs[layer][ref] = coords
+                layers[layer]['children'].append({'ref': ref, 'coords': coords})
+            coords.append([x, y])
+            lengthColors = colors.setdefault(length, [])
+            if not '#' + color in lengthColors:
+                lengthColors.append('#' + color)
+
+        if stitches:
+            left = min(s[0] for s in stitches)
+            top = min(s[1] for s in stitches)
+            right = max(s[0] + s[2] for s in stitches)
+            bottom = max(s[1] for s in stitches) + 1
+            bbox = [left, top, right - left, bottom - top]
+        else:
+            bbox = [0, 0, 0, 0]
+        return {
+            'application': 'kogin',
+            'data': layers,
+            'defs': {'single': [{'length': str(length), 'colors': colors[length]}
+                                for length in sorted(colors)]},
+            'pivots': pivots,
+            'bbox': bbox,
+        }
+
+    def compose(self, option=None, metadata=None):
+        """ Returns Kogin of the merged pattern.
+
+        Option and metadata of the first placed template are used if not specified.
+        Output bounds are set to the merged bbox and not used, the schema version
+        and the data format of the template are not taken, as in Kogin.mergeOption.
+        """
+        import copy
+        if not self.placements:
+            raise Exception('No template placed')
+        first = self.placements[0][0]
+        if option is None:
+            option = first.getOption().getData()
+        if metadata is None:
+            metadata = first.getMetadata()
+        data = self.composeData()
+        option = copy.deepcopy({key: value for key, value in option.items()
+                                if key != SCHEMA_VERSION_KEY and key != DATA_FORMAT_KEY})
+        left, top, width, height = data['bbox']
+        bounds = option.setdefault('bounds', {})
+        bounds.update({
+            'useOutputBounds': False,
+            'boundsLeft': left,
+            'boundsTop': top,
+            'boundsRight': left + width - 1,
+            'boundsBottom': top + height - 1,
+        })
+        return Kogin.create(data, option, copy.deepcopy(metadata))
+
+def compose_layout(path):
+    """ Composes pattern from layout file.
+
+    The layout is a JSON object with list of placements in "items", each of
+    them has "path", "x", "y" and optional "hmirror", "vmirror" and "name".
+    "option" is path to a template for options and "metadata" overrides
+    metadata. Paths are relative to the layout file.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        layout = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    composer = Composer()
+    for item in layout['items']:
+        composer.add(composer.load(join(base, item['path'])), item.get('x', 0), item.get('y', 0),
+                     item.get('hmirror', False), item.get('vmirror', False), item.get('name'))
+
+    option = None
+    if 'option' in layout:
+        option = composer.load(join(base, layout['option'])).getOption().getData()
+    metadata = None
+    if 'metadata' in layout:
+        metadata = dict(composer.placements[0][0].getMetadata()) if composer.placements else {}
+        metadata.update(layout['metadata'])
+    return composer.compose(option, metadata)
+
+HASH_MOD = (1 << 61) - 1
+HASH_ROW_BASE = 1000003
+HASH_COL_BASE = 999331
+
+class StitchRaster:
+    """ Normalized stitches rasterized into rows of cells.
+
+    Each cell holds the length of the stitch starting there, 0 if empty.
+    """
+    def __init__(self, stitches):
+        stitches = list(stitches)
+        if stitches:
+            self.left = min(x for x, _, _ in stitches)
+            self.top = min(y for _, y, _ in stitches)
+            self.width = max(x + length for x, _, length in stitches) - self.left
+            self.height = max(y for _, y, _ in stitches) + 1 - self.top
+        else:
+            self.left = self.top = self.width = self.height = 0
+        self.rows = [[0] * self.width for _ in range(self.height)]
+        for x, y, length in stitches:
+            self.rows[y - self.top][x - self.left] = length
+
+    def hash(self):
+        h = 0
+        for row in self.rows:
+            rh = 0
+            for v in row:
+                rh = (rh * HASH_ROW_BASE + v) % HASH_MOD
+            h = (h * HASH_COL_BASE + rh) % HASH_MOD
+        return h
+
+    def matches(self, template, x, y):
+        width = template.width
+        for j, row in enumerate(template.rows):
+            if self.rows[y + j][x:x + width] != row:
+                return False
+        return True
+
+    def find(self, template):
+        """ Returns list of (x, y) where template appears, in normalized coordinates. """
+        width = template.width
+        height = template.height
+        if width == 0 or width > self.width or height > self.height:
+            return []
+        target = template.hash()
+        count = self.width - width + 1
+
+        # hash of each window of width in each row
+        rowPow = pow(HASH_ROW_BASE, width - 1, HASH_MOD)
+        rowHashes = []
+        for row in self.rows:
+            h = 0
+            for v in row[:width]:
+                h = (h * HASH_ROW_BASE + v) % HASH_MOD
+            hashes = [h]
+            for i in range(width, self.width):
+                h = ((h - row[i - width] * rowPow) * HASH_ROW_BASE + row[i]) % HASH_MOD
+                hashes.append(h)
+            rowHashes.append(hashes)
+
+        # rolls window of height over row hashes
+        colPow = pow(HASH_COL_BASE, height - 1, HASH_MOD)
+        found = []
+        hashes = [0] * count
+        for j in range(height):
+            rh = rowHashes[j]
+            hashes = [(h * HASH_COL_BASE + v) % HASH_MOD for h, v in zip(hashes, rh)]
+        y = 0
+        while True:
+            for x, h in enumerate(hashes):
+                if h == target and self.matches(template, x, y):
+                    found.append((x + self.left, y + self.top))
+            if y + height >= self.height:
+                break
+            removed = rowHashes[y]
+            added = rowHashes[y + height]
+            hashes = [((h - r * colPow) * HASH_COL_BASE + a) % HASH_MOD
+                      for h, r, a in zip(hashes, removed, added)]
+            y += 1
+        return found
+
+def find_in_file(template, path):
+    """ Returns (path, list of absolute (x, y) where template appears, error). """
+    try:
+        kogin = Kogin(path)
+        raster = StitchRaster(normalized_stitches(kogin))
+        left, top = kogin.getData().bbox()[0:2]
+        return (path, [(x + left, y + top) for x, y in raster.find(template)], None)
+    except Exception as e:
+        return (path, [], str(e))
+
+STITCH_TABLE_MAGIC = b'KGST'
+STITCH_TABLE_VERSION = 1
+# name, array type code, all little endian
+STITCH_TABLE_COLUMNS = (
+    ('template', 'I'),
+    ('layer', 'H'),
+    ('x', 'i'),
+    ('y', 'i'),
+    ('length', 'H'),
+    ('color', 'I'),
+)
+
+def _align8(n):
+    return (n + 7) & ~7
+
+def _checkCoordinates(values, name):
+    # columns are 32 bit integers
+    for value in values:
+        if type(value) is not int or not -0x80000000 <= value <= 0x7fffffff:
+            raise Exception('Invalid {} coordinate: {!r}'.format(name, value))
+
+def stitch_columns(path):
+    """ Returns stitches of the file as columns for the stitch table.
+
+    Returns (path, info, colors, columns, error), color column refers to
+    the index of colors of this file and template column is empty.
+    Files with coordinates which are not integers are reported as error.
+    """
+    from array import array
+    try:
+        kogin = Kogin(path)
+        data = kogin.getData()
+        flat = data.flat()
+        layerColumn = array('H')
+        xColumn = array('i')
+        yColumn = array('i')
+        lengthColumn = array('H')
+        colorColumn = array('I')
+        colors = []
+        colorIndex = {}
+        for r, xs in enumerate(flat.xs):
+            _checkCoordinates(xs, 'x')
+            _checkCoordinates(flat.ys[r], 'y')
+        for r, xs in enumerate(flat.xs):
+            color = flat.colors[r]
+            index = colorIndex.get(color)
+            if index is None:
+                index = len(colors)
+                colorIndex[color] = index
+                colors.append(color)
+            count = len(xs)
+            layerColumn.extend(flat.groupLayer[g] for g in flat.gs[r])
+            xColumn.extend(xs)
+            yColumn.extend(flat.ys[r])
+            lengthColumn.extend([flat.lengths[r]] * count)
+            colorColumn.extend([index] * count)
+        info = {
+            'name': os.path.basename(path),
+            'metadata': kogin.getMetadata(),
+            'bbox': data.bbox(),
+            'layers': [flat.groups[g].get('name', '') for g in flat.layers],
+        }
+        columns = {
+            'layer': layerColumn, 'x': xColumn, 'y': yColumn,
+            'length': lengthColumn, 'color': colorColumn,
+        }
+        return (path, info, colors, columns, None)
+    except Exception as e:
+        return (path, None, [], {}, str(e))
+
+def write_stitch_table(out, results):
+    """ Writes list of results of stitch_columns into the file.
+
+    The file starts with the magic, version, length of the header and
+    the header in JSON, which lists templates, colors and columns with
+    their offset from the end of the header aligned to 8 bytes.
+    Each column is aligned to 8 bytes.
+    """
+    import struct
+    from array import array
+
+    templates = []
+    colors = []
+    colorIndex = {}
+    parts = []
+    for path, info, fileColors, columns, error in results:
+        if error:
+            continue
+        mapping = []
+        for color in fileColors:
+            index = colorIndex.get(color)
+            if index is None:
+                index = len(colors)
+                colorIndex[color] = index
+                colors.append(color)
+            mapping.append(index)
+        count = len(columns['x'])
+        columns['color'] = array('I', [mapping[c] for c in columns['color']])
+        columns['template'] = array('I', [len(templates)]) * count
+        templates.append(info)
+        parts.append(columns)
+
+    count = sum(len(columns['x']) for columns in parts)
+    header = {
+        'count': count,
+        'templates': templates,
+        'colors': colors,
+        'columns': [],
+    }
+    offset = 0
+    for name, typecode in STITCH_TABLE_COLUMNS:
+        size = array(typecode).itemsize * count
+        header['columns'].append({'name': name, 'type': typecode, 'offset': offset, 'size': size})
+        offset = _align8(offset + size)
+    headerBytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    base = _align8(12 + len(headerBytes))
+
+    with open(out, 'wb') as f:
+        f.write(STITCH_TABLE_MAGIC)
+        f.write(struct.pack('<II', STITCH_TABLE_VERSION, len(headerBytes)))
+        f.write(headerBytes)
+        for column in header['columns']:
+            f.write(b'\0' * (base + column['offset'] - f.tell()))
+            for columns in parts:
+                values = columns[column['name']]
+                if sys.byteorder != 'little':
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                values.tofile(f)
+    return header
+
+class StitchTable:
+    """ Memory mapped stitch table written by export-stitches.
+
+    Columns are memoryviews over the file, in native byte order of
+    little endian machines.
+    """
+    def __init__(self, path):
+        import mmap
+        import struct
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[0:4] != STITCH_TABLE_MAGIC:
+            raise Exception('Not a stitch table')
+        version, length = struct.unpack_from('<II', self._map, 4)
+        if version != STITCH_TABLE_VERSION:
+            raise Exception('Unknown version of stitch table: {}'.format(version))
+        self.header = json.loads(bytes(self._map[12:12 + length]).decode('utf-8'))
+        self.templates = self.header['templates']
+        self.colors = self.header['colors']
+        self.columns = {}
+        base = _align8(12 + length)
+        view = memoryview(self._map)
+        for column in self.header['columns']:
+            offset = base + column['offset']
+            self.columns[column['name']] = view[offset:offset + column['size']].cast(column['type'])
+
+    def __len__(self):
+        return self.header['count']
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self._map.close()
+        self._file.close()
+
+
+VERTEX_BUFFER_MAGIC = b'KGVB'
+VERTEX_BUFFER_VERSION = 1
+
+class VertexBufferWriter(Writer):
+    """ Writes stitches and grid as line segments in packed buffers.
+
+    Positions are Float32 x, y of both ends of each segment in the coordinates
+    of the image written by Writer with the same options, colors are Uint16
+    index of the color in the header for each vertex. Ranges in the header
+    list segments of the grid and layers in drawing order with their line
+    width. Text like numbering is not included.
+    """
+    def export(self, out, forPrinting=False, viewMode=None):
+        from array import array
+        self._setup(forPrinting, viewMode)
+        op = self.op
+        self.positions = array('f')
+        self.vertexColors = array('H')
+        self.colors = []
+        self._colorIndex = {}
+        self.ranges = []
+        # numbering margin is given by translation of the parent group
+        self.originX = self.horiMargin if op.gridNumber else 0
+        self.originY = self.vertMargin if op.gridNumber else 0
+
+        if op.showGrid and not op.overGrid:
+            self._addGrid(op.width, op.height)
+        self._addLayers()
+        if op.showGrid and op.overGrid:
+            self._addGrid(op.width, op.height)
+
+        header = {
+            'version': VERTEX_BUFFER_VERSION,
+            'width': op.width + (self.horiMargin * 2 if op.gridNumber else 0),
+            'height': op.height + (self.vertMargin * 2 if op.gridNumber else 0),
+            'unit': 'mm' if op.forPrinting else 'px',
+            'viewMode': op.viewMode,
+            'lineCap': op.lineCap,
+            'background': op.backgroundColor if op.setBackground else None,
+            'clip': self._clipRect() if op.useOutputBounds else None,
+            'colors': self.colors,
+            'ranges': self.ranges,
+            'count': len(self.positions) // 4,
+            'buffers': [],
+        }
+        self._write(out, header, [('positions', self.positions), ('colors', self.vertexColors)])
+        return header
+
+    def _write(self, out, header, buffers):
+        import struct
+        from array import array
+        offset = 0
+        for name, values in buffers:
+            size = values.itemsize * len(values)
+            header['buffers'].append({'name': name, 'type': values.typecode, 'offset': offset, 'size': size})
+            offset = _align8(offset + size)
+        headerBytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        base = _align8(12 + len(headerBytes))
+
+        with open(out, 'wb') as f:
+            f.write(VERTEX_BUFFER_MAGIC)
+            f.write(struct.pack('<II', VERTEX_BUFFER_VERSION, len(headerBytes)))
+            f.write(headerBytes)
+            for (name, values), info in zip(buffers, header['buffers']):
+                f.write(b'\0' * (base + info['offset'] - f.tell()))
+                if sys.byteorder != 'little':
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                values.tofile(f)
+
+    def _color(self, color):
+        index = self._colorIndex.get(color)
+        if index is None:
+            index = len(self.colors)
+            self._colorIndex[color] = index
+            self.colors.append(color)
+        return index
+
+    def _beginRange(self, name, kind, width, visible=True):
+        self.ranges.append({'name': name, 'kind': kind, 'first': len(self.positions) // 4,
+                            'count': 0, 'width': width, 'visible': visible})
+
+    def _endRange(self):
+        current = self.ranges[-1]
+        current['count'] = len(self.positions) // 4 - current['first']
+
+    def _addSegment(self, x1, y1, x2, y2, color):
+        self.positions.extend((x1 + self.originX, y1 + self.originY,
+                               x2 + self.originX, y2 + self.originY))
+        self.vertexColors.extend((color, color))
+
+    def _clipRect(self):
+        op = self.op
+        return [
+            self.originX + op.leftMargin * op.gridWidth,
+            self.originY + op.topMargin * op.gridHeight,
+            op.width - (op.leftMargin + op.rightMargin) * op.gridWidth,
+            op.height - (op.topMargin + op.bottomMargin) * op.gridHeight,
+        ]
+
+    def _addLayers(self):
+        op = self.op
+        flat = self._flat
+        gridWidth = op.gridWidth
+        gridHeight = op.gridHeight
+        offsetX = op.offsetX
+        offsetY = op.offsetY
+        # same lines as the stitch definitions used by Writer, refs without
+        # definition are not drawn
+        defs = {}
+        for id, length, color in self._stitchDefs:
+            start, end = op.posCalc.calc(0, 0, length, op.forPrinting)
+            defs[id] = ((start.x, start.y, end.x, end.y),
+                        self._color('#000000' if op.monochrome else color))
+        lines = [defs.get(ref) for ref in flat.refs]
+
+        for layer, index in enumerate(flat.layers):
+            group = flat.groups[index]
+            self._beginRange(group.get('name', 'group'), 'layer', op.strokeWidth, group.get('visible', True))
+            for g, r, start, end in flat.runs:
+                if flat.groupLayer[g] != layer:
+                    continue
+                groupX = flat.groupX[g]
+                groupY = flat.groupY[g]
+                # translation of the groups and position of the use
+                tx = groupX * gridWidth - offsetX
+                ty = groupY * gridHeight - offsetY
+                if lines[r] is None:
+                    continue
+                (x1, y1, x2, y2), color = lines[r]
+                for cx, cy in zip(flat.xs[r][start:end], flat.ys[r][start:end]):
+                    x = tx + floor((cx - groupX) * gridWidth)
+                    y = ty + floor((cy - groupY) * gridHeight)
+                    self._addSegment(x + x1, y + y1, x + x2, y + y2, color)
+            self._endRange()
+
+    def _addGrid(self, width, height):
+        # segments of the paths written by _writeGridByPath
+        op = self.op
+        gridWidth = op.gridWidth
+        gridHeight = op.gridHeight
+        if gridWidth <= 0 or gridHeight <= 0 or width <= 0 or height <= 0:
+            return
+        gridStart = op.gridLineWidth / 2
+        lineColor = self._color(op.gridLineColor)
+        majorColor = self._color(op.gridMajorLineColor)
+
+        self._beginRange('grid', 'grid', op.gridLineWidth)
+        self._addGridLines(gridStart, gridStart, 0, gridWidth, width, height, True, lineColor)
+        self._addGridLines(gridStart, gridStart, 0, gridHeight, width, height, False, lineColor)
+        self._endRange()
+
+        self._beginRange('grid-major', 'grid', op.gridLineWidth)
+        if op.showGridFrame:
+            right = width - gridStart
+            bottom = height - gridStart
+            self._addSegment(gridStart, gridStart, right, gridStart, majorColor)
+            self._addSegment(right, gridStart, right, bottom, majorColor)
+            self._addSegment(right, bottom, gridStart, bottom, majorColor)
+            self._addSegment(gridStart, bottom, gridStart, gridStart, majorColor)
+        if op.showGridMajorLine and op.gridMajorLineFrequency > 0:
+            horiDistance = gridWidth * op.gridMajorLineFrequency
+            vertDistance = gridHeight * op.gridMajorLineFrequency
+            if horiDistance > 0:
+                start = gridStart + gridWidth * op.gridMajorHoriOffset
+                self._addGridLines(start, gridStart, start, horiDistance, width, height, True, majorColor)
+            if horiDistance > 0 and vertDistance > 0:
+                start = gridStart + gridHeight * op.gridMajorVertOffset
+                self._addGridLines(start, gridStart, start, vertDistance, width, height, False, majorColor)
+        self._endRange()
+
+    def _addGridLines(self, start, lineStart, current, distance, width, height, vertical, color):
+        # the first line starts from lineStart, the others from 0 by relative moves
+        end = width if vertical else height
+        position = start
+        first = True
+        while current <= end:
+            if vertical:
+                self._addSegment(position, lineStart if first else 0, position, height, color)
+            else:
+                self._addSegment(lineStart if first else 0, position, width, position, color)
+            first = False
+            position += distance
+            current += distance
+
+def read_vertex_buffer(path):
+    """ Returns (header, positions, colors) of the file written by VertexBufferWriter. """
+    import struct
+    from array import array
+    with open(path, 'rb') as f:
+        content = f.read()
+    if content[0:4] != VERTEX_BUFFER_MAGIC:
+        raise Exception('Not a vertex buffer')
+    version, length = struct.unpack_from('<II', content, 4)
+    if version != VERTEX_BUFFER_VERSION:
+        raise Exception('Unknown version of vertex buffer: {}'.format(version))
+    header = json.loads(content[12:12 + length].decode('utf-8'))
+    base = _align8(12 + length)
+    buffers = {}
+    for info in header['buffers']:
+        values = array(info['type'])
+        offset = base + info['offset']
+        values.frombytes(content[offset:offset + info['size']])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        buffers[info['name']] = values
+    return (header, buffers['positions'], buffers['colors'])
+
+
+INDEX_NAME = '.kogin-index.json'
+INDEX_VERSION = 1
+INDEX_FIELDS = ('title', 'title-en', 'author', 'copyright', 'keyword', 'description', 'type')
+# latin words and runs of other letters like Japanese
+TOKEN_EXP = r'([0-9a-z]+)|([^\W\d_a-z]+)'
+
+def normalize_text(text):
+    import unicodedata
+    return unicodedata.normalize('NFKC', text).lower()
+
+def tokenize_text(text):
+    """ Returns set of tokens, latin words and 1, 2-grams of the other letters. """
+    tokens = set()
+    for m in re.finditer(TOKEN_EXP, normalize_text(text)):
+        word, letters = m.groups()
+        if word:
+            tokens.add(word)
+        else:
+            tokens.update(letters)
+            tokens.update(letters[i:i + 2] for i in range(len(letters) - 1))
+    return tokens
+
+def index_entry(path):
+    """ Returns (name, entry) with metadata fields and facets of the file. """
+    name = os.path.basename(path)
+    st = os.stat(path)
+    entry = {'mtime': st.st_mtime_ns, 'size': st.st_size}
+    try:
+        with open(path, 'rb') as f:
+            sections = SVGSections(f.read())
+        metadata = sections['kogin-metadata'] if 'kogin-metadata' in sections else {}
+        entry['fields'] = {key: metadata[key] for key in INDEX_FIELDS
+                           if isinstance(metadata.get(key), str) and metadata[key]}
+        data = KoginData(sections['kogin-data'])
+        bbox = data.bbox()
+        entry['width'] = bbox[2]
+        entry['height'] = bbox[3]
+        entry['stitches'] = data.flat().count()
+    except Exception as e:
+        entry['error'] = str(e)
+    return (name, entry)
+
+class SearchIndex:
+    """ Inverted index of metadata of files in a directory.
+
+    Postings map a token to the field names and the file names, stored in
+    a JSON file next to the templates. Entries of files are kept while their
+    modification time and size are not changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.postings = {}
+        self._vocabulary = None
+
+    @classmethod
+    def load(cls, path):
+        index = cls(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return index
+        if data.get('version') == INDEX_VERSION:
+            index.files = data['files']
+            index.postings = data['postings']
+        return index
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'files': self.files, 'postings': self.postings},
+                      f, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+    def update(self, dir_path, jobs=None):
+        """ Reads changed files in the directory, returns (added, updated, removed). """
+        paths = {os.path.basename(path): path for path in list_files(dir_path)}
+        changed = []
+        for name, path in paths.items():
+            entry = self.files.get(name)
+            st = os.stat(path)
+            if entry is None or entry['mtime'] != st.st_mtime_ns or entry['size'] != st.st_size:
+                changed.append(path)
+        removed = [name for name in self.files if not name in paths]
+        added = len([path for path in changed if not os.path.basename(path) in self.files])
+
+        for name in removed:
+            del self.files[name]
+        for name, entry in map_files(index_entry, [(path,) for path in changed], jobs, 16):
+            self.files[name] = entry
+        self._buildPostings()
+        return (added, len(changed) - added, len(removed))
+
+    def _buildPostings(self):
+        postings = {}
+        for name in sorted(self.files):
+            for field, text in self.files[name].get('fields', {}).items():
+                for token in tokenize_text(text):
+                    postings.setdefault(token, {}).setdefault(field, []).append(name)
+        self.postings = postings
+        self._vocabulary = None
+
+    def _candidates(self, token, fields):
+        names = set()
+        for field, entries in self.postings.get(token, {}).items():
+            if fields is None or field in fields:
+                names.update(entries)
+        return names
+
+    def _lookup(self, term, fields):
+        # files which may contain the term, verified by the caller
+        names = None
+        for m in re.finditer(TOKEN_EXP, term):
+            word, letters = m.groups()
+            found = set()
+            if word:
+                # latin words match by prefix
+                if self._vocabulary is None:
+                    self._vocabulary = sorted(self.postings)
+                from bisect import bisect_left
+                i = bisect_left(self._vocabulary, word)
+                while i < len(self._vocabulary) and self._vocabulary[i].startswith(word):
+                    found |= self._candidates(self._vocabulary[i], fields)
+                    i += 1
+            elif len(letters) == 1:
+                found = self._candidates(letters, fields)
+            else:
+                found = self._candidates(letters[0:2], fields)
+                for i in range(1, len(letters) - 1):
+                    found &= self._candidates(letters[i:i + 2], fields)
+            names = found if names is None else names & found
+        return names
+
+    def search(self, query='', fields=None, facets=None):
+        """ Returns sorted names of files matching to all terms and facets.
+
+        Facets is dict of facet name to (minimum, maximum), None for no limit.
+        """
+        terms = normalize_text(query).split()
+        names = set(self.files)
+        for term in terms:
+            found = self._lookup(term, fields)
+            if found is not None:
+                names &= found
+
+        result = []
+        for name in sorted(names):
+            entry = self.files[name]
+            if 'error' in entry:
+                continue
+            if facets and not all(
+                    (low is None or low <= entry[key]) and (high is None or entry[key] <= high)
+                    for key, (low, high) in facets.items()):
+                continue
+            texts = [normalize_text(text) for field, text in entry['fields'].items()
+                     if fields is None or field in fields]
+            if all(any(term in text for text in texts) for term in terms):
+                result.append(name)
+        return result
+
+def index_path(path):
+    return join(path, INDEX_NAME) if os.path.isdir(path) else path
+
+
+# interval to check limits of supervised workers in seconds
+SUPERVISOR_POLL_INTERVAL = 0.1
+
+# connection to the supervisor in worker processes
+_stageConnection = None
+
+def set_stage(stage):
+    """ Tells the supervisor which stage of the task the worker is in. """
+    if _stageConnection is not None:
+        _stageConnection.send(('stage', stage))
+
+def resident_memory(pid):
+    """ Returns resident set size of the process in bytes, None if unknown. """
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _supervised_worker(func, conn):
+    global _stageConnection
+    _stageConnection = conn
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        try:
+            result = func(*task)
+        except Exception as e:
+            conn.send(('error', str(e)))
+        else:
+            conn.send(('done', result))
+
+class SupervisedWorker:
+    def __init__(self, func):
+        import multiprocessing
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_supervised_worker, args=(func, child), daemon=True)
+        self.process.start()
+        child.close()
+        self.index = None
+        self.stage = None
+        self.startTime = None
+
+    def assign(self, index, task):
+        import time
+        self.index = index
+        self.stage = 'start'
+        self.startTime = time.monotonic()
+        self.conn.send(task)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+class Supervisor:
+    """ Runs tasks in worker processes with limits of time and memory for each.
+
+    Worker exceeding the limit is killed and replaced, the task is recorded in
+    skipped with the stage reported by set_stage, and others carry on.
+    Tasks raising exception are recorded as well. Memory is resident set size,
+    which is only checked where /proc is available.
+    """
+    def __init__(self, jobs=None, timeout=None, memory=None):
+        self.jobs = jobs or os.cpu_count() or 1
+        # in seconds
+        self.timeout = timeout
+        # in bytes
+        self.memory = memory
+        self.skipped = []
+
+    def map(self, func, tasks, names=None):
+        """ Returns results of func(*task) for each task, None for skipped tasks. """
+        from multiprocessing.connection import wait
+        import time
+        results = [None] * len(tasks)
+        names = names or [str(task[0]) for task in tasks]
+        pending = list(range(len(tasks) - 1, -1, -1))
+        workers = [SupervisedWorker(func) for _ in range(min(self.jobs, len(tasks)))]
+
+        def skip(worker, reason, message=None, memory=None):
+            self.skipped.append({
+                'task': names[worker.index],
+                'stage': worker.stage,
+                'reason': reason,
+                'message': message,
+                'elapsed': round(time.monotonic() - worker.startTime, 3),
+                'memory': memory,
+            })
+            worker.index = None
+
+        def replace(worker):
+            worker.kill()
+            workers[workers.index(worker)] = SupervisedWorker(func)
+
+        try:
+            while True:
+                for worker in workers:
+                    if worker.index is None and pending:
+                        index = pending.pop()
+                        worker.assign(index, tasks[index])
+                busy = [worker for worker in workers if worker.index is not None]
+                if not busy:
+                    break
+
+                ready = wait([worker.conn for worker in busy], SUPERVISOR_POLL_INTERVAL)
+                for worker in busy:
+                    if not worker.conn in ready:
+                        continue
+                    try:
+                        kind, value = worker.conn.recv()
+                    except EOFError:
+                        # killed from outside, like by OOM killer
+                        worker.process.join()
+                        skip(worker, 'exited', 'exit code {}'.format(worker.process.exitcode))
+                        replace(worker)
+                        continue
+                    if kind == 'stage':
+                        worker.stage = value
+                    elif kind == 'done':
+                        results[worker.index] = value
+                        worker.index = None
+                    else:
+                        skip(worker, 'error', value)
+
+                now = time.monotonic()
+                for worker in list(workers):
+                    if worker.index is None:
+                        continue
+                    if self.timeout is not None and now - worker.startTime > self.timeout:
+                        skip(worker, 'timeout')
+                        replace(worker)
+                    elif self.memory is not None:
+                        memory = resident_memory(worker.process.pid)
+                        if memory is not None and memory > self.memory:
+                            skip(worker, 'memory', memory=memory)
+                            replace(worker)
+        finally:
+            for worker in workers:
+                worker.stop()
+        return results
+
+    def report(self, skippedFile=None):
+        """ Prints skipped tasks and writes them as JSON if skippedFile is specified. """
+        for entry in self.skipped:
+            print('Skipped: {} ({} in {} stage){}'.format(
+                entry['task'], entry['reason'], entry['stage'],
+                ': ' + entry['message'] if entry['message'] else ''))
+        if skippedFile:
+            with open(skippedFile, 'w', encoding='utf-8') as f:
+                json.dump({'skipped': self.skipped}, f, indent=1, ensure_ascii=False)
+
+def supervisor_from_args(args):
+    memory = args.max_memory * 1024 * 1024 if args.max_memory is not None else None
+    return Supervisor(args.jobs, args.timeout, memory)
+
+def add_supervisor_arguments(parser):
+    add_jobs_argument(parser)
+    parser.add_argument('--timeout',
+        help='Skips a file taking longer than the seconds.',
+        type=float, default=None)
+    parser.add_argument('--max-memory',
+        help='Skips a file when the worker uses more memory than the MB, where /proc is available.',
+        type=int, default=None)
+    parser.add_argument('--skipped',
+        help='Path to write report of skipped files as JSON.',
+        default=None)
+
+
+def hash(path):
+    return Normalizer(Kogin(path).getData(), threshold=PARALLEL_NORMALIZE_THRESHOLD).normalize()
+
+def hash_file(path):
+    """ Returns hash of the file, reporting stages to the supervisor. """
+    set_stage('load')
+    data = Kogin(path).getData()
+    set_stage('normalize')
+    return Normalizer(data).normalize()
+
+def signature_file(path):
+    set_stage('load')
+    data = Kogin(path).getData()
+    set_stage('signature')
+    return Normalizer(data).signature()
+
+def get_hash_list(path, shard=None, supervisor=None):
+    names = []
+    for name in sorted(os.listdir(path)):
         if name.endswith('.svg'):
-            h = hash(join(path, name))
-            if not h:
-                print('Warning: {} is broken or wrong format'.format(name))
+            if shard is not None and not in_shard(name, shard):
                 continue
-            listing.append((name, h))
+            names.append(name)
+    supervisor = supervisor or Supervisor()
+    skipped = len(supervisor.skipped)
+    hashes = supervisor.map(hash_file, [(join(path, name),) for name in names], names)
+    skippedNames = set(entry['task'] for entry in supervisor.skipped[skipped:])
+    listing = []
+    for name, h in zip(names, hashes):
+        if not h:
+            if not name in skippedNames:
+                print('Warning: {} is broken or wrong format'.format(name))
+            continue
+        listing.append((name, h))
+    return listing
+
+def find_repeated(path, supervisor=None):
+    """ Returns lists of names of files with the same normalized stitches.
+
+    Files are grouped by signature first, only files sharing the signature
+    with another are normalized to compare their hashes.
+    """
+    supervisor = supervisor or Supervisor()
+    names = sorted(name for name in os.listdir(path) if name.endswith('.svg'))
+    signatures = supervisor.map(signature_file, [(join(path, name),) for name in names], names)
+    buckets = {}
+    for name, signature in zip(names, signatures):
+        if signature is not None:
+            buckets.setdefault(signature, []).append(name)
+
+    candidates = [name for entries in buckets.values() if len(entries) > 1 for name in entries]
+    hashes = dict(zip(candidates, supervisor.map(
+        hash_file, [(join(path, name),) for name in candidates], candidates)))
+
+    checker = {}
+    for name in names:
+        h = hashes.get(name)
+        if h is not None:
+            checker.setdefault(h, []).append(name)
+    return [entries for entries in checker.values() if len(entries) > 1]
+
+def validate_data(data):
+    """ Returns (number of stitches outside of bbox, list of refs missing in defs). """
+    flat = data.flat()
+    left, top, width, height = data.bbox()
+    right = left + width
+    bottom = top + height
+    outside = 0
+    for r in range(len(flat.refs)):
+        length = flat.lengths[r]
+        for x, y in zip(flat.xs[r], flat.ys[r]):
+            if x < left or right < x + length or y < top or bottom <= y:
+                outside += 1
+
+    defined = set()
+    for d in data.defs().get('single', []):
+        for color in d.get('colors', []):
+            defined.add('{}-{}'.format(d.get('length'), color[1:]))
+    unknown = [ref for r, ref in enumerate(flat.refs) if flat.xs[r] and not ref in defined]
+    return (outside, unknown)
+
+def audit_file(path):
+    """ Loads the file once and returns its hash and findings as dict. """
+    report = {
+        'name': os.path.basename(path),
+        'hash': None,
+        'pivots': 0,
+        'outsideBBox': 0,
+        'unknownRefs': [],
+        'unresolvedOverlaps': 0,
+        'error': None,
+    }
+    try:
+        kogin = Kogin(path)
+        data = kogin.getData()
+        report['pivots'] = len(data.pivots())
+        report['outsideBBox'], report['unknownRefs'] = validate_data(data)
+        normalizer = kogin.normalizer()
+        report['hash'] = normalizer.normalize()
+        report['unresolvedOverlaps'] = normalizer.countConflicts()
+    except Exception as e:
+        report['error'] = '{}: {}'.format(type(e).__name__, e)
+    return report
+
+def audit(path, jobs=None):
+    """ Audits files in the directory.
+
+    Returns dict of reports for each file, groups of duplicated names,
+    names without pivots and names with findings.
+    """
+    reports = map_files(audit_file, [(file_path,) for file_path in list_files(path)], jobs)
+    reports.sort(key=itemgetter('name'))
+
+    hashes = {}
+    for report in reports:
+        if report['hash']:
+            hashes.setdefault(report['hash'], []).append(report['name'])
+    return {
+        'files': reports,
+        'duplicates': [names for names in hashes.values() if len(names) > 1],
+        'missingPivots': [report['name'] for report in reports
+                          if not report['error'] and not report['pivots']],
+        'invalid': [report['name'] for report in reports
+                    if report['error'] or not report['hash'] or report['outsideBBox'] or
+                    report['unknownRefs'] or report['unresolvedOverlaps']],
+    }
+
+def color_stats(data):
+    """ Returns dict of color to [number of stitches, total length in grids].
+
+    Stitches in hidden layers are not stitched, they are not counted.
+    """
+    flat = data.flat()
+    hidden = flat.hiddenGroups()
+    colors = {}
+    # stitches of a run share length and color, sums are taken per run
+    for g, r, start, end in flat.runs:
+        if g in hidden or start == end:
+            continue
+        entry = colors.setdefault('#' + flat.colors[r], [0, 0])
+        entry[0] += end - start
+        entry[1] += (end - start) * flat.lengths[r]
+    return colors
+
+def stats_file(path, gridWidth=None):
+    """ Returns thread usage of each color in the file as dict.
+
+    Physical length in mm is calculated with width of the grid for printing,
+    unless gridWidth is specified.
+    """
+    report = {
+        'name': os.path.basename(path),
+        'gridWidth': gridWidth,
+        'colors': [],
+        'error': None,
+    }
+    try:
+        kogin = Kogin(path)
+        if gridWidth is None:
+            report['gridWidth'] = gridWidth = kogin.getOption().gridPrint()['gridWidth']
+        for color, (stitches, length) in sorted(color_stats(kogin.getData()).items()):
+            report['colors'].append({
+                'color': color,
+                'stitches': stitches,
+                'length': length,
+                'lengthMM': round(length * gridWidth, 3),
+            })
+    except Exception as e:
+        report['error'] = '{}: {}'.format(type(e).__name__, e)
+    return report
+
+def thread_stats(path, gridWidth=None, jobs=None):
+    """ Returns reports of files in the directory and totals for each color. """
+    reports = map_files(stats_file, [(file_path, gridWidth) for file_path in list_files(path)], jobs)
+    reports.sort(key=itemgetter('name'))
+
+    totals = {}
+    for report in reports:
+        for entry in report['colors']:
+            total = totals.setdefault(entry['color'], {
+                'color': entry['color'], 'stitches': 0, 'length': 0, 'lengthMM': 0})
+            for key in ('stitches', 'length', 'lengthMM'):
+                total[key] += entry[key]
+            total['lengthMM'] = round(total['lengthMM'], 3)
+    return {
+        'files': reports,
+        'total': [totals[color] for color in sorted(totals)],
+    }
+
+def write_stats_csv(f, result):
+    """ Writes a row for each color of each file, total rows have empty name. """
+    import csv
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(['name', 'color', 'stitches', 'length', 'length_mm'])
+    for report in result['files']:
+        if report['error']:
+            continue
+        for entry in report['colors']:
+            writer.writerow([report['name'], entry['color'], entry['stitches'],
+                             entry['length'], format_number(entry['lengthMM'])])
+    for entry in result['total']:
+        writer.writerow(['', entry['color'], entry['stitches'], entry['length'],
+                         format_number(entry['lengthMM'])])
+
+def func_stats(args):
+    return cmd_stats(args.path, args.output, args.format, args.grid_width, args.jobs)
+
+def cmd_stats(path, output, outputFormat, gridWidth, jobs):
+    result = thread_stats(path, gridWidth, jobs)
+    f = open(output, 'w', newline='', encoding='utf-8') if output else sys.stdout
+    try:
+        if outputFormat == 'json':
+            f.write(json.dumps(result, indent=1, ensure_ascii=False))
+            f.write('\n')
+        else:
+            write_stats_csv(f, result)
+    finally:
+        if output:
+            f.close()
+    status = 0
+    for report in result['files']:
+        if report['error']:
+            print('Error: {}: {}'.format(report['name'], report['error']), file=sys.stderr)
+            status = 1
+    return status
+
+def func_audit(args):
+    return cmd_audit(args.path, args.output, args.jobs)
+
+def cmd_audit(path, output, jobs):
+    result = audit(path, jobs)
+    s = json.dumps(result, indent=1, ensure_ascii=False)
+    if output:
+        with open(output, 'w') as f:
+            f.write(s)
+    else:
+        print(s)
+    return 1 if result['invalid'] else 0
+
+def func_index(args):
+    cmd_index(args.path, args.index, args.jobs)
+
+def cmd_index(path, indexFile, jobs):
+    index = SearchIndex.load(indexFile or index_path(path))
+    added, updated, removed = index.update(path, jobs)
+    index.save()
+    print('{} files, {} added, {} updated, {} removed'.format(
+        len(index.files), added, updated, removed))
+
+def func_search(args):
+    facets = {
+        'width': (args.min_width, args.max_width),
+        'height': (args.min_height, args.max_height),
+        'stitches': (args.min_stitches, args.max_stitches),
+    }
+    facets = {key: value for key, value in facets.items() if value != (None, None)}
+    cmd_search(args.path, ' '.join(args.query), args.field, facets)
+
+def cmd_search(path, query, fields, facets):
+    index = SearchIndex.load(index_path(path))
+    for name in index.search(query, fields, facets):
+        entry = index.files[name]
+        print('{}\t{}'.format(name, entry['fields'].get('title', '')))
+
+def in_shard(name, shard):
+    """ Returns True if the file belongs to the shard (index, count).
+
+    Shard of each file depends only on its name, so adding files does not
+    move others between shards.
+    """
+    import zlib
+    index, count = shard
+    return zlib.crc32(name.encode('utf-8')) % count == index - 1
+
+def parse_shard(value):
+    try:
+        index, count = [int(v, 10) for v in value.split('/')]
+    except ValueError:
+        index = count = 0
+    if not 0 < index <= count:
+        import argparse
+        raise argparse.ArgumentTypeError('shard must be i/N with 1 <= i <= N: {}'.format(value))
+    return (index, count)
+
+def read_listing(listFile):
+    """ Returns list of (name, hash) in the listing file sorted by name. """
+    with open(listFile) as f:
+        lines = f.read().split('\n')
+    listing = [tuple(line.split('\t', 1)) for line in lines if line]
+    # nearly linear for sorted listings
     listing.sort(key=itemgetter(0))
     return listing
 
-def func_list(args):
-    cmd_list(args.path, args.list)
+def merge_listings(listings):
+    """ Merges listings sorted by name into one.
 
-def cmd_list(path, listFile):
-    listing = get_hash_list(path)
+    Returns (listing, lists of names with the same hash, names appearing
+    in more than one listing).
+    """
+    merged = []
+    checker = {}
+    duplicated = []
+    for name, h in heapq.merge(*listings, key=itemgetter(0)):
+        if merged and merged[-1][0] == name:
+            duplicated.append(name)
+            continue
+        merged.append((name, h))
+        checker.setdefault(h, []).append(name)
+    repeated = [entries for entries in checker.values() if len(entries) > 1]
+    return (merged, repeated, duplicated)
+
+def write_listing(listFile, listing):
     lines = ['{}\t{}'.format(name, h) for name, h in listing]
     with open(listFile, 'w') as f:
         f.write('\n'.join(lines))
 
+def func_list(args):
+    cmd_list(args.path, args.list, args.shard, supervisor_from_args(args), args.skipped)
+
+def cmd_list(path, listFile, shard=None, supervisor=None, skippedFile=None):
+    supervisor = supervisor or Supervisor()
+    write_listing(listFile, get_hash_list(path, shard, supervisor))
+    supervisor.report(skippedFile)
+
+def func_merge_lists(args):
+    return cmd_merge_lists(args.list, args.lists)
+
+def cmd_merge_lists(listFile, listFiles):
+    listing, repeated, duplicated = merge_listings([read_listing(path) for path in listFiles])
+    write_listing(listFile, listing)
+    if repeated:
+        print('Repeated')
+        for entries in repeated:
+            print(', '.join(entries))
+    for name in duplicated:
+        print('Error: {} is listed in more than one listing'.format(name))
+    return 1 if duplicated else 0
+
 def func_check(args):
     cmd_check(args.path, args.list)
 
@@ -1078,7 +4139,7 @@ def cmd_check(path, listFile):
     h = hash(path)
     if not h:
         print('Error: {} is broken'.format(path))
-        os.exit(1)
+        sys.exit(1)
 
     if h in hashMap:
         'exists'
@@ -1092,31 +4153,36 @@ def cmd_hash(path):
     h = hash(path)
     if not h:
         print('Error: {} is broken'.format(path))
-        os.exit(1)
+        sys.exit(1)
     print(h)
 
 def func_repeated(args):
-    cmd_repeated(args.path)
-
-def cmd_repeated(path):
-    listing = get_hash_list(path)
-    checker = {}
-    for (name, h) in listing:
-        entries = checker.get(h, [])
-        entries.append(name)
-        if len(entries) == 1:
-            checker[h] = entries
+    cmd_repeated(args.path, supervisor_from_args(args), args.skipped)
 
-    if len(listing) == len(checker):
+def cmd_repeated(path, supervisor=None, skippedFile=None):
+    supervisor = supervisor or Supervisor()
+    groups = find_repeated(path, supervisor)
+    supervisor.report(skippedFile)
+    if not groups:
         print('Nothing repeated.')
         return
     print('Repeated')
-    for h, entries in checker.items():
-        if len(entries) > 1:
-            print(', '.join(entries))
+    for entries in groups:
+        print(', '.join(entries))
 
 def func_pivots(args):
-    cmd_pivots(args.path)
+    if args.compute:
+        cmd_compute_pivots(args.path, args.all, args.dry_run, args.jobs)
+    else:
+        cmd_pivots(args.path)
+
+def cmd_compute_pivots(path, overwrite, dryRun, jobs):
+    results = map_files(pivots_file, [(file_path, overwrite, dryRun) for file_path in list_files(path)], jobs)
+    for file_path, pivots, error in results:
+        if error:
+            print('Error: {}: {}'.format(file_path, error))
+        elif pivots is not None:
+            print('{}\t{}'.format(os.path.basename(file_path), json.dumps(pivots) if pivots else 'no symmetry'))
 
 def cmd_pivots(path):
     for name in os.listdir(path):
@@ -1125,27 +4191,231 @@ def cmd_pivots(path):
             if not kogin.getData().pivots():
                 print(name)
 
-def func_update(args):
-    cmd_update(args.path, args.dir_path, args.print)
-
-def cmd_update(path, dir_path, forPrinting):
-    base = Kogin(path)
-    for name in os.listdir(dir_path):
-        if name.endswith('.svg'):
-            file_path = join(dir_path, name)
-            kogin = Kogin(file_path)
-            kogin.mergeOption(base)
-            try:
-                s = Writer(kogin).write()
-            except Exception as e:
-                print(e)
-                print(file_path)
-                continue
-            with open(file_path, 'w') as f:
-                f.write(s)
-
+def update_file(path, base_path, forPrinting=False, tiling=False, minify=False, cacheDir=None):
+    """ Rewrites the file with options of the base file. """
+    set_stage('load')
+    kogin = Kogin(path)
+    kogin.mergeOption(Kogin(base_path))
+    set_stage('render')
+    s = Writer(kogin, tiling, minify, LayerCache(cacheDir) if cacheDir else None).write(forPrinting)
+    set_stage('write')
+    # the worker can be killed at any time, the file is replaced at once
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp, 'w') as f:
+        f.write(s)
+    os.replace(temp, path)
+    return True
 
-def main():
+def func_update(args):
+    cmd_update(args.path, args.dir_path, args.print, args.tile, args.minify,
+               supervisor_from_args(args), args.skipped, args.cache)
+
+def cmd_update(path, dir_path, forPrinting, tiling=False, minify=False, supervisor=None, skippedFile=None,
+               cacheDir=None):
+    # base file is read by each worker, fails here if broken
+    Kogin(path)
+    supervisor = supervisor or Supervisor()
+    files = [join(dir_path, name) for name in sorted(os.listdir(dir_path)) if name.endswith('.svg')]
+    supervisor.map(update_file, [(file_path, path, forPrinting, tiling, minify, cacheDir) for file_path in files])
+    supervisor.report(skippedFile)
+
+def render_variants(path, variants, tiling=False, minify=False, layerCache=None):
+    """ Renders the file for list of (viewMode, forPrinting) in single pass. """
+    return Writer(Kogin(path), tiling, minify, layerCache).writeVariants(variants)
+
+def parse_view_mode(name):
+    for key, value in VIEW_MODES.items():
+        if key.lower() == name.lower():
+            return value
+    try:
+        viewMode = int(name, 10)
+    except ValueError:
+        viewMode = -1
+    if not viewMode in PositionCalculator.CLASSES:
+        import argparse
+        raise argparse.ArgumentTypeError('unknown view mode: {}'.format(name))
+    return viewMode
+
+def func_render(args):
+    cmd_render(args.path, args.out_dir, args.mode, args.target, args.tile, args.minify, args.cache)
+
+def cmd_render(path, out_dir, viewModes, target, tiling=False, minify=False, cacheDir=None):
+    if not viewModes:
+        viewModes = list(PositionCalculator.CLASSES.keys())
+    targets = [False, True] if target == 'both' else [target == 'print']
+    variants = [(viewMode, forPrinting) for viewMode in viewModes for forPrinting in targets]
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    layerCache = LayerCache(cacheDir) if cacheDir else None
+    for (viewMode, forPrinting), s in zip(variants, render_variants(path, variants, tiling, minify, layerCache)):
+        name = '{}-{}-{}.svg'.format(stem, PositionCalculator.CLASSES[viewMode].__name__,
+                                     'print' if forPrinting else 'screen')
+        with open(join(out_dir, name), 'w') as f:
+            f.write(s)
+
+
+def list_files(path):
+    if os.path.isdir(path):
+        return [join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.svg')]
+    return [path]
+
+def _apply(task):
+    func, args = task
+    return func(*args)
+
+def map_files(func, tasks, jobs=None, chunksize=8):
+    """ Returns results of func(*task) for each task run in a process pool.
+
+    A single task runs in this process. Functions catch errors of each file
+    and return them in the result, Supervisor is used for limits.
+    """
+    if len(tasks) <= 1:
+        return [func(*task) for task in tasks]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(_apply, [(func, task) for task in tasks], chunksize=chunksize))
+
+def add_jobs_argument(parser):
+    parser.add_argument('-j', '--jobs',
+        help='Number of worker processes.',
+        type=int, default=None)
+
+def func_migrate(args):
+    cmd_migrate(args.path, args.to, args.dry_run, args.jobs)
+
+def cmd_migrate(path, version, dryRun, jobs):
+    results = migrate_files(list_files(path), version, dryRun, jobs)
+    migrated = 0
+    errors = 0
+    for file_path, current, applied, error in results:
+        if error:
+            errors += 1
+            print('Error: {}: {}'.format(file_path, error))
+        elif applied:
+            migrated += 1
+            print('{}\t{} -> {}\t{}'.format(file_path, current, version, ', '.join(applied)))
+    print('{} {}, {} up to date, {} errors'.format(
+        'To be migrated' if dryRun else 'Migrated', migrated,
+        len(results) - migrated - errors, errors))
+
+def func_pack(args):
+    cmd_pack(args.path, DATA_FORMAT_JSON if args.unpack else DATA_FORMAT_PACKED,
+             args.dry_run, args.jobs)
+
+def cmd_pack(path, dataFormat, dryRun, jobs):
+    results = map_files(pack_file, [(file_path, dataFormat, dryRun) for file_path in list_files(path)], jobs, 16)
+    before = 0
+    after = 0
+    for file_path, old, new, error in results:
+        if error:
+            print('Error: {}: {}'.format(file_path, error))
+        else:
+            before += old
+            after += new
+            print('{}\t{} -> {}'.format(file_path, old, new))
+    print('Data size: {} -> {}'.format(before, after))
+
+def func_compose(args):
+    cmd_compose(args.layout, args.output, args.print, args.tile, args.minify)
+
+def cmd_compose(layout, output, forPrinting, tiling, minify):
+    s = Writer(compose_layout(layout), tiling, minify).write(forPrinting)
+    with open(output, 'w', encoding='utf-8') as f:
+        f.write(s)
+
+def func_diff(args):
+    cmd_diff(args.path1, args.path2, args.output, args.verbose)
+
+def cmd_diff(path1, path2, output, verbose):
+    kogin = Kogin(path2)
+    d = diff_kogins(Kogin(path1), kogin)
+
+    print('added: {}'.format(len(d.added)))
+    print('removed: {}'.format(len(d.removed)))
+    print('extended: {}'.format(len(d.extended)))
+    print('shortened: {}'.format(len(d.shortened)))
+    print('unchanged: {}'.format(len(d.unchanged)))
+    if verbose:
+        for x, y, length in d.added:
+            print('+ {},{} {}'.format(x, y, length))
+        for x, y, length in d.removed:
+            print('- {},{} {}'.format(x, y, length))
+        for x, y, old, new in d.extended + d.shortened:
+            print('~ {},{} {} -> {}'.format(x, y, old, new))
+
+    if output:
+        grid = kogin.getOption().gridScreen()
+        s = DiffWriter(d, grid['gridWidth'], grid['gridHeight']).write()
+        with open(output, 'w') as f:
+            f.write(s)
+
+def func_find(args):
+    cmd_find(args.template, args.path, args.jobs)
+
+def cmd_find(template_path, path, jobs):
+    template = StitchRaster(normalized_stitches(Kogin(template_path)))
+    if template.width == 0:
+        print('Error: {} has no stitch'.format(template_path))
+        sys.exit(1)
+    results = map_files(find_in_file, [(template, file_path) for file_path in list_files(path)], jobs)
+    found = 0
+    for file_path, positions, error in results:
+        if error:
+            print('Error: {}: {}'.format(file_path, error))
+        elif positions:
+            found += 1
+            print('{}\t{}'.format(file_path, ' '.join('{},{}'.format(x, y) for x, y in positions)))
+    if not found:
+        print('Not found.')
+
+def pdf_file(path, out, viewMode=None):
+    """ Writes PDF of the file, returns (path, error). """
+    try:
+        PDFExport(Kogin(path), viewMode).export(out)
+        return (path, None)
+    except Exception as e:
+        return (path, str(e))
+
+def func_pdf(args):
+    cmd_pdf(args.path, args.out, args.mode, args.jobs)
+
+def cmd_pdf(path, out, viewMode, jobs):
+    files = list_files(path)
+    tasks = []
+    for file_path in files:
+        name = os.path.splitext(os.path.basename(file_path))[0] + '.pdf'
+        if out is None:
+            out_path = join(os.path.dirname(file_path), name)
+        elif os.path.isdir(path):
+            out_path = join(out, name)
+        else:
+            out_path = out
+        tasks.append((file_path, out_path, viewMode))
+    results = map_files(pdf_file, tasks, jobs, 1)
+    for file_path, error in results:
+        if error:
+            print('Error: {}: {}'.format(file_path, error))
+
+def func_export_stitches(args):
+    cmd_export_stitches(args.path, args.out, args.jobs)
+
+def cmd_export_stitches(path, out, jobs):
+    results = map_files(stitch_columns, [(file_path,) for file_path in list_files(path)], jobs)
+    for file_path, _, _, _, error in results:
+        if error:
+            print('Error: {}: {}'.format(file_path, error))
+    header = write_stitch_table(out, results)
+    print('{} stitches of {} templates'.format(header['count'], len(header['templates'])))
+
+def func_vertex_buffer(args):
+    cmd_vertex_buffer(args.path, args.out, args.mode, args.print)
+
+def cmd_vertex_buffer(path, out, viewMode, forPrinting):
+    header = VertexBufferWriter(Kogin(path)).export(out, forPrinting, viewMode)
+    print('{} segments in {} ranges'.format(header['count'], len(header['ranges'])))
+
+def main(argv=None):
+    import argparse
     parser = argparse.ArgumentParser(
                 prog = 'kogin',
                 description = 'Checks template confliction')
@@ -1167,27 +4437,105 @@ def main():
         help='Path to kogin file.')
     parser_hash.set_defaults(func=func_hash)
 
-    # kogin list dir_path list_path
+    # kogin list dir_path list_path [--shard i/N]
     parser_list = subparsers.add_parser('list',
         help='Makes list of hash for files in specified directory.')
     parser_list.add_argument('path',
         help='Path to directory.')
     parser_list.add_argument('list',
         help='Path to listing file.')
+    parser_list.add_argument('--shard',
+        help='Lists only part i of N of the files, as i/N.',
+        type=parse_shard, default=None)
+    add_supervisor_arguments(parser_list)
     parser_list.set_defaults(func=func_list)
 
+    # kogin merge-lists list_path list_path...
+    parser_merge = subparsers.add_parser('merge-lists',
+        help='Merges listings of shards into one listing.')
+    parser_merge.add_argument('list',
+        help='Path to output listing file.')
+    parser_merge.add_argument('lists',
+        help='Paths to listing files of shards.',
+        nargs='+')
+    parser_merge.set_defaults(func=func_merge_lists)
+
     # kogin repeated dir_path
     parser_repeated = subparsers.add_parser('repeated',
         help='Checks repeated templates in the directory.')
     parser_repeated.add_argument('path',
         help='Path to directory.')
+    add_supervisor_arguments(parser_repeated)
     parser_repeated.set_defaults(func=func_repeated)
 
+    # kogin index dir_path
+    parser_index = subparsers.add_parser('index',
+        help='Builds or updates search index of metadata.')
+    parser_index.add_argument('path',
+        help='Path to directory.')
+    parser_index.add_argument('-i', '--index',
+        help='Path to index file, {} in the directory by default.'.format(INDEX_NAME))
+    add_jobs_argument(parser_index)
+    parser_index.set_defaults(func=func_index)
+
+    # kogin search path query
+    parser_search = subparsers.add_parser('search',
+        help='Searches files by metadata from the index.')
+    parser_search.add_argument('path',
+        help='Path to directory or index file.')
+    parser_search.add_argument('query', nargs='*',
+        help='Terms to search, latin words match by prefix.')
+    parser_search.add_argument('-f', '--field',
+        help='Field to search, can be specified multiple times.',
+        choices=INDEX_FIELDS, action='append')
+    for facet in ('width', 'height', 'stitches'):
+        parser_search.add_argument('--min-' + facet, type=int, default=None,
+            help='Minimum {}.'.format(facet))
+        parser_search.add_argument('--max-' + facet, type=int, default=None,
+            help='Maximum {}.'.format(facet))
+    parser_search.set_defaults(func=func_search)
+
+    # kogin audit path
+    parser_audit = subparsers.add_parser('audit',
+        help='Lists hash, duplicates, missing pivots and invalid data of files in single pass.')
+    parser_audit.add_argument('path',
+        help='Path to directory.')
+    parser_audit.add_argument('-o', '--output',
+        help='Path to output JSON file, written to stdout by default.')
+    add_jobs_argument(parser_audit)
+    parser_audit.set_defaults(func=func_audit)
+
+    # kogin stats path
+    parser_stats = subparsers.add_parser('stats',
+        help='Reports number of stitches and thread length for each color.')
+    parser_stats.add_argument('path',
+        help='Path to kogin file or directory.')
+    parser_stats.add_argument('-o', '--output',
+        help='Path to output file, written to stdout by default.')
+    parser_stats.add_argument('-f', '--format',
+        help='Output format.',
+        choices=['csv', 'json'], default='csv')
+    parser_stats.add_argument('--grid-width',
+        help='Width of a grid in mm, the grid width for printing by default.',
+        type=float, default=None)
+    add_jobs_argument(parser_stats)
+    parser_stats.set_defaults(func=func_stats)
+
     # kogin pivots dir_path
     parser_pivots = subparsers.add_parser('pivots',
         help='Checks pivots not specified.')
     parser_pivots.add_argument('path',
         help='Path to directory.')
+    parser_pivots.add_argument('-c', '--compute',
+        help='Computes pivots from symmetry of stitches and writes them into files without pivots.',
+        action='store_true')
+    parser_pivots.add_argument('-a', '--all',
+        help='Replaces pivots of all files with --compute.',
+        action='store_true')
+    parser_pivots.add_argument('-n', '--dry-run',
+        help='Only reports computed pivots.',
+        action='store_true')
+    add_jobs_argument(parser_pivots)
     parser_pivots.set_defaults(func=func_pivots)
 
     # kogin update dir_path base_path
@@ -1200,14 +4548,161 @@ def main():
     parser_update.add_argument('-p', '--print',
         help='Image mode for print.',
         action='store_true')
+    parser_update.add_argument('--tile',
+        help='Writes repeated stitches as uses of a shared motif.',
+        action='store_true')
+    parser_update.add_argument('--minify',
+        help='Writes smaller output with shortest numbers and no redundant attributes.',
+        action='store_true')
+    parser_update.add_argument('--cache',
+        help='Directory to store serialized layers, reused while the layer is not changed.',
+        default=None)
+    add_supervisor_arguments(parser_update)
 
     parser_update.set_defaults(func=func_update)
 
-    args = parser.parse_args()
-    args.func(args)
+    # kogin render path out_dir
+    parser_render = subparsers.add_parser('render',
+        help='Renders SVG images in multiple view modes from single file.')
+    parser_render.add_argument('path',
+        help='Path to kogin file.')
+    parser_render.add_argument('out_dir',
+        help='Path to output directory.')
+    parser_render.add_argument('-m', '--mode',
+        help='View mode, LineGrain, FillGrain, OverGrain or OverWarp. '
+             'Can be specified multiple times, all modes by default.',
+        type=parse_view_mode, action='append')
+    parser_render.add_argument('-t', '--target',
+        help='Output target.',
+        choices=['screen', 'print', 'both'], default='both')
+    parser_render.add_argument('--tile',
+        help='Writes repeated stitches as uses of a shared motif.',
+        action='store_true')
+    parser_render.add_argument('--minify',
+        help='Writes smaller output with shortest numbers and no redundant attributes.',
+        action='store_true')
+    parser_render.add_argument('--cache',
+        help='Directory to store serialized layers, reused while the layer is not changed.',
+        default=None)
+    parser_render.set_defaults(func=func_render)
+
+    # kogin pack path
+    parser_pack = subparsers.add_parser('pack',
+        help='Stores kogin-data in compact packed format.')
+    parser_pack.add_argument('path',
+        help='Path to kogin file or directory.')
+    parser_pack.add_argument('-u', '--unpack',
+        help='Stores kogin-data in JSON coordinates readable by the editor.',
+        action='store_true')
+    parser_pack.add_argument('-n', '--dry-run',
+        help='Only reports size of the data.',
+        action='store_true')
+    add_jobs_argument(parser_pack)
+    parser_pack.set_defaults(func=func_pack)
+
+    # kogin migrate path
+    parser_migrate = subparsers.add_parser('migrate',
+        help='Migrates data of files to the current format.')
+    parser_migrate.add_argument('path',
+        help='Path to kogin file or directory.')
+    parser_migrate.add_argument('-n', '--dry-run',
+        help='Only reports files to be migrated.',
+        action='store_true')
+    add_jobs_argument(parser_migrate)
+    parser_migrate.add_argument('--to',
+        help='Target version.',
+        type=int, default=SCHEMA_VERSION)
+    parser_migrate.set_defaults(func=func_migrate)
+
+    # kogin diff path1 path2
+    parser_diff = subparsers.add_parser('diff',
+        help='Shows difference of stitches between two files.')
+    parser_diff.add_argument('path1',
+        help='Path to original kogin file.')
+    parser_diff.add_argument('path2',
+        help='Path to changed kogin file.')
+    parser_diff.add_argument('-o', '--output',
+        help='Path to SVG file to write difference.')
+    parser_diff.add_argument('-v', '--verbose',
+        help='Shows each changed stitch.',
+        action='store_true')
+    parser_diff.set_defaults(func=func_diff)
+
+    # kogin compose layout output
+    parser_compose = subparsers.add_parser('compose',
+        help='Composes a pattern from templates placed by layout file.')
+    parser_compose.add_argument('layout',
+        help='Path to layout JSON file.')
+    parser_compose.add_argument('output',
+        help='Path to output file.')
+    parser_compose.add_argument('-p', '--print',
+        help='Image mode for print.',
+        action='store_true')
+    parser_compose.add_argument('--tile',
+        help='Writes repeated stitches as uses of a shared motif.',
+        action='store_true')
+    parser_compose.add_argument('--minify',
+        help='Writes smaller output with shortest numbers and no redundant attributes.',
+        action='store_true')
+    parser_compose.set_defaults(func=func_compose)
+
+    # kogin find template path
+    parser_find = subparsers.add_parser('find',
+        help='Finds where the template appears in patterns.')
+    parser_find.add_argument('template',
+        help='Path to template file.')
+    parser_find.add_argument('path',
+        help='Path to pattern file or directory.')
+    add_jobs_argument(parser_find)
+    parser_find.set_defaults(func=func_find)
+
+    # kogin pdf path
+    parser_pdf = subparsers.add_parser('pdf',
+        help='Writes PDF for printing.')
+    parser_pdf.add_argument('path',
+        help='Path to kogin file or directory.')
+    parser_pdf.add_argument('-o', '--out',
+        help='Path to output file or directory, next to the input by default.')
+    parser_pdf.add_argument('-m', '--mode',
+        help='View mode, LineGrain, FillGrain, OverGrain or OverWarp.',
+        type=parse_view_mode, default=None)
+    add_jobs_argument(parser_pdf)
+    parser_pdf.set_defaults(func=func_pdf)
+
+    # kogin export-stitches dir_path out_path
+    parser_export = subparsers.add_parser('export-stitches',
+        help='Exports stitches of all files into a columnar file.')
+    parser_export.add_argument('path',
+        help='Path to directory.')
+    parser_export.add_argument('out',
+        help='Path to output file.')
+    add_jobs_argument(parser_export)
+    parser_export.set_defaults(func=func_export_stitches)
+
+    # kogin vertex-buffer path out_path
+    parser_vertex = subparsers.add_parser('vertex-buffer',
+        help='Writes stitches and grid as packed line segments for GPU renderers.')
+    parser_vertex.add_argument('path',
+        help='Path to kogin file.')
+    parser_vertex.add_argument('out',
+        help='Path to output file.')
+    parser_vertex.add_argument('-m', '--mode',
+        help='View mode, LineGrain, FillGrain, OverGrain or OverWarp.',
+        type=parse_view_mode, default=None)
+    parser_vertex.add_argument('-p', '--print',
+        help='Image mode for print.',
+        action='store_true')
+    parser_vertex.set_defaults(func=func_vertex_buffer)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return 1
+    return args.func(args)
 
 def main2():
     kogin = Kogin('./katako-17-1.svg')
     Writer(kogin).write(False)
 
-main()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,616 @@
+import contextlib
+import copy
+import io
+import json
+import re
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+import zlib
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import benchmark
+import kogin
+
+
+MOTIF = [(0, 0, 0), (3, 0, 1), (1, 1, 0), (4, 1, 0),
+         (0, 2, 1), (2, 2, 0), (3, 3, 1), (5, 3, 0)]
+
+
+def _sleep(seconds):
+    kogin.set_stage('sleep')
+    time.sleep(seconds)
+    return seconds
+
+
+def make_data(stitches, bbox=None):
+    """ Returns kogin-data of list of (x, y, length) in black. """
+    refs = {}
+    for x, y, length in stitches:
+        refs.setdefault(length, []).append([x, y])
+    data = benchmark.make_data(0, 0)
+    data['data'][0]['children'] = [{'ref': '{}-000000'.format(length), 'coords': coords}
+                                   for length, coords in sorted(refs.items())]
+    data['defs'] = {'single': [{'length': str(length), 'colors': ['#000000']} for length in sorted(refs)]}
+    data['bbox'] = bbox or [0, 0, max(x + length for x, y, length in stitches) + 1,
+                            max(y for x, y, length in stitches) + 1]
+    return data
+
+
+def write_template(path, data, option=None, metadata=None):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<svg xmlns="http://www.w3.org/2000/svg">\n')
+        for name, value in (('option', option or benchmark.make_option()), ('data', data),
+                            ('metadata', metadata or {'title': os.path.basename(path)})):
+            f.write('<foreignObject id="kogin-{}" visibility="hidden">{}</foreignObject>\n'.format(
+                name, kogin.escape(json.dumps(value))))
+        f.write('</svg>')
+
+
+def tuple_of(*args):
+    return args
+
+
+def tile(width, height, skew, columns, rows):
+    return [(x + i * width + j * skew, y + j * height, r)
+            for j in range(rows) for i in range(columns) for x, y, r in MOTIF]
+
+
+class TilingTest(unittest.TestCase):
+    def test_plain(self):
+        tiling = kogin.Tiling(tile(6, 4, 0, 7, 6))
+        self.assertEqual(tiling.periods, ((6, 0), (0, 4)))
+        self.assertEqual(len(tiling.tiles), 42)
+        self.assertEqual(tiling.residue, [])
+
+    def test_stray_stitches_go_to_residue(self):
+        strays = [(100, 100, 2), (101, 103, 2), (-5, -5, 0)]
+        tiling = kogin.Tiling(tile(6, 4, 0, 7, 6) + strays)
+        self.assertEqual(tiling.periods, ((6, 0), (0, 4)))
+        self.assertEqual(len(tiling.tiles), 42)
+        self.assertEqual(sorted(tiling.residue), sorted(strays))
+
+    def test_skewed_period(self):
+        strays = [(100, 100, 2), (101, 103, 2)]
+        for columns, rows in ((7, 6), (2, 6), (1, 6)):
+            tiling = kogin.Tiling(tile(6, 6, 3, columns, rows) + strays)
+            self.assertEqual(tiling.periods[1], (3, 6))
+            self.assertEqual(len(tiling.tiles), columns * rows)
+            self.assertEqual(sorted(tiling.residue), strays)
+
+
+class PDFExportTest(unittest.TestCase):
+    def export(self, width, height):
+        # the grid has a margin of 3x2 cells around the data, 47x67 cells in an A4 page
+        k = kogin.Kogin.create(benchmark.make_data(width - 3, height - 2), benchmark.make_option(), {})
+        pdf = kogin.PDFExport(k)
+        with tempfile.TemporaryDirectory() as tmp:
+            pdf.export(os.path.join(tmp, 'out.pdf'))
+        self.assertEqual((pdf.contentPageWidth, pdf.contentPageHeight), (47, 67))
+        self.assertEqual((pdf.gridRect.width, pdf.gridRect.height), (width, height))
+        return pdf
+
+    def pageSizes(self, pdf):
+        return [pdf.getPageGridSize(row, column)
+                for row in range(pdf.pageRows) for column in range(pdf.pageColumns)]
+
+    def test_exactly_a_page(self):
+        pdf = self.export(47, 67)
+        self.assertEqual((pdf.pageColumns, pdf.pageRows), (1, 1))
+        self.assertEqual(self.pageSizes(pdf), [(47, 67)])
+
+    def test_exact_multiple_of_pages(self):
+        pdf = self.export(94, 134)
+        self.assertEqual((pdf.pageColumns, pdf.pageRows), (2, 2))
+        self.assertEqual(self.pageSizes(pdf), [(47, 67)] * 4)
+
+    def test_hidden_layer(self):
+        data = make_data([(0, 0, 2), (3, 1, 2), (5, 3, 1)])
+        layer = copy.deepcopy(data['data'][0])
+        layer['name'] = 'Layer 2'
+        layer['children'] = [{'ref': '2-000000', 'coords': [[0, 2], [4, 4]]}]
+        data['data'].append(layer)
+
+        def countDraws(data):
+            pdf = kogin.PDFExport(kogin.Kogin.create(data, benchmark.make_option(), {}))
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'out.pdf')
+                pdf.export(path)
+                with open(path, 'rb') as f:
+                    content = f.read()
+            streams = re.findall(rb'stream\n(.*?)\nendstream', content, re.S)
+            return sum(zlib.decompress(stream).count(b' Do Q') for stream in streams)
+
+        self.assertEqual(countDraws(data), 5)
+        layer['visible'] = False
+        self.assertEqual(countDraws(data), 3)
+
+    def test_last_page_takes_the_rest(self):
+        pdf = self.export(95, 68)
+        self.assertEqual((pdf.pageColumns, pdf.pageRows), (3, 2))
+        self.assertEqual(self.pageSizes(pdf), [(47, 67), (47, 67), (1, 67), (47, 1), (47, 1), (1, 1)])
+
+
+class EncodedTest(unittest.TestCase):
+    def test_same_format_is_not_converted(self):
+        data = kogin.KoginData(benchmark.make_data(20, 10))
+        self.assertIs(data.encoded(kogin.DATA_FORMAT_JSON), data.getData())
+        packed = kogin.KoginData(data.encoded(kogin.DATA_FORMAT_PACKED))
+        self.assertIsNot(packed.getData(), data.getData())
+        self.assertIs(packed.encoded(kogin.DATA_FORMAT_PACKED), packed.getData())
+        self.assertEqual(packed.encoded(kogin.DATA_FORMAT_JSON), data.getData())
+
+    def test_writer_encodes_data_once(self):
+        k = kogin.Kogin.create(benchmark.make_data(20, 10), benchmark.make_option(), {})
+        k.getOption().getData()[kogin.DATA_FORMAT_KEY] = kogin.DATA_FORMAT_PACKED
+        calls = []
+        encoded = k.getData().encoded
+        k.getData().encoded = lambda dataFormat: calls.append(dataFormat) or encoded(dataFormat)
+        writer = kogin.Writer(k)
+        first = writer.write()
+        self.assertEqual(writer.write(), first)
+        self.assertEqual(calls, [kogin.DATA_FORMAT_PACKED])
+
+
+class ResolveOverlapsTest(unittest.TestCase):
+    def resolve(self, stitches):
+        return kogin.resolve_overlaps([list(s) for s in stitches])
+
+    def test_inside_and_touching(self):
+        self.assertEqual(self.resolve([(0, 0, 5, 'a', 0), (1, 0, 2, 'b', 1)]), [[0, 0, 5, 'a', 0]])
+        self.assertEqual(self.resolve([(2, 0, 3, 'b', 1), (0, 0, 2, 'a', 0)]), [[0, 0, 5, 'a', 0]])
+        self.assertEqual(self.resolve([(0, 0, 2, 'a', 0), (3, 0, 2, 'b', 0), (0, 1, 2, 'a', 0)]),
+                         [[0, 0, 2, 'a', 0], [3, 0, 2, 'b', 0], [0, 1, 2, 'a', 0]])
+
+    def test_chain_becomes_a_stitch(self):
+        # Normalizer leaves [0, 0, 7] and [4, 0, 5] here
+        chain = [(0, 0, 3, 'a', 0), (2, 0, 3, 'b', 0), (4, 0, 3, 'a', 1), (6, 0, 3, 'b', 1)]
+        self.assertEqual(self.resolve(chain), [[0, 0, 9, 'a', 0]])
+
+    def test_same_start_is_merged_once(self):
+        # Normalizer leaves two copies of [0, 0, 6] here
+        stitches = [(0, 0, 3, 'a', 0), (1, 0, 4, 'a', 0), (2, 0, 4, 'a', 0)]
+        self.assertEqual(self.resolve(stitches), [[0, 0, 6, 'a', 0]])
+
+
+class StitchDiffTest(unittest.TestCase):
+    def test_changed_bbox(self):
+        data = benchmark.make_data(20, 10)
+        changed = copy.deepcopy(data)
+        changed['bbox'] = [-3, -2, 26, 12]
+        option = benchmark.make_option()
+        d = kogin.diff_kogins(kogin.Kogin.create(data, option, {}), kogin.Kogin.create(changed, option, {}))
+        self.assertTrue(d.isSame())
+
+        children = changed['data'][0]['children']
+        x, y = children[0]['coords'].pop()
+        children.append({'ref': '1-000000', 'coords': [[30, 30]]})
+        d = kogin.diff_kogins(kogin.Kogin.create(data, option, {}), kogin.Kogin.create(changed, option, {}))
+        # relative to the left top of the union of the bboxes
+        length = int(children[0]['ref'].split('-')[0])
+        self.assertEqual(d.removed, [(x + 3, y + 2, length)])
+        self.assertEqual(d.added, [(33, 32, 1)])
+
+
+class SupervisorTest(unittest.TestCase):
+    def test_timeout_is_skipped(self):
+        supervisor = kogin.Supervisor(2, timeout=0.5)
+        results = supervisor.map(_sleep, [(0,), (30,), (0.1,), (0,)], ['a', 'b', 'c', 'd'])
+        self.assertEqual(results, [0, None, 0.1, 0])
+        self.assertEqual(len(supervisor.skipped), 1)
+        entry = supervisor.skipped[0]
+        self.assertEqual((entry['task'], entry['reason'], entry['stage']), ('b', 'timeout', 'sleep'))
+
+
+class LazyJSONObjectTest(unittest.TestCase):
+    TEXTS = [
+        '{}',
+        ' { } ',
+        '{"a": 1, "b": -2.5e3, "c": true, "d": null, "e": "x"}',
+        '{"a": [1, [2, {"b": "]}"}]], "c": {"d": "\\"{[", "e": []}, "f": "あ\\u3044"}',
+        '{\n "a" : [ ] ,\n "b" : { "c" : "\\\\" }\n}',
+        json.dumps(benchmark.make_data(20, 10), indent=1),
+    ]
+
+    def test_same_as_json(self):
+        for text in self.TEXTS:
+            expected = json.loads(text)
+            obj = kogin.LazyJSONObject(text)
+            self.assertEqual(sorted(obj.keys()), sorted(expected.keys()))
+            for key, value in expected.items():
+                self.assertEqual(obj[key], value)
+            self.assertEqual(kogin.LazyJSONObject(text).decode(), expected)
+
+    def test_invalid(self):
+        for text in ('[]', '{"a" 1}', '{"a": 1 "b": 2}', '{"a": [1, 2}'):
+            with self.assertRaises(ValueError):
+                kogin.LazyJSONObject(text).decode()
+
+
+class SVGSectionsTest(unittest.TestCase):
+    DATA = {'application': 'kogin', 'text': '<a & "b">', 'data': [], 'bbox': [0, 0, 1, 1]}
+
+    def svg(self, section):
+        return ('<svg xmlns="http://www.w3.org/2000/svg">\n'
+                '<foreignObject id="kogin-option" visibility="hidden">{"a": "&lt;&amp;"}</foreignObject>\n'
+                + section + '\n<rect width="1" height="1"/>\n</svg>').encode('utf-8')
+
+    def treeText(self, content, name):
+        root = ET.fromstring(content)
+        for obj in root.iter('{http://www.w3.org/2000/svg}foreignObject'):
+            if obj.get('id') == name:
+                return obj.text
+
+    def test_same_as_element_tree(self):
+        text = json.dumps(self.DATA)
+        escaped = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        variants = [
+            '<foreignObject id="kogin-data">' + escaped + '</foreignObject>',
+            "<foreignObject visibility='hidden' id='kogin-data'>" + escaped + '</foreignObject>',
+            '<foreignObject id="kogin-data"><![CDATA[' + text + ']]></foreignObject>',
+            '<foreignObject id="kogin-data">' + escaped.replace('"', '&#34;') + '</foreignObject>',
+            '<foreignObject id="kogin-data">' + escaped.replace('"', '&quot;') + '</foreignObject>',
+        ]
+        for variant in variants:
+            content = self.svg(variant)
+            sections = kogin.SVGSections(content)
+            for name in ('kogin-option', 'kogin-data'):
+                self.assertIn(name, sections)
+                self.assertEqual(sections.text(name), self.treeText(content, name))
+                self.assertEqual(sections[name], json.loads(self.treeText(content, name)))
+            self.assertEqual(kogin.LazyJSONObject(sections.text('kogin-data')).decode(), self.DATA)
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'template.svg')
+                with open(path, 'wb') as f:
+                    f.write(content)
+                self.assertEqual(kogin.Kogin(path).getData().getData(), self.DATA)
+
+    def test_self_closing(self):
+        content = self.svg('<foreignObject id="kogin-data"/>')
+        sections = kogin.SVGSections(content)
+        self.assertNotIn('kogin-data', sections)
+        self.assertEqual(sections['kogin-option'], {'a': '<&'})
+
+    def test_splice(self):
+        content = self.svg("<foreignObject id='kogin-data'><![CDATA[" + json.dumps(self.DATA) + ']]></foreignObject>')
+        sections = kogin.SVGSections(content)
+        sections['kogin-data'] = dict(sections['kogin-data'], bbox=[1, 2, 3, 4])
+        spliced = sections.splice()
+        self.assertEqual(json.loads(self.treeText(spliced, 'kogin-data')), dict(self.DATA, bbox=[1, 2, 3, 4]))
+        self.assertEqual(kogin.SVGSections(spliced)['kogin-option'], {'a': '<&'})
+
+
+class SymmetryTest(unittest.TestCase):
+    def test_mirrored_horizontally(self):
+        symmetry = kogin.Symmetry([(0, 0, 2), (4, 0, 2), (2, 1, 2)])
+        self.assertEqual((symmetry.hori, symmetry.vert, symmetry.rotation), (5, None, False))
+        self.assertEqual(symmetry.pivots(), [[2, 0], [2, 1]])
+
+    def test_mirrored_vertically(self):
+        symmetry = kogin.Symmetry([(0, 0, 2), (3, 1, 1), (0, 2, 2)])
+        self.assertEqual((symmetry.hori, symmetry.vert, symmetry.rotation), (None, 2, False))
+        self.assertEqual(symmetry.pivots(), [[0, 1], [3, 1]])
+
+    def test_rotated(self):
+        symmetry = kogin.Symmetry([(0, 0, 2), (3, 1, 2)])
+        self.assertEqual((symmetry.hori, symmetry.vert, symmetry.rotation), (None, None, True))
+        self.assertEqual(symmetry.pivots(), [[2, 0]])
+
+    def test_asymmetric(self):
+        symmetry = kogin.Symmetry([(0, 0, 2), (3, 0, 1), (1, 1, 1)])
+        self.assertEqual((symmetry.hori, symmetry.vert, symmetry.rotation), (None, None, False))
+        self.assertEqual(symmetry.pivots(), [])
+
+    def test_asymmetric_file_is_unchanged(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'a.svg')
+            write_template(path, make_data([(0, 0, 2), (3, 0, 1), (1, 1, 1)]))
+            with open(path, 'rb') as f:
+                content = f.read()
+            self.assertEqual(kogin.pivots_file(path), (path, [], None))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+            path = os.path.join(tmp, 'b.svg')
+            write_template(path, make_data([(0, 0, 2), (3, 1, 2)]))
+            self.assertEqual(kogin.pivots_file(path), (path, [[2, 0]], None))
+            self.assertEqual(kogin.Kogin(path).getData().pivots(), [[2, 0]])
+
+
+class ComposerTest(unittest.TestCase):
+    def test_option_of_first_template(self):
+        option = benchmark.make_option()
+        option['bounds'].update({'useOutputBounds': True, 'boundsLeft': 1, 'boundsRight': 2})
+        option[kogin.SCHEMA_VERSION_KEY] = kogin.SCHEMA_VERSION
+        option[kogin.DATA_FORMAT_KEY] = kogin.DATA_FORMAT_PACKED
+        first = kogin.Kogin.create(make_data([(0, 0, 2), (3, 1, 2)]), option, {'title': 'a'})
+        second = kogin.Kogin.create(make_data([(0, 0, 1)]), benchmark.make_option(), {'title': 'b'})
+        composer = kogin.Composer()
+        composer.add(first, 0, 0)
+        composer.add(second, 10, 5)
+        composed = composer.compose()
+
+        data = composed.getOption().getData()
+        self.assertNotIn(kogin.SCHEMA_VERSION_KEY, data)
+        self.assertNotIn(kogin.DATA_FORMAT_KEY, data)
+        self.assertEqual(data['bounds'], {'useOutputBounds': False, 'boundsLeft': 0, 'boundsTop': 0,
+                                          'boundsRight': 10, 'boundsBottom': 5})
+        self.assertEqual(data['grid-screen'], option['grid-screen'])
+        self.assertTrue(option['bounds']['useOutputBounds'])
+        self.assertEqual(composed.getMetadata(), {'title': 'a'})
+
+
+def random_stitches(seed, count, width, height):
+    # dense rows so that stitches are inside of, touch and chain with others
+    rnd = random.Random(seed)
+    return [(rnd.randrange(width), rnd.randrange(height), rnd.randrange(1, 8)) for _ in range(count)]
+
+
+class NormalizerTest(unittest.TestCase):
+    def assertSameAsSerial(self, data):
+        serial = kogin.Normalizer(kogin.KoginData(copy.deepcopy(data)))
+        bands = kogin.Normalizer(kogin.KoginData(copy.deepcopy(data)), jobs=2, threshold=1)
+        self.assertEqual(bands.normalize(), serial.normalize())
+        self.assertEqual(bands.base, serial.base)
+
+    def test_bands_same_as_serial(self):
+        for seed in range(2):
+            self.assertSameAsSerial(make_data(random_stitches(seed, 1200, 40, 60)))
+
+    def test_small_bands_same_as_serial(self):
+        # a band for every row or two, overlaps are on both sides of each boundary
+        with mock.patch.object(kogin, 'NORMALIZE_BAND_SIZE', 7):
+            for seed in range(5):
+                self.assertSameAsSerial(make_data(random_stitches(seed, 300, 20, 30)))
+
+
+class FindRepeatedTest(unittest.TestCase):
+    def test_same_groups_as_hashes(self):
+        base = [(0, 0, 5), (7, 0, 2), (1, 1, 3), (4, 2, 4), (0, 3, 1)]
+        templates = {
+            'a.svg': base,
+            # a stitch inside of another one
+            'b.svg': base + [(1, 0, 2)],
+            # overlapping and touching halves of (0, 0, 5) and (4, 2, 4)
+            'c.svg': base[1:4] + [(0, 0, 3), (2, 0, 3), (0, 3, 1)],
+            'd.svg': [base[0], base[1], base[2], (4, 2, 2), (6, 2, 2), base[4]],
+            # same cells in rows, but another stitch
+            'e.svg': [(0, 0, 2), (2, 0, 3)] + base[1:],
+            'f.svg': base[:4] + [(1, 3, 1)],
+            'g.svg': [(0, 0, 5), (7, 0, 2)],
+        }
+        for seed in range(3):
+            stitches = random_stitches(seed, 30, 12, 6)
+            templates['r{}.svg'.format(seed)] = stitches
+            templates['s{}.svg'.format(seed)] = stitches + [(x, y, 1) for x, y, length in stitches[:5]]
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, stitches in templates.items():
+                write_template(os.path.join(tmp, name), make_data(stitches, [0, 0, 20, 10]))
+            hashes = {}
+            for name in sorted(templates):
+                hashes.setdefault(kogin.hash(os.path.join(tmp, name)), []).append(name)
+            expected = sorted(entries for entries in hashes.values() if len(entries) > 1)
+            groups = sorted(kogin.find_repeated(tmp, kogin.Supervisor(2)))
+        self.assertEqual(groups, expected)
+        self.assertIn(['a.svg', 'b.svg', 'c.svg', 'd.svg', 'e.svg'], groups)
+
+
+class ShardTest(unittest.TestCase):
+    def test_shards_partition_names(self):
+        names = ['{}.svg'.format(i) for i in range(200)] + ['テンプレート.svg', 'a b.svg']
+        for count in range(1, 6):
+            shards = [[name for name in names if kogin.in_shard(name, (index, count))]
+                      for index in range(1, count + 1)]
+            self.assertEqual(sorted(sum(shards, [])), sorted(names))
+
+    def test_merged_shards_same_as_list(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = os.path.join(tmp, 'files')
+            os.mkdir(files)
+            for seed in range(12):
+                write_template(os.path.join(files, 'p{:02}.svg'.format(seed)),
+                               make_data(random_stitches(seed % 10, 20, 12, 6), [0, 0, 20, 10]))
+            supervisor = kogin.Supervisor(2)
+            full = os.path.join(tmp, 'full.txt')
+            shards = [os.path.join(tmp, 'shard{}.txt'.format(index)) for index in range(1, 4)]
+            merged = os.path.join(tmp, 'merged.txt')
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                kogin.cmd_list(files, full, None, supervisor)
+                for index, shard in enumerate(shards, 1):
+                    kogin.cmd_list(files, shard, (index, 3), supervisor)
+                self.assertEqual(kogin.cmd_merge_lists(merged, shards), 0)
+            with open(full) as f, open(merged) as g:
+                self.assertEqual(f.read(), g.read())
+            self.assertEqual(len(kogin.read_listing(full)), 12)
+            self.assertIn('p00.svg, p10.svg', out.getvalue())
+
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(kogin.cmd_merge_lists(merged, shards + [shards[0]]), 1)
+            self.assertIn('is listed in more than one listing', out.getvalue())
+
+
+class StitchTableTest(unittest.TestCase):
+    def test_round_trip(self):
+        first = [(0, 0, 2), (3, 1, 1), (-4, 2, 3)]
+        second = [(5, 5, 1), (6, 7, 2)]
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, name) for name in ('a.svg', 'b.svg', 'c.svg')]
+            write_template(paths[0], make_data(first))
+            data = make_data(second)
+            data['data'][0]['children'][0]['ref'] = '1-ff0000'
+            write_template(paths[1], data)
+            broken = make_data(second)
+            broken['data'][0]['children'][0]['coords'][0][0] = 5.5
+            write_template(paths[2], broken)
+
+            results = [kogin.stitch_columns(path) for path in paths]
+            self.assertEqual(results[2][4], 'Invalid x coordinate: 5.5')
+            out = os.path.join(tmp, 'table.bin')
+            header = kogin.write_stitch_table(out, results)
+
+            with open(out, 'rb') as f:
+                content = f.read()
+            self.assertEqual(content[:4], kogin.STITCH_TABLE_MAGIC)
+            version, length = struct.unpack_from('<II', content, 4)
+            self.assertEqual(version, kogin.STITCH_TABLE_VERSION)
+            self.assertEqual(json.loads(content[12:12 + length].decode('utf-8')), header)
+            base = (12 + length + 7) & ~7
+            for column in header['columns']:
+                self.assertEqual((base + column['offset']) % 8, 0)
+
+            table = kogin.StitchTable(out)
+            try:
+                self.assertEqual(len(table), 5)
+                self.assertEqual([t['name'] for t in table.templates], ['a.svg', 'b.svg'])
+                self.assertEqual(table.colors, ['000000', 'ff0000'])
+                self.assertEqual(sorted(zip(table['template'], table['x'], table['y'], table['length'],
+                                            table['color'], table['layer'])),
+                                 sorted([(0, x, y, length, 0, 0) for x, y, length in first] +
+                                        [(1, 5, 5, 1, 1, 0), (1, 6, 7, 2, 0, 0)]))
+            finally:
+                table.close()
+
+
+class VertexBufferTest(unittest.TestCase):
+    SVG = '{http://www.w3.org/2000/svg}'
+
+    def svgSegments(self, content):
+        # ends of the lines placed by use elements, moved by the groups
+        root = ET.fromstring(content)
+        lines = {e.get('id'): e for e in root.iter(self.SVG + 'line')}
+        segments = []
+
+        def walk(element, dx, dy):
+            for child in element:
+                if child.tag == self.SVG + 'g':
+                    tx = ty = 0
+                    if child.get('transform'):
+                        tx, ty = map(float, re.findall(r'[-\d.]+', child.get('transform')))
+                    walk(child, dx + tx, dy + ty)
+                elif child.tag == self.SVG + 'use':
+                    line = lines[child.get('href')[1:]]
+                    x = dx + float(child.get('x', 0))
+                    y = dy + float(child.get('y', 0))
+                    segments.append((x + float(line.get('x1')), y + float(line.get('y1')),
+                                     x + float(line.get('x2')), y + float(line.get('y2'))))
+        walk(root, 0, 0)
+        return segments
+
+    def test_round_trip(self):
+        option = benchmark.make_option()
+        option['grid-screen']['showGrid'] = False
+        option['output-screen']['gridNumber'] = False
+        k = kogin.Kogin.create(make_data([(2, 1, 3)]), option, {'title': 't'})
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, 'out.kgvb')
+            for viewMode in kogin.PositionCalculator.CLASSES:
+                header = kogin.VertexBufferWriter(k).export(out, False, viewMode)
+                read, positions, colors = kogin.read_vertex_buffer(out)
+                self.assertEqual(read, header)
+                self.assertEqual((header['count'], header['viewMode']), (1, viewMode))
+                self.assertEqual([(r['kind'], r['first'], r['count']) for r in header['ranges']],
+                                 [('layer', 0, 1)])
+                self.assertEqual(list(colors), [0, 0])
+                self.assertEqual(header['colors'], ['#000000'])
+                expected = self.svgSegments(kogin.Writer(k).write(False, viewMode))
+                self.assertEqual(len(expected), 1)
+                for value, svg in zip(positions, expected[0]):
+                    self.assertAlmostEqual(value, svg, places=4)
+
+
+class StatsTest(unittest.TestCase):
+    def test_hidden_layers_are_not_counted(self):
+        data = make_data([(0, 0, 2), (3, 1, 2), (5, 3, 1)])
+        layer = copy.deepcopy(data['data'][0])
+        layer['children'] = [{'ref': '2-000000', 'coords': [[0, 2], [4, 4]]}]
+        data['data'].append(layer)
+        self.assertEqual(kogin.color_stats(kogin.KoginData(copy.deepcopy(data))), {'#000000': [5, 9]})
+        layer['visible'] = False
+        self.assertEqual(kogin.color_stats(kogin.KoginData(data)), {'#000000': [3, 5]})
+
+    def test_map_files(self):
+        tasks = [(i, 'x') for i in range(20)]
+        self.assertEqual(kogin.map_files(tuple_of, tasks, 2), tasks)
+        self.assertEqual(kogin.map_files(tuple_of, tasks[:1]), tasks[:1])
+        self.assertEqual(kogin.map_files(tuple_of, []), [])
+
+
+class SearchIndexTest(unittest.TestCase):
+    TEMPLATES = {
+        'a.svg': {'title': '津軽こぎん刺し', 'title-en': 'ＫＯＧＩＮ Ｓａｓｈｉ', 'author': 'Hanako Sato'},
+        'b.svg': {'title': 'こぎん模様', 'author': 'Taro Hanada', 'keyword': 'dish cloth'},
+        'c.svg': {'title': '猫の足跡', 'title-en': 'Cat foot', 'author': 'Sato'},
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        for name, metadata in self.TEMPLATES.items():
+            self.write(name, metadata)
+        self.index = kogin.SearchIndex(kogin.index_path(self.dir))
+        self.assertEqual(self.index.update(self.dir), (3, 0, 0))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, metadata, width=10):
+        write_template(os.path.join(self.dir, name), make_data([(0, 0, 2)], [0, 0, width, 5]), metadata=metadata)
+
+    def test_cjk_ngrams(self):
+        self.assertEqual(self.index.search('こぎん'), ['a.svg', 'b.svg'])
+        self.assertEqual(self.index.search('ぎん刺'), ['a.svg'])
+        self.assertEqual(self.index.search('猫'), ['c.svg'])
+        # all bigrams are indexed, but not next to each other
+        self.assertEqual(self.index.search('こぎ刺'), [])
+        self.assertEqual(self.index.search('津軽 こぎん'), ['a.svg'])
+
+    def test_nfkc(self):
+        self.assertEqual(self.index.search('kogin'), ['a.svg'])
+        self.assertEqual(self.index.search('ＣＡＴ'), ['c.svg'])
+        self.assertEqual(self.index.search('ｺｷﾞﾝ'), [])
+
+    def test_latin_prefix(self):
+        self.assertEqual(self.index.search('han'), ['a.svg', 'b.svg'])
+        self.assertEqual(self.index.search('Hanako'), ['a.svg'])
+        self.assertEqual(self.index.search('sato'), ['a.svg', 'c.svg'])
+        # words match from their start only
+        self.assertEqual(self.index.search('ako'), [])
+        self.assertEqual(self.index.search('sato', fields=['title']), [])
+        self.assertEqual(self.index.search('sato', fields=['author']), ['a.svg', 'c.svg'])
+
+    def test_incremental_update(self):
+        self.index.save()
+        index = kogin.SearchIndex.load(kogin.index_path(self.dir))
+        self.assertEqual(index.files, self.index.files)
+
+        self.write('b.svg', {'title': 'こぎん模様', 'author': 'Jiro'}, 20)
+        path = os.path.join(self.dir, 'b.svg')
+        mtime = os.stat(path).st_mtime_ns + 10 ** 9
+        os.utime(path, ns=(mtime, mtime))
+        os.remove(os.path.join(self.dir, 'c.svg'))
+        # a single changed file is read in this process, so it can be counted
+        with mock.patch.object(kogin, 'index_entry', wraps=kogin.index_entry) as entry:
+            self.assertEqual(index.update(self.dir), (0, 1, 1))
+        self.assertEqual([call.args[0] for call in entry.call_args_list], [path])
+        self.write('d.svg', {'title': '菱刺し'})
+        self.assertEqual(index.update(self.dir), (1, 0, 0))
+        self.assertEqual(index.search('jiro'), ['b.svg'])
+        self.assertEqual(index.search('taro'), [])
+        self.assertEqual(index.search('sato'), ['a.svg'])
+        self.assertEqual(index.search('刺し'), ['a.svg', 'd.svg'])
+        self.assertEqual(index.search('', facets={'width': (15, None)}), ['b.svg'])
+
+        with mock.patch.object(kogin, 'index_entry', wraps=kogin.index_entry) as entry:
+            self.assertEqual(index.update(self.dir), (0, 0, 0))
+        self.assertEqual(entry.call_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()